@@ -1,26 +1,45 @@
 import os
 from flask import Flask
-from flask_restful import Api
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import logging
 
 app = Flask(__name__)
 CORS(app)
 
 settings = os.getenv('APP_SETTINGS', 'eachday.config.DevelopmentConfig')
 app.config.from_object(settings)
-level = app.config.get('LOG_LEVEL', logging.INFO)
-app.logger.setLevel(level)
 
+from .log import configure_logging  # nopep8
+configure_logging(app)
+
+from .database import SQLAlchemy, register_database_hooks  # nopep8
 db = SQLAlchemy(app)
+register_database_hooks(app, db)
+
+from .utils import Api  # nopep8
 api = Api(app)
-bcrypt = Bcrypt(app)
+
+from . import tracing  # nopep8
+tracing.register_tracing(app)
+bcrypt = tracing.TracedBcrypt(app)
+
+from . import querylog  # nopep8
+querylog.register_query_hooks(app)
+
+from . import events  # nopep8
+events.register_event_hooks(app)
+
+from . import profiling  # nopep8
+profiling.register_profiling(app)
+
+from . import concurrency  # nopep8
+concurrency.register_concurrency_limits(app)
 
 from . import resources  # nopep8
 resources.create_apis(api)
 resources.register_error_handlers(app)
 
+from .static import register_static  # nopep8
+register_static(app)
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,216 @@
+import array
+import ast
+import itertools
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+from datetime import date
+from .models import Entry
+
+from eachday import db
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columns written for every entry, with their .npy dtypes. Ratings are
+# 1-10, so 0 stands for "not rated" in the .npy files; Parquet has nulls.
+COLUMNS = (('user_id', '<i4'), ('date', '<M8[D]'), ('rating', '|i1'),
+           ('notes_length', '<i4'))
+EPOCH = date(1970, 1, 1)
+STATE_FILE = '_state.json'
+FETCH_ROWS = 10000
+
+
+def array_typecode(size):
+    """ Returns the array module typecode for signed integers of a size """
+    for code in 'bhilq':
+        try:
+            if array.array(code).itemsize == size:
+                return code
+        except ValueError:  # 'q' needs Python 3
+            pass
+    raise ValueError('No {}-byte integer array type'.format(size))
+
+
+def dtype_size(dtype):
+    return int(re.search(r'\d+', dtype).group())
+
+
+def new_columns():
+    return dict((name, array.array(array_typecode(dtype_size(dtype))))
+                for name, dtype in COLUMNS)
+
+
+def write_npy(path, dtype, values):
+    """ Writes an array.array as a NumPy .npy file, without NumPy """
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}" \
+        .format(dtype, len(values))
+    # The header is padded so the data starts on a 64 byte boundary
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    with open(path, 'wb') as f:
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+                header.encode('latin1'))
+        values.tofile(f)
+
+
+def read_npy(path):
+    """ Reads a 1-d integer .npy file written by write_npy """
+    with open(path, 'rb') as f:
+        if f.read(8) != b'\x93NUMPY\x01\x00':
+            raise ValueError('{} is not a .npy file'.format(path))
+        length, = struct.unpack('<H', f.read(2))
+        header = ast.literal_eval(f.read(length).decode('latin1'))
+        values = array.array(array_typecode(dtype_size(header['descr'])))
+        values.fromfile(f, header['shape'][0])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def month_key(year, month):
+    return '{:04d}-{:02d}'.format(int(year), int(month))
+
+
+def month_range(key):
+    year, month = int(key[:4]), int(key[5:])
+    return (date(year, month, 1),
+            date(year + month // 12, month % 12 + 1, 1))
+
+
+def month_fingerprints():
+    """
+    Returns {month: fingerprint} for every month with entries. Inserts,
+    updates and deletes all change the count, id sum or latest update.
+    """
+    year = db.extract('year', Entry.date)
+    month = db.extract('month', Entry.date)
+    rows = (db.session.query(year, month, db.func.count(Entry.id),
+                             db.func.sum(Entry.id),
+                             db.func.max(Entry.updated_at))
+            .group_by(year, month))
+    fingerprints = dict((month_key(y, m), [count, int(id_sum),
+                                           str(updated_at)])
+                        for y, m, count, id_sum, updated_at in rows)
+    db.session.rollback()
+    return fingerprints
+
+
+def iter_months(months):
+    """
+    Yields (month, columns) for the given months from one streamed query,
+    so only a month of compact columns is held at a time
+    """
+    if not months:
+        return
+    ranges = [month_range(key) for key in months]
+    query = (db.session.query(Entry.user_id, Entry.date, Entry.rating,
+                              db.func.coalesce(db.func.length(Entry.notes),
+                                               0))
+             .filter(db.or_(*[db.and_(Entry.date >= start, Entry.date < end)
+                              for start, end in ranges]))
+             .order_by(Entry.date, Entry.user_id)
+             .execution_options(stream_results=True)
+             .yield_per(FETCH_ROWS))
+    by_month = itertools.groupby(
+        query, lambda row: month_key(row[1].year, row[1].month))
+    for key, rows in by_month:
+        columns = new_columns()
+        for user_id, day, rating, notes_length in rows:
+            columns['user_id'].append(user_id)
+            columns['date'].append((day - EPOCH).days)
+            columns['rating'].append(rating or 0)
+            columns['notes_length'].append(notes_length)
+        yield key, columns
+    db.session.rollback()
+
+
+def write_parquet(path, columns):
+    table = pyarrow.Table.from_arrays([
+        pyarrow.array(columns['user_id'], pyarrow.int32()),
+        pyarrow.array(columns['date'], pyarrow.int32())
+        .cast(pyarrow.date32()),
+        pyarrow.array([r or None for r in columns['rating']],
+                      pyarrow.int8()),
+        pyarrow.array(columns['notes_length'], pyarrow.int32()),
+    ], names=[name for name, _ in COLUMNS])
+    pyarrow.parquet.write_table(table, os.path.join(path, 'part.parquet'))
+
+
+def write_partition(directory, key, columns, file_format):
+    """
+    Writes a month to directory/month=YYYY-MM, replacing the old files
+    only once the new ones are complete
+    """
+    path = os.path.join(directory, 'month=' + key)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    if file_format == 'parquet':
+        write_parquet(tmp, columns)
+    else:
+        for name, dtype in COLUMNS:
+            write_npy(os.path.join(tmp, name + '.npy'), dtype, columns[name])
+    remove_partition(directory, key)
+    os.rename(tmp, path)
+
+
+def remove_partition(directory, key):
+    path = os.path.join(directory, 'month=' + key)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def dump_analytics(directory, file_format=None, full=False):
+    """
+    Writes (user_id, date, rating, notes_length) for every entry to
+    directory/month=YYYY-MM partitions, as Parquet when pyarrow is
+    installed or one .npy file per column otherwise. Only months whose
+    entries changed since the last run are rewritten. Returns the lists
+    of months written and removed.
+    """
+    file_format = file_format or ('parquet' if pyarrow else 'npy')
+    if file_format == 'parquet' and pyarrow is None:
+        raise ValueError('Parquet output needs the pyarrow package')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    state_path = os.path.join(directory, STATE_FILE)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    previous = state.get('months', {})
+    if full or state.get('format') != file_format:
+        state = {'format': file_format, 'months': {}}
+
+    fingerprints = month_fingerprints()
+    changed = sorted(key for key, fingerprint in fingerprints.items()
+                     if state['months'].get(key) != fingerprint)
+    removed = sorted(set(previous) - set(fingerprints))
+
+    written = []
+    for key, columns in iter_months(changed):
+        write_partition(directory, key, columns, file_format)
+        state['months'][key] = fingerprints[key]
+        written.append(key)
+    # Months whose entries all went away between the two queries
+    for key in set(changed) - set(written):
+        remove_partition(directory, key)
+        state['months'].pop(key, None)
+    for key in removed:
+        remove_partition(directory, key)
+        state['months'].pop(key, None)
+
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(state_path + '.tmp', state_path)
+    return written, removed
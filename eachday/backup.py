@@ -0,0 +1,431 @@
+import collections
+import gzip
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from datetime import date, datetime
+import six
+
+from eachday import app, db
+
+BACKUP_FORMAT = 'eachday-backup'
+BACKUP_VERSION = 1
+MANIFEST = 'manifest.json'
+# Tables in load order: entries and refresh tokens reference their user.
+# Without refresh tokens, a restore would sign every user out.
+BACKUP_TABLES = ('user', 'entry', 'blacklist_token', 'refresh_token')
+# Column each table's chunks are split on
+CHUNK_COLUMNS = {'user': 'id', 'entry': 'user_id', 'blacklist_token': 'id',
+                 'refresh_token': 'id'}
+# Ids per chunk file (user ids for user and entry)
+BACKUP_CHUNK_IDS = 10000
+# Rows read, or inserted without COPY, per round trip
+BATCH_ROWS = 1000
+
+
+class BackupError(Exception):
+    pass
+
+
+def encode_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def decode_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, db.DateTime):
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f'
+                                 if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if isinstance(column.type, db.Date):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+class HashingFile(object):
+    """ Wraps a binary file, keeping a SHA-256 of what passes through """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+    def flush(self):
+        self.f.flush()
+
+
+class IterFile(object):
+    """ A read-only file over an iterator of strings, for COPY FROM """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.offset = 0
+        # The driver reports failures in read() as its own error
+        self.error = None
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset == len(self.buffer):
+                try:
+                    self.buffer, self.offset = next(self.chunks), 0
+                except StopIteration:
+                    break
+                except Exception as e:
+                    self.error = e
+                    raise
+            end = len(self.buffer) if size < 0 else self.offset + size
+            part = self.buffer[self.offset:end]
+            self.offset += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    readline = read
+
+
+def id_ranges(low, high, size):
+    """ Splits ids low..high into inclusive (first, last) ranges """
+    if low is None:
+        return []
+    return [(first, min(first + size - 1, high))
+            for first in range(low, high + 1, size)]
+
+
+def chunk_file(table_name, first_id):
+    return '{}-{:010d}.jsonl.gz'.format(table_name, first_id)
+
+
+def begin_snapshot(connection, snapshot=None):
+    """
+    Starts a repeatable read transaction on Postgres, importing an
+    exported snapshot so that every worker sees the same data
+    """
+    transaction = connection.begin()
+    if connection.dialect.name == 'postgresql':
+        connection.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        if snapshot is not None:
+            connection.execute("SET TRANSACTION SNAPSHOT '{}'"
+                               .format(snapshot))
+    return transaction
+
+
+def write_chunk(connection, directory, table_name, first_id, last_id):
+    """
+    Streams one id range of a table into a gzipped JSON lines file, a
+    JSON array per row. The file is only given its name once complete.
+    """
+    table = db.metadata.tables[table_name]
+    column = table.c[CHUNK_COLUMNS[table_name]]
+    query = (table.select()
+             .where(column.between(first_id, last_id))
+             .order_by(column, table.c.id))
+    result = (connection.execution_options(stream_results=True)
+              .execute(query))
+    name = chunk_file(table_name, first_id)
+    path = os.path.join(directory, name)
+    rows = 0
+    with open(path + '.tmp', 'wb') as f:
+        hashing = HashingFile(f)
+        with gzip.GzipFile(filename='', mode='wb', fileobj=hashing,
+                           mtime=0) as out:
+            while True:
+                batch = result.fetchmany(BATCH_ROWS)
+                if not batch:
+                    break
+                out.write(''.join(
+                    json.dumps([encode_value(v) for v in row]) + '\n'
+                    for row in batch
+                ).encode('utf-8'))
+                rows += len(batch)
+    os.rename(path + '.tmp', path)
+    return {'table': table_name, 'file': name, 'first_id': first_id,
+            'last_id': last_id, 'rows': rows,
+            'sha256': hashing.sha256.hexdigest()}
+
+
+def backup_task(args):
+    directory, table_name, first_id, last_id, snapshot = args
+    with db.engine.connect() as connection:
+        transaction = begin_snapshot(connection, snapshot)
+        try:
+            return write_chunk(connection, directory, table_name,
+                               first_id, last_id)
+        finally:
+            transaction.rollback()
+
+
+def backup_tasks(connection, directory, chunk_ids, snapshot):
+    for table_name in BACKUP_TABLES:
+        table = db.metadata.tables[table_name]
+        # Entries are split on the same user id ranges as users
+        ids = (table.c.id if table_name != 'entry'
+               else db.metadata.tables['user'].c.id)
+        low, high = connection.execute(
+            db.select([db.func.min(ids), db.func.max(ids)])
+        ).first()
+        for first_id, last_id in id_ranges(low, high, chunk_ids):
+            yield (directory, table_name, first_id, last_id, snapshot)
+
+
+def init_worker():
+    app.app_context().push()
+
+
+def run_tasks(function, tasks, pool, progress):
+    """
+    Runs tasks in this process, or in a pool of worker processes, and
+    returns their results in the order they finish
+    """
+    if pool is None:
+        results = six.moves.map(function, tasks)
+    else:
+        results = pool.imap_unordered(function, tasks)
+    done = []
+    for result in results:
+        done.append(result)
+        if progress is not None:
+            progress(result)
+    return done
+
+
+def start_pool(workers):
+    if workers <= 1:
+        return None
+    # Forked workers must not share the parent's connections
+    db.session.remove()
+    db.engine.dispose()
+    return multiprocessing.Pool(workers, initializer=init_worker)
+
+
+def stop_pool(pool, failed):
+    if pool is None:
+        return
+    if failed:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+
+def backup(directory, workers=1, chunk_ids=BACKUP_CHUNK_IDS, progress=None):
+    """
+    Writes users, entries, blacklisted and refresh tokens to a directory of
+    checksummed chunk files, one per id range, and a manifest that is
+    written last. Chunks are written by a pool of worker processes that
+    share one Postgres snapshot, so the backup is consistent. Returns the
+    manifest.
+    """
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        raise BackupError('{} already holds a backup'.format(directory))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    started = time.time()
+    pool = start_pool(workers)
+    failed = True
+    try:
+        with db.engine.connect() as connection:
+            transaction = begin_snapshot(connection)
+            try:
+                snapshot = None
+                if pool is not None and \
+                        connection.dialect.name == 'postgresql':
+                    snapshot = connection.execute(
+                        'SELECT pg_export_snapshot()').scalar()
+                tasks = list(backup_tasks(connection, directory, chunk_ids,
+                                          snapshot))
+                if pool is None:
+                    # Read through this connection's transaction instead
+                    chunks = run_tasks(
+                        lambda task: write_chunk(connection, *task[:4]),
+                        tasks, None, progress)
+                else:
+                    chunks = run_tasks(backup_task, tasks, pool, progress)
+            finally:
+                transaction.rollback()
+        failed = False
+    finally:
+        stop_pool(pool, failed)
+
+    order = dict((name, i) for i, name in enumerate(BACKUP_TABLES))
+    manifest = {
+        'format': BACKUP_FORMAT,
+        'version': BACKUP_VERSION,
+        'created_at': datetime.utcnow().isoformat(),
+        'seconds': round(time.time() - started, 3),
+        'tables': dict((name, [c.name for c in
+                               db.metadata.tables[name].columns])
+                       for name in BACKUP_TABLES),
+        'chunks': sorted(chunks, key=lambda c: (order[c['table']],
+                                                c['first_id'])),
+    }
+    with open(os.path.join(directory, MANIFEST + '.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(os.path.join(directory, MANIFEST + '.tmp'),
+              os.path.join(directory, MANIFEST))
+    return manifest
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise BackupError('No readable backup in {}: {}'.format(directory, e))
+    if manifest.get('format') != BACKUP_FORMAT or \
+            manifest.get('version') != BACKUP_VERSION:
+        raise BackupError('Unsupported backup format in {}'.format(directory))
+    for name, columns in manifest['tables'].items():
+        missing = set(columns) - set(db.metadata.tables[name].c.keys())
+        if missing:
+            raise BackupError('Backup has unknown {} columns: {}'.format(
+                name, ', '.join(sorted(missing))))
+    return manifest
+
+
+def read_chunk(directory, chunk):
+    """
+    Yields the rows of a chunk file as they were encoded, then fails if
+    the file doesn't match its checksum
+    """
+    with open(os.path.join(directory, chunk['file']), 'rb') as f:
+        hashing = HashingFile(f)
+        with gzip.GzipFile(fileobj=hashing, mode='rb') as lines:
+            for line in lines:
+                yield json.loads(line.decode('utf-8'))
+        while hashing.read(1 << 16):
+            pass
+    if hashing.sha256.hexdigest() != chunk['sha256']:
+        raise BackupError('Checksum mismatch in {}'.format(chunk['file']))
+
+
+def csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, six.integer_types + (float,)):
+        return str(value)
+    return '"{}"'.format(six.text_type(value).replace('"', '""'))
+
+
+def csv_blocks(rows):
+    """ Encodes rows as CSV for COPY, where only NULLs are left unquoted """
+    while True:
+        block = [','.join(csv_field(v) for v in row) + '\n'
+                 for row in itertools.islice(rows, BATCH_ROWS)]
+        if not block:
+            return
+        yield ''.join(block)
+
+
+def copy_rows(connection, table, columns, rows):
+    """
+    Bulk loads encoded rows through COPY on Postgres, which parses the
+    values itself, or batched INSERTs
+    """
+    if connection.dialect.name == 'postgresql':
+        preparer = connection.dialect.identifier_preparer
+        statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            preparer.format_table(table),
+            ', '.join(preparer.quote(c.name) for c in columns))
+        source = IterFile(csv_blocks(iter(rows)))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(statement, source)
+        except Exception:
+            if source.error is not None:
+                raise source.error
+            raise
+        finally:
+            cursor.close()
+        return
+    names = [c.name for c in columns]
+    batch = []
+    for row in rows:
+        batch.append(dict((name, decode_value(column, value)) for
+                          name, column, value in zip(names, columns, row)))
+        if len(batch) == BATCH_ROWS:
+            connection.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+
+
+def restore_task(args):
+    """ Loads one chunk in its own transaction """
+    directory, chunk, names = args
+    table = db.metadata.tables[chunk['table']]
+    columns = [table.c[name] for name in names]
+    with db.engine.connect() as connection:
+        with connection.begin():
+            copy_rows(connection, table, columns,
+                      read_chunk(directory, chunk))
+    return chunk
+
+
+def reset_sequences(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    preparer = connection.dialect.identifier_preparer
+    for name in BACKUP_TABLES:
+        table = preparer.format_table(db.metadata.tables[name])
+        connection.execute(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "coalesce(max(id), 0) + 1, false) FROM {0}".format(table))
+        connection.execute('ANALYZE {}'.format(table))
+
+
+def restore(directory, workers=1, progress=None):
+    """
+    Loads a backup into empty tables. Secondary indexes are dropped while
+    chunks are loaded concurrently (users first, as entries reference
+    them) and rebuilt at the end. Unique constraints stay, so a damaged
+    backup can't restore duplicates. Returns the rows restored per table.
+    """
+    manifest = read_manifest(directory)
+    tables = [db.metadata.tables[name] for name in BACKUP_TABLES]
+    with db.engine.connect() as connection:
+        for table in tables:
+            if connection.execute(table.select().limit(1)).first():
+                raise BackupError('{} is not empty; restore needs empty '
+                                  'tables'.format(table.name))
+        if connection.dialect.name == 'sqlite':
+            # SQLite has a single writer
+            workers = 1
+
+    indexes = [index for table in tables for index in table.indexes
+               if not index.unique]
+    for index in indexes:
+        index.drop(db.engine)
+    counts = collections.Counter(dict.fromkeys(BACKUP_TABLES, 0))
+    pool = start_pool(workers)
+    failed = True
+    try:
+        for name in BACKUP_TABLES:
+            tasks = [(directory, chunk, manifest['tables'][name])
+                     for chunk in manifest['chunks']
+                     if chunk['table'] == name]
+            for chunk in run_tasks(restore_task, tasks, pool, progress):
+                counts[name] += chunk['rows']
+        failed = False
+    finally:
+        stop_pool(pool, failed)
+        for index in indexes:
+            index.create(db.engine)
+    with db.engine.begin() as connection:
+        reset_sequences(connection)
+    return counts
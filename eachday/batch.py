@@ -0,0 +1,136 @@
+import json
+import six
+from multiprocessing.pool import ThreadPool
+from flask import current_app, g, request
+from .concurrency import Overloaded, SHED_ERROR, held_slot
+
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+# Set on g by validate_auth, and handed to sub-requests so they skip
+# decoding and blacklist checks for the token the batch already checked
+AUTH_ATTRIBUTES = ('auth_token', 'auth_claims', 'user_id', 'batch_token')
+
+# Set in the environ of sub-requests. They share the batch's app context
+# and g, so per-request teardown must leave them alone.
+SUB_REQUEST_KEY = 'eachday.batch_sub_request'
+
+# Sub-requests are read to the end before the batch responds, so streams
+# that never end can't be batched. The batch is authorized once, so a
+# logout would leave the sub-requests after it running as the old token.
+UNBATCHABLE_PATHS = ('/entry/stream', '/logout')
+
+
+def validate_calls(calls):
+    """
+    Checks a batch's sub-requests
+    :return: an error message, or None if the calls are valid
+    """
+    if not isinstance(calls, list) or not calls:
+        return 'Expected a list of requests'
+    limit = current_app.config['BATCH_MAX_REQUESTS']
+    if len(calls) > limit:
+        return 'A batch can contain at most {} requests'.format(limit)
+    for call in calls:
+        if not isinstance(call, dict):
+            return 'Each request must be an object'
+        path = call.get('path')
+        if (not isinstance(path, six.string_types) or
+                not path.startswith('/')):
+            return 'Each request needs a path starting with /'
+        path = path.split('?', 1)[0].rstrip('/')
+        if path == request.path.rstrip('/'):
+            return 'Batches cannot be nested'
+        if path in UNBATCHABLE_PATHS:
+            return 'Cannot batch {}'.format(path)
+        method = call.get('method', 'GET')
+        if (not isinstance(method, six.string_types) or
+                method.upper() not in BATCH_METHODS):
+            return 'Unsupported method: {}'.format(method)
+    return None
+
+
+def run_call(app, call, environ, auth):
+    """
+    Dispatches one sub-request in-process and returns its status and body.
+    Skips the before and after request hooks, so the batch's own query
+    stats cover every sub-request. Each sub-request takes a slot in the
+    concurrency limit of its own endpoint class.
+    """
+    method = call.get('method', 'GET').upper()
+    try:
+        with held_slot(app, method, call['path'].split('?', 1)[0]) as done:
+            result = dispatch_call(app, call, method, environ, auth)
+            done(result['status'])
+            return result
+    except Overloaded:
+        return {'status': 503,
+                'body': {'status': 'error', 'error': SHED_ERROR}}
+
+
+def dispatch_call(app, call, method, environ, auth):
+    body = call.get('body')
+    context = app.test_request_context(
+        call['path'],
+        method=method,
+        data=json.dumps(body) if body is not None else None,
+        content_type='application/json',
+        **environ
+    )
+    with context:
+        for name, value in auth.items():
+            setattr(g, name, value)
+        try:
+            response = app.make_response(app.dispatch_request())
+        except Exception as e:
+            response = app.make_response(app.handle_user_exception(e))
+
+        # File responses (e.g. export artifacts) are read in full here
+        response.direct_passthrough = False
+        try:
+            if response.mimetype == 'application/json':
+                data = json.loads(response.get_data(as_text=True))
+            else:
+                data = response.get_data(as_text=True)
+        finally:
+            response.close()
+    return {'status': response.status_code, 'body': data}
+
+
+def run_concurrently(app, call, environ, auth):
+    """ run_call for a pool thread, which has no app context of its own """
+    with app.app_context():
+        return run_call(app, call, environ, auth)
+
+
+def get_pool():
+    pools = current_app.extensions.setdefault('batch', {})
+    if 'pool' not in pools:
+        pools['pool'] = ThreadPool(current_app.config['BATCH_MAX_WORKERS'])
+    return pools['pool']
+
+
+def run_batch(calls, parallel=False):
+    """
+    Runs sub-requests with the current request's credentials, in order.
+    With parallel set, and only GETs in the batch, they run concurrently
+    on their own database sessions.
+    """
+    app = current_app._get_current_object()
+    environ = {
+        'headers': {'Authorization': request.headers.get('Authorization')},
+        'environ_base': {'REMOTE_ADDR': request.remote_addr,
+                         SUB_REQUEST_KEY: True},
+    }
+    g.batch_token = g.get('auth_token')
+    auth = dict((name, g.get(name)) for name in AUTH_ATTRIBUTES)
+
+    try:
+        if parallel and all(call.get('method', 'GET').upper() == 'GET'
+                            for call in calls):
+            return get_pool().map(
+                lambda call: run_concurrently(app, call, environ, auth),
+                calls
+            )
+        return [run_call(app, call, environ, auth) for call in calls]
+    finally:
+        g.batch_token = None
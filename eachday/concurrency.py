@@ -0,0 +1,279 @@
+import hmac
+import json
+import threading
+import time
+from contextlib import contextmanager
+from werkzeug.wsgi import ClosingIterator
+
+# Endpoint classes, most important first. While a class is shedding
+# requests, the classes after it are held to their minimum limit, so
+# cheap reads keep their share of the database pool and CPU ahead of
+# bcrypt and exports.
+CLASS_PRIORITY = ('reads', 'writes', 'auth', 'export')
+# How long shedding in a class counts as pressure on the classes after it
+PRESSURE_SECONDS = 1.0
+AUTH_PATHS = ('/login', '/register')
+# Long-lived streams that mostly wait, where limiting would only starve
+# their clients, and batches, whose sub-requests each take a slot in
+# their own class (see held_slot)
+UNLIMITED_PATHS = ('/entry/stream', '/batch')
+
+SHED_ERROR = 'Service temporarily unavailable.'
+SHED_BODY = json.dumps({'status': 'error', 'error': SHED_ERROR})
+FORBIDDEN_BODY = json.dumps({'status': 'error', 'error': 'Forbidden'})
+
+
+class Overloaded(Exception):
+    pass
+
+
+def endpoint_class(method, path):
+    """ Returns the limit class of a request, or None for no limit """
+    if path in UNLIMITED_PATHS:
+        return None
+    if path in AUTH_PATHS or (path == '/user' and method == 'PUT'):
+        # Both check a password with bcrypt
+        return 'auth'
+    if path == '/export' or path.startswith('/export/'):
+        return 'export'
+    if method in ('GET', 'HEAD', 'OPTIONS'):
+        return 'reads'
+    return 'writes'
+
+
+class AIMDLimit(object):
+    """
+    An additive increase, multiplicative decrease concurrency limit. Each
+    request that is slower than the target latency, or that failed with a
+    503, cuts the limit by the backoff ratio. Each fast request grows it
+    by one, as long as at least half the limit was in use.
+    """
+
+    def __init__(self, name, initial, minimum, maximum, target, backoff):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.backoff = backoff
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.last_shed = 0
+        self.admitted = self.shed = 0
+        self.increases = self.decreases = 0
+
+    def acquire(self, cap=None):
+        with self.lock:
+            limit = self.limit if cap is None else min(self.limit, cap)
+            if self.inflight >= int(limit):
+                self.shed += 1
+                self.last_shed = time.time()
+                return False
+            self.inflight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def sample(self, latency, dropped):
+        with self.lock:
+            if dropped or latency > self.target:
+                limit = max(self.minimum, self.limit * self.backoff)
+                if limit < self.limit:
+                    self.decreases += 1
+            elif self.inflight * 2 >= self.limit:
+                limit = min(self.maximum, self.limit + 1)
+                if limit > self.limit:
+                    self.increases += 1
+            else:
+                return
+            self.limit = limit
+
+
+class Limits(object):
+    """ The limits of every endpoint class in this process """
+
+    def __init__(self, config):
+        self.classes = dict(
+            (name, AIMDLimit(name, initial, minimum, maximum,
+                             target_ms / 1000.0,
+                             config['CONCURRENCY_BACKOFF']))
+            for name, (initial, minimum, maximum, target_ms)
+            in config['CONCURRENCY_LIMITS'].items()
+        )
+
+    def cap(self, name):
+        """
+        Returns the minimum limit of a class while a more important class
+        is shedding, else None
+        """
+        now = time.time()
+        for other in CLASS_PRIORITY[:CLASS_PRIORITY.index(name)]:
+            limit = self.classes.get(other)
+            if limit is not None and now - limit.last_shed < PRESSURE_SECONDS:
+                return self.classes[name].minimum
+        return None
+
+    def metrics(self):
+        """ Returns the limits and decisions in Prometheus text format """
+        families = [
+            ('eachday_concurrency_limit', 'gauge',
+             'Current adaptive concurrency limit',
+             lambda l: [('', l.limit)]),
+            ('eachday_concurrency_inflight', 'gauge',
+             'Requests in progress',
+             lambda l: [('', l.inflight)]),
+            ('eachday_concurrency_requests_total', 'counter',
+             'Requests admitted or shed by the limiter',
+             lambda l: [(',decision="admitted"', l.admitted),
+                        (',decision="shed"', l.shed)]),
+            ('eachday_concurrency_limit_changes_total', 'counter',
+             'Times the limit was raised or lowered',
+             lambda l: [(',direction="increase"', l.increases),
+                        (',direction="decrease"', l.decreases)]),
+        ]
+        lines = []
+        for metric, kind, description, values in families:
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for name in CLASS_PRIORITY:
+                limit = self.classes.get(name)
+                if limit is None:
+                    continue
+                with limit.lock:
+                    samples = values(limit)
+                for labels, value in samples:
+                    lines.append('{}{{class="{}"{}}} {:g}'.format(
+                        metric, name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def get_limits(app):
+    """ Returns the app's limits, rebuilt whenever their settings change """
+    settings = (repr(sorted(app.config['CONCURRENCY_LIMITS'].items())),
+                app.config['CONCURRENCY_BACKOFF'])
+    cached = app.extensions.get('concurrency')
+    if cached is None or cached[0] != settings:
+        cached = app.extensions['concurrency'] = (
+            settings, Limits(app.config)
+        )
+    return cached[1]
+
+
+@contextmanager
+def held_slot(app, method, path):
+    """
+    Holds a slot in the limit of a request dispatched within the app, such
+    as a /batch sub-request, which the middleware never sees. Yields a
+    function to call with the response's status code.
+    :raises Overloaded: if the request's class is at its limit
+    """
+    limit = None
+    if app.config.get('CONCURRENCY_LIMIT_ENABLED'):
+        name = endpoint_class(method, path)
+        limits = get_limits(app)
+        limit = limits.classes.get(name)
+    if limit is None:
+        yield lambda status: None
+        return
+    if not limit.acquire(limits.cap(name)):
+        raise Overloaded()
+    started = time.time()
+    try:
+        yield lambda status: limit.sample(time.time() - started,
+                                          status == 503)
+    finally:
+        limit.release()
+
+
+def metrics_allowed(config, environ):
+    """
+    Checks the client's address against CONCURRENCY_METRICS_ALLOWED_IPS,
+    or its bearer token against CONCURRENCY_METRICS_TOKEN
+    """
+    allowed = config['CONCURRENCY_METRICS_ALLOWED_IPS']
+    if environ.get('REMOTE_ADDR') in allowed:
+        return True
+    token = config.get('CONCURRENCY_METRICS_TOKEN')
+    authorization = environ.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(
+        authorization.encode('utf-8'), ('Bearer ' + token).encode('utf-8')
+    )
+
+
+class ConcurrencyLimitMiddleware(object):
+    """
+    Sheds requests over their endpoint class's adaptive concurrency limit
+    with a 503 and Retry-After, before they reach Flask, the connection
+    pool or bcrypt. Latency is measured to the start of the response, and
+    a request holds its slot until its body has been sent. Limits and
+    metrics are per process.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        config = self.app.config
+        if not config.get('CONCURRENCY_LIMIT_ENABLED'):
+            return self.wsgi_app(environ, start_response)
+        path = environ.get('PATH_INFO', '')
+        if path == config.get('CONCURRENCY_METRICS_PATH'):
+            if not metrics_allowed(config, environ):
+                return self.send_json(start_response, '403 FORBIDDEN',
+                                      FORBIDDEN_BODY)
+            return self.send_metrics(start_response)
+        name = endpoint_class(environ.get('REQUEST_METHOD'), path)
+        limits = get_limits(self.app)
+        limit = limits.classes.get(name)
+        if limit is None:
+            return self.wsgi_app(environ, start_response)
+
+        if not limit.acquire(limits.cap(name)):
+            return self.shed(start_response)
+        started = time.time()
+        sampled = []
+
+        def start_limited_response(status, headers, exc_info=None):
+            if not sampled:
+                sampled.append(True)
+                limit.sample(time.time() - started,
+                             status.startswith('503'))
+            return start_response(status, headers, exc_info)
+
+        try:
+            app_iter = self.wsgi_app(environ, start_limited_response)
+        except BaseException:
+            limit.release()
+            raise
+        return ClosingIterator(app_iter, [limit.release])
+
+    def shed(self, start_response):
+        retry_after = str(self.app.config['CONCURRENCY_RETRY_AFTER'])
+        return self.send_json(start_response, '503 SERVICE UNAVAILABLE',
+                              SHED_BODY, [('Retry-After', retry_after)])
+
+    def send_json(self, start_response, status, body, headers=()):
+        body = body.encode('utf-8')
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            # The CORS headers Flask would have added
+            ('Access-Control-Allow-Origin', '*'),
+        ] + list(headers))
+        return [body]
+
+    def send_metrics(self, start_response):
+        body = get_limits(self.app).metrics().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+def register_concurrency_limits(app):
+    app.wsgi_app = ConcurrencyLimitMiddleware(app, app.wsgi_app)
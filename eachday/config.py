@@ -1,18 +1,165 @@
 import os
 import logging
+import tempfile
 basedir = os.path.abspath(os.path.dirname(__file__))
 postgres_local_base = 'postgresql://postgres:@localhost/'
 database_name = 'eachday'
 
 
+def env_flag(name):
+    """ Reads an on/off setting, so that e.g. 'false' or '0' means off """
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
 class BaseConfig:
     """Base configuration."""
     SECRET_KEY = os.getenv('SECRET_KEY', 'changeme')
     DEBUG = False
     BCRYPT_LOG_ROUNDS = 13
+    # Access tokens are short-lived; clients renew them without a password
+    # (or bcrypt) through POST /token/refresh with a rotating refresh token
+    ACCESS_TOKEN_MINUTES = 15
+    REFRESH_TOKEN_DAYS = 30
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_POOL_SIZE = 5
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_RECYCLE = 1800
+    # Seconds to wait for a pooled connection before answering with a 503
+    SQLALCHEMY_POOL_TIMEOUT = 5
+    # Check connections with a cheap SELECT as they leave the pool
+    SQLALCHEMY_POOL_PRE_PING = True
+    DATABASE_CONNECT_TIMEOUT = 10
+    # Milliseconds, applied with SET LOCAL to every transaction
+    DATABASE_STATEMENT_TIMEOUT = 30000
+    # Connect through PgBouncer in transaction pooling mode: no local pool
+    # and no session-level server state
+    DATABASE_PGBOUNCER = False
+    # Applied to every new connection when running on SQLite
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'foreign_keys': 'ON',
+        'busy_timeout': 5000,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+    }
+    # Set SQLALCHEMY_BINDS = {'replica': <uri>} to serve read-only views
+    # from a replica. Users stay on the primary this long after a write,
+    # as recorded in the RATELIMIT_STORAGE_URL store.
+    REPLICA_STICKY_SECONDS = 5
+    # How long the shared store keeps a user's profile version, which lets
+    # GET /user answer from the token's claims while they are current
+    PROFILE_VERSION_TTL = 60
+    # GET /entry/changes: deletions older than this need a full resync, and
+    # each sync re-sends changes from this many seconds before its cursor
+    SYNC_TOMBSTONE_DAYS = 30
+    SYNC_CURSOR_OVERLAP = 5
+    # Where the export worker (manage.py export_worker) writes artifacts,
+    # and how long a running job may go without finishing before another
+    # worker takes it over
+    EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(tempfile.gettempdir(),
+                                                      'eachday-exports'))
+    EXPORT_JOB_TIMEOUT = 600
+    # On Postgres, have GET /export stream the CSV produced by COPY
+    # instead of building it in Python
+    EXPORT_COPY = True
+    # Token buckets for /login and /register, as (burst, seconds to refill
+    # it). Use shm:///path or redis://... to share them between workers;
+    # the store also shares recent writes and profile versions, so use
+    # redis:// when running on more than one host.
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORAGE_URL = 'memory://'
+    RATELIMIT_PER_IP = (20, 60)
+    RATELIMIT_PER_EMAIL = (5, 60)
+    # Reverse proxies in front of the app that append to X-Forwarded-For.
+    # Per-IP buckets are keyed on the address the outermost one saw;
+    # leave at 0 when clients connect directly, or they could pick their
+    # own address.
+    RATELIMIT_TRUSTED_PROXIES = int(os.getenv('RATELIMIT_TRUSTED_PROXIES',
+                                              0))
+    # Adaptive concurrency limits per endpoint class, as (initial, minimum,
+    # maximum, target latency in ms). Requests over their class's limit
+    # get a 503 with Retry-After; reads are favoured over writes, then auth
+    # and exports (see concurrency.py). Decisions are exported in
+    # Prometheus text format at CONCURRENCY_METRICS_PATH, to requests
+    # bearing METRICS_TOKEN or from the comma separated addresses in
+    # METRICS_ALLOWED_IPS. With neither set, the endpoint is closed. Only
+    # list addresses that connect directly: behind a reverse proxy, every
+    # request comes from the proxy's address.
+    CONCURRENCY_LIMIT_ENABLED = True
+    CONCURRENCY_LIMITS = {
+        'reads': (20, 4, 200, 100),
+        'writes': (10, 2, 100, 250),
+        'auth': (4, 1, 20, 1000),
+        'export': (2, 1, 10, 2000),
+    }
+    CONCURRENCY_BACKOFF = 0.9
+    CONCURRENCY_RETRY_AFTER = 1
+    CONCURRENCY_METRICS_PATH = '/metrics'
+    CONCURRENCY_METRICS_ALLOWED_IPS = tuple(
+        address.strip()
+        for address in os.getenv('METRICS_ALLOWED_IPS', '').split(',')
+        if address.strip()
+    )
+    CONCURRENCY_METRICS_TOKEN = os.getenv('METRICS_TOKEN')
     LOGGER_NAME = 'eachday'
     LOG_LEVEL = logging.INFO
+    # 'text' or 'json' (one JSON object per line)
+    LOG_FORMAT = 'text'
+    # Write log records from a background thread instead of the request
+    LOG_ASYNC = True
+    # Records beyond this many pending ones are dropped instead of blocking
+    LOG_QUEUE_SIZE = 10000
+    # Queries slower than this many seconds are logged (None disables)
+    SLOW_QUERY_THRESHOLD = 0.5
+    # Also log the EXPLAIN plan for slow SELECT queries
+    SLOW_QUERY_EXPLAIN = False
+    # Warn when a single request runs more than this many queries
+    QUERY_BUDGET = 10
+    # Profile requests that carry a signed X-Profile header (see
+    # `manage.py profile_header`), or a random PROFILE_SAMPLE_RATE of them,
+    # writing flamegraph.pl-style CPU and allocation stacks to PROFILE_DIR
+    PROFILE_ENABLED = env_flag('PROFILE_ENABLED')
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_SIGNATURE_MAX_AGE = 300
+    PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(),
+                                                        'eachday-profiles'))
+    PROFILE_INTERVAL = 0.005
+    PROFILE_ALLOC_FRAMES = 32
+    # Serve the frontend build (e.g. public/, after `yarn build` and
+    # `manage.py compress_static`) from the API app; unset to serve it
+    # elsewhere
+    STATIC_DIR = os.getenv('STATIC_DIR')
+    # Hash partitions created by the entry partitioning migration
+    ENTRY_PARTITIONS = int(os.getenv('ENTRY_PARTITIONS', 16))
+    # POST /batch: sub-requests per batch, and threads for parallel batches
+    BATCH_MAX_REQUESTS = 20
+    BATCH_MAX_WORKERS = 4
+    # Record requests as nested spans (auth, SQL statements, schema dump and
+    # load, bcrypt, JSON encoding) for a TRACE_SAMPLE_RATE of them. The
+    # 'file' exporter appends JSON lines to TRACE_FILE (summarise them with
+    # `manage.py trace_report`); 'otlp' posts to an OTLP/HTTP collector
+    TRACING_ENABLED = env_flag('TRACING_ENABLED')
+    TRACE_SAMPLE_RATE = 1.0
+    TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'file')
+    TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(tempfile.gettempdir(),
+                                                      'eachday-spans.jsonl'))
+    TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT',
+                                    'http://localhost:4318/v1/traces')
+    TRACE_SERVICE_NAME = 'eachday'
+    # Export from a background thread, dropping traces beyond this many
+    TRACE_ASYNC = True
+    TRACE_QUEUE_SIZE = 1000
+    # Entry changes pushed to GET /entry/stream. 'notify' fans out through
+    # Postgres LISTEN/NOTIFY across processes; 'local' (and SQLite) only
+    # reaches streams in the writing process
+    EVENTS_ENABLED = True
+    EVENTS_BACKEND = os.getenv('EVENTS_BACKEND', 'notify')
+    EVENTS_CHANNEL = 'entry_events'
+    # Seconds between keepalive comments on idle streams
+    EVENTS_KEEPALIVE = 15
+    # Pending events per stream before a slow client is told to resync
+    EVENTS_QUEUE_SIZE = 100
 
 
 class DevelopmentConfig(BaseConfig):
@@ -22,6 +169,16 @@ class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = postgres_local_base + database_name
 
 
+class SQLiteConfig(BaseConfig):
+    """Single-node configuration backed by an SQLite file."""
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = os.getenv(
+        'DATABASE_URI',
+        'sqlite:///' + os.path.join(basedir, '..', database_name + '.db')
+    )
+    LOG_FORMAT = 'json'
+
+
 class TestingConfig(BaseConfig):
     """Testing configuration."""
     DEBUG = True
@@ -31,9 +188,25 @@ class TestingConfig(BaseConfig):
     SECRET_KEY = 'test_secret_key'
     PRESERVE_CONTEXT_ON_EXCEPTION = False
     LOG_LEVEL = logging.WARN
+    LOG_ASYNC = False
+    TRACE_ASYNC = False
+    SLOW_QUERY_THRESHOLD = None
+    # Keep these off so query budgets only count the app's own queries
+    SQLALCHEMY_POOL_PRE_PING = False
+    DATABASE_STATEMENT_TIMEOUT = None
+    RATELIMIT_ENABLED = False
+    CONCURRENCY_LIMIT_ENABLED = False
 
 
 class ProductionConfig(BaseConfig):
     """Production configuration."""
     DEBUG = False
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URI')
+    DATABASE_PGBOUNCER = env_flag('DATABASE_PGBOUNCER')
+    if os.getenv('DATABASE_REPLICA_URI'):
+        SQLALCHEMY_BINDS = {'replica': os.getenv('DATABASE_REPLICA_URI')}
+    LOG_FORMAT = 'json'
+    RATELIMIT_STORAGE_URL = os.getenv(
+        'RATELIMIT_STORAGE_URL',
+        'shm://' + os.path.join(tempfile.gettempdir(), 'eachday-ratelimit')
+    )
@@ -0,0 +1,219 @@
+import sqlite3
+import time
+import threading
+import flask_sqlalchemy
+from flask import current_app, g, has_app_context
+from flask_restful import wraps
+from sqlalchemy import event, exc, orm, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+from .ratelimit import get_store
+
+POOL_OPTIONS = ('pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow')
+
+
+REPLICA_BIND = 'replica'
+
+
+class RecentWrites(object):
+    """
+    Remembers which users wrote recently, so that their reads can stick to
+    the primary until the replica has caught up. Write times are kept in
+    the shared store (RATELIMIT_STORAGE_URL), so whichever worker serves
+    the next read sees them, and expire once the window has passed.
+    """
+
+    @staticmethod
+    def key(user_id):
+        return 'write:{}'.format(user_id)
+
+    def record(self, user_id):
+        window = current_app.config.get('REPLICA_STICKY_SECONDS', 0)
+        if window:
+            get_store().raise_value(self.key(user_id), time.time(), window)
+
+    def is_recent(self, user_id, window):
+        if user_id is None or not window:
+            return False
+        written = get_store().get_value(self.key(user_id))
+        return written is not None and time.time() - written < window
+
+
+recent_writes = RecentWrites()
+
+
+def replica_enabled():
+    return (has_app_context() and g.get('use_replica', False) and
+            REPLICA_BIND in (current_app.config.get('SQLALCHEMY_BINDS') or ()))
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """ Sends reads to the replica bind inside read_only views """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not replica_enabled():
+            return flask_sqlalchemy.SignallingSession.get_bind(
+                self, mapper, clause
+            )
+        state = flask_sqlalchemy.get_state(self.app)
+        return state.db.get_engine(self.app, bind=REPLICA_BIND)
+
+
+def read_only(func):
+    """
+    Runs a view's queries on the read replica (when one is configured),
+    unless the user wrote within the last REPLICA_STICKY_SECONDS
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        window = current_app.config.get('REPLICA_STICKY_SECONDS', 0)
+        g.use_replica = not recent_writes.is_recent(kwargs.get('user_id'),
+                                                    window)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.use_replica = False
+    return wrapped
+
+
+# SQLite allows a single writer at a time. Write views queue up on this
+# lock within a process, and BEGIN IMMEDIATE plus busy_timeout queue them
+# across processes, instead of failing with "database is locked".
+sqlite_write_lock = threading.Lock()
+
+
+def is_sqlite():
+    return current_app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite')
+
+
+def serialized_write(func):
+    """ Runs a write view as SQLite's only writer; a no-op elsewhere """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if not is_sqlite():
+            return func(*args, **kwargs)
+
+        session = flask_sqlalchemy.get_state(current_app).db.session
+        with sqlite_write_lock:
+            # End the read transaction opened by validate_auth, so the
+            # view's transaction can start as a write transaction
+            session.commit()
+            g.sqlite_write = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                g.sqlite_write = False
+    return wrapped
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """ Flask-SQLAlchemy with the app's connection and pooling settings """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        flask_sqlalchemy.SQLAlchemy.apply_driver_hacks(self, app, info,
+                                                       options)
+        if info.drivername == 'sqlite':
+            if 'poolclass' in options:
+                # In-memory databases get a StaticPool, which takes no
+                # sizing options
+                for option in POOL_OPTIONS:
+                    options.pop(option, None)
+            else:
+                # Keep connections (with their pragmas and page cache)
+                # pooled instead of reopening the file on every checkout
+                options['poolclass'] = QueuePool
+                options.setdefault('connect_args', {})
+                options['connect_args']['check_same_thread'] = False
+            return
+
+        if not info.drivername.startswith('postgresql'):
+            return
+
+        connect_timeout = app.config.get('DATABASE_CONNECT_TIMEOUT')
+        if connect_timeout:
+            options.setdefault('connect_args', {})
+            options['connect_args']['connect_timeout'] = connect_timeout
+
+        if app.config.get('DATABASE_PGBOUNCER'):
+            # PgBouncer already pools server connections, so holding our
+            # own pool on top of it only pins them to idle workers
+            for option in POOL_OPTIONS:
+                options.pop(option, None)
+            options['poolclass'] = NullPool
+
+
+def statement_timeout():
+    """ Returns the statement timeout (ms) for the current request """
+    if not has_app_context():
+        return None
+    return g.get('statement_timeout',
+                 current_app.config.get('DATABASE_STATEMENT_TIMEOUT'))
+
+
+def register_database_hooks(app, db):
+    @event.listens_for(Engine, 'connect')
+    def configure_sqlite(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        # Let SQLAlchemy emit BEGIN itself (see begin_sqlite), since
+        # pysqlite's own transaction handling breaks SAVEPOINTs
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in sorted(app.config['SQLITE_PRAGMAS'].items()):
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+        cursor.close()
+
+    @event.listens_for(Engine, 'begin')
+    def begin_sqlite(connection):
+        if connection.dialect.name != 'sqlite':
+            return
+        if has_app_context() and g.get('sqlite_write', False):
+            connection.execute('BEGIN IMMEDIATE')
+        else:
+            connection.execute('BEGIN')
+
+    @event.listens_for(Engine, 'engine_connect')
+    def ping_connection(connection, branch):
+        """ Pessimistically checks connections as they leave the pool """
+        if branch or not app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            return
+
+        should_close = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as e:
+            # The pool is invalidated along with the dead connection, so
+            # retrying once reconnects
+            if not e.connection_invalidated:
+                raise
+            connection.scalar(select([1]))
+        finally:
+            connection.should_close_with_result = should_close
+
+    @event.listens_for(db.session, 'after_begin')
+    def set_statement_timeout(session, transaction, connection):
+        # SET LOCAL only lasts until the end of the transaction, so it is
+        # safe with PgBouncer's transaction pooling
+        timeout = statement_timeout()
+        if timeout and connection.dialect.name == 'postgresql':
+            connection.execute('SET LOCAL statement_timeout = %d'
+                               % int(timeout))
+
+    @event.listens_for(db.session, 'after_flush')
+    def note_write(session, flush_context):
+        session.info['has_writes'] = True
+
+    @event.listens_for(db.session, 'after_commit')
+    def record_write(session):
+        if session.info.pop('has_writes', False) and has_app_context():
+            user_id = g.get('user_id')
+            if user_id is not None:
+                recent_writes.record(user_id)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def discard_write(session):
+        session.info.pop('has_writes', None)
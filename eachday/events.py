@@ -0,0 +1,223 @@
+import collections
+import json
+import os
+import select
+import threading
+import time
+from flask import current_app
+from six.moves import queue
+from sqlalchemy import event, func, sql
+from .models import Entry
+from .queries import entry_row_dict
+
+from eachday import db
+
+# NOTIFY payloads must be shorter than 8000 bytes; larger events are sent
+# without the entry, and clients fetch it instead
+MAX_PAYLOAD_BYTES = 7900
+
+
+def event_payload(user_id, kind, entry=None, entry_id=None):
+    payload = {'user_id': user_id, 'type': kind,
+               'id': entry['id'] if entry is not None else entry_id}
+    if entry is not None:
+        payload['entry'] = entry
+    encoded = json.dumps(payload, sort_keys=True)
+    if len(encoded.encode('utf-8')) > MAX_PAYLOAD_BYTES:
+        del payload['entry']
+        encoded = json.dumps(payload, sort_keys=True)
+    return encoded
+
+
+def publish_entry(user_id, kind, entry=None, entry_id=None):
+    """
+    Queues an entry event for the user's streams. It is sent when the
+    session commits, and dropped if the session rolls back.
+    """
+    if not current_app.config.get('EVENTS_ENABLED'):
+        return
+    if entry is not None and not isinstance(entry, dict):
+        entry = entry_row_dict(entry)
+    db.session.info.setdefault('events', []).append(
+        event_payload(user_id, kind, entry, entry_id)
+    )
+
+
+def uses_notify(config):
+    return (config.get('EVENTS_BACKEND') != 'local' and
+            config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'))
+
+
+class Subscription(object):
+    def __init__(self, user_id, size):
+        self.user_id = user_id
+        self.queue = queue.Queue(size)
+        # Set when events were dropped because the client fell behind
+        self.overflowed = False
+
+    def put(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            self.overflowed = True
+
+
+class EventBus(object):
+    """
+    Hands events to the streams open in this process. With Postgres, a
+    single LISTEN connection per process receives every worker's events;
+    otherwise events only reach streams in the publishing process.
+    """
+
+    def __init__(self, app, listen):
+        self.app = app
+        self.pid = os.getpid()
+        self.subscriptions = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        self.listener = None
+        if listen:
+            self.listener = threading.Thread(target=self._listen)
+            self.listener.daemon = True
+            self._stopped = threading.Event()
+            self._listening = threading.Event()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id,
+                                    self.app.config['EVENTS_QUEUE_SIZE'])
+        with self.lock:
+            self.subscriptions[user_id].add(subscription)
+            if self.listener is not None and not self.listener.is_alive():
+                self.listener.start()
+        if self.listener is not None:
+            # Events committed before LISTEN took effect would be missed
+            self._listening.wait(5)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions[subscription.user_id]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    def dispatch(self, payload):
+        user_id = json.loads(payload)['user_id']
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(payload)
+
+    def stop(self):
+        if self.listener is not None:
+            self._stopped.set()
+            if self.listener.is_alive():
+                self.listener.join()
+
+    def _connect(self):
+        with self.app.app_context():
+            raw = db.engine.raw_connection()
+        # Keep the LISTEN connection out of the pool for good
+        raw.detach()
+        connection = raw.connection
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute('LISTEN {}'.format(self.app.config['EVENTS_CHANNEL']))
+        cursor.close()
+        return connection
+
+    def _listen(self):
+        connection = None
+        while not self._stopped.is_set():
+            try:
+                if connection is None:
+                    connection = self._connect()
+                    self._listening.set()
+                if select.select([connection], [], [], 1)[0]:
+                    connection.poll()
+                    while connection.notifies:
+                        self.dispatch(connection.notifies.pop(0).payload)
+            except Exception:
+                self.app.logger.warning('Event listener failed; '
+                                        'reconnecting', exc_info=True)
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                connection = None
+                self._listening.clear()
+                time.sleep(1)
+        if connection is not None:
+            connection.close()
+
+
+def get_bus(app):
+    """
+    Returns this process's event bus, created after any fork or change
+    of backend
+    """
+    listen = uses_notify(app.config)
+    bus = app.extensions.get('events')
+    if (bus is None or bus.pid != os.getpid() or
+            (bus.listener is not None) != listen):
+        if bus is not None:
+            bus.stop()
+        bus = app.extensions['events'] = EventBus(app, listen)
+    return bus
+
+
+def format_event(payload):
+    data = json.loads(payload)
+    del data['user_id']
+    return 'event: {}\ndata: {}\n\n'.format(data['type'],
+                                            json.dumps(data, sort_keys=True))
+
+
+def stream_events(subscription, keepalive):
+    """
+    Yields server-sent events for a subscription until the client goes
+    away, with a comment line every keepalive seconds to hold the
+    connection open through proxies
+    """
+    yield 'retry: 5000\n\n'
+    while True:
+        try:
+            payload = subscription.queue.get(timeout=keepalive)
+        except queue.Empty:
+            yield ': keepalive\n\n'
+            continue
+        if subscription.overflowed:
+            # Events were dropped; the client should resync
+            subscription.overflowed = False
+            yield 'event: resync\ndata: {}\n\n'
+        yield format_event(payload)
+
+
+def register_event_hooks(app):
+    @event.listens_for(db.session, 'before_commit')
+    def send_events(session):
+        events = session.info.pop('events', None)
+        if not events:
+            return
+        if uses_notify(app.config):
+            # Delivered by Postgres when (and only if) the transaction
+            # commits
+            channel = app.config['EVENTS_CHANNEL']
+            for payload in events:
+                notify = sql.select([func.pg_notify(channel, payload)])
+                session.execute(notify, mapper=Entry.__mapper__)
+        else:
+            session.info['committed_events'] = events
+
+    @event.listens_for(db.session, 'after_commit')
+    def dispatch_local_events(session):
+        events = session.info.pop('committed_events', None)
+        if events:
+            bus = get_bus(app)
+            for payload in events:
+                bus.dispatch(payload)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def discard_events(session):
+        session.info.pop('events', None)
+        session.info.pop('committed_events', None)
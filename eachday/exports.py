@@ -0,0 +1,149 @@
+import csv
+import os
+import time
+import six
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func
+from .models import Entry, EntryTombstone, ExportJob, encode_sync_cursor
+from .log import log
+
+from eachday import db
+
+CSV_HEADER = ['Date', 'Rating', 'Notes']
+# Rows buffered per chunk when writing CSV
+CHUNK_ROWS = 1000
+# The same CSV written by Postgres (with \n rather than \r\n line endings)
+COPY_EXPORT = ('COPY (SELECT date AS "Date", rating AS "Rating", '
+               'notes AS "Notes" FROM entry WHERE user_id = %s '
+               'ORDER BY date) TO STDOUT WITH (FORMAT csv, HEADER)')
+
+
+def iter_csv(rows):
+    """ Yields CSV text for (date, rating, notes) rows, a chunk at a time """
+    buf = six.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_HEADER)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def uses_copy(connection):
+    return (connection.dialect.name == 'postgresql' and
+            current_app.config.get('EXPORT_COPY'))
+
+
+def copy_csv(connection, user_id, target):
+    """
+    Writes a user's entries to a binary file as CSV produced by Postgres'
+    COPY, without building rows in Python
+    """
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(cursor.mogrify(COPY_EXPORT, (user_id,)), target)
+    finally:
+        cursor.close()
+
+
+def export_rows(user_id):
+    return (db.session.query(Entry.date, Entry.rating, Entry.notes)
+            .filter(Entry.user_id == user_id)
+            .order_by(Entry.date))
+
+
+def data_version(user_id):
+    """
+    Identifies the current state of a user's entries. Any create, edit or
+    delete changes it, and it is computed from the (user_id, updated_at)
+    indexes without reading the entries themselves.
+    """
+    count, updated = (db.session.query(func.count(Entry.id),
+                                       func.max(Entry.updated_at))
+                      .filter(Entry.user_id == user_id)
+                      .one())
+    deleted = (db.session.query(func.max(EntryTombstone.deleted_at))
+               .filter(EntryTombstone.user_id == user_id)
+               .scalar())
+    return '{}-{}-{}'.format(count,
+                             encode_sync_cursor(updated) if updated else 0,
+                             encode_sync_cursor(deleted) if deleted else 0)
+
+
+def artifact_path(user_id, version):
+    return os.path.join(current_app.config['EXPORT_DIR'], str(user_id),
+                        version + '.csv')
+
+
+def write_artifact(user_id, version):
+    """
+    Writes the user's export, replacing any artifacts for older versions.
+    The file is renamed into place, so readers never see a partial one.
+    """
+    path = artifact_path(user_id, version)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter_csv(export_rows(user_id).yield_per(CHUNK_ROWS)):
+            f.write(chunk.encode('utf-8'))
+    os.rename(tmp_path, path)
+
+    for name in os.listdir(directory):
+        if name != os.path.basename(path) and name.endswith('.csv'):
+            os.remove(os.path.join(directory, name))
+    return path
+
+
+def claim_job():
+    """ Marks the oldest pending (or abandoned) job as running """
+    timeout = timedelta(seconds=current_app.config['EXPORT_JOB_TIMEOUT'])
+    abandoned = db.and_(ExportJob.status == ExportJob.RUNNING,
+                        ExportJob.started_at < datetime.utcnow() - timeout)
+    job = (ExportJob.query
+           .filter(db.or_(ExportJob.status == ExportJob.PENDING, abandoned))
+           .order_by(ExportJob.id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        db.session.rollback()
+        return None
+    job.status = ExportJob.RUNNING
+    job.started_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def process_job(job):
+    try:
+        version = data_version(job.user_id)
+        if not os.path.exists(artifact_path(job.user_id, version)):
+            log.info('Writing export %s for user %s', version, job.user_id)
+            write_artifact(job.user_id, version)
+        job.data_version = version
+        job.status = ExportJob.DONE
+    except Exception as e:
+        log.exception('Export job %s failed', job.id)
+        db.session.rollback()
+        job.status = ExportJob.FAILED
+        job.error = str(e)
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def run_worker(once=False, poll_interval=1.0):
+    """ Processes export jobs until interrupted (or the queue is empty) """
+    while True:
+        job = claim_job()
+        if job is not None:
+            process_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
@@ -1,4 +1,90 @@
+import atexit
+import json
+import logging
+from datetime import datetime
+from six.moves import queue
 from werkzeug.local import LocalProxy
-from flask import current_app
+from flask import current_app, g, has_app_context
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2 has no queue handlers; log synchronously
+    QueueHandler = QueueListener = None
 
 log = LocalProxy(lambda: current_app.logger)
+
+TEXT_LOG_FORMAT = ('[%(asctime)s] %(levelname)s in %(module)s '
+                   '[%(request_id)s]: %(message)s')
+
+
+class RequestIdFilter(logging.Filter):
+    """ Tags each record with the id of the request that logged it """
+
+    def filter(self, record):
+        request_id = g.get('request_id') if has_app_context() else None
+        record.request_id = request_id or '-'
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats each record as a single line JSON object """
+
+    def format(self, record):
+        payload = {
+            'timestamp': datetime.utcfromtimestamp(record.created)
+                                 .isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', '-') != '-':
+            payload['request_id'] = record.request_id
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+if QueueHandler is not None:
+    class LazyQueueHandler(QueueHandler):
+        """
+        Hands records to the writer thread without formatting them first,
+        and drops records rather than blocking when the queue is full.
+        """
+        dropped = 0
+
+        def prepare(self, record):
+            return record
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                LazyQueueHandler.dropped += 1
+
+
+def configure_logging(app):
+    """
+    Replaces Flask's default handlers with one that honours LOG_LEVEL,
+    LOG_FORMAT ('text' or 'json') and, when LOG_ASYNC is set, hands records
+    to a background writer thread so slow sinks don't block requests.
+    """
+    app.logger.setLevel(app.config.get('LOG_LEVEL', logging.INFO))
+
+    handler = logging.StreamHandler()
+    if app.config.get('LOG_FORMAT') == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+
+    if app.config.get('LOG_ASYNC') and QueueHandler is not None:
+        records = queue.Queue(app.config.get('LOG_QUEUE_SIZE', 10000))
+        listener = QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = LazyQueueHandler(records)
+
+    # Filtered before records are queued, while the request is still known
+    handler.addFilter(RequestIdFilter())
+    app.logger.handlers = [handler]
+    return handler
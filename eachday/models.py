@@ -1,20 +1,25 @@
 from sqlalchemy.orm import validates
 from sqlalchemy import UniqueConstraint
 from eachday import app, db, bcrypt
+from .database import replica_enabled
+from .ratelimit import get_store
+from .tracing import TracedSchema, traced
 from datetime import datetime, date, timedelta
 import jwt
 import marshmallow
-from marshmallow import Schema, fields, validate, ValidationError
+from marshmallow import fields, validate, ValidationError
 
 
 class User(db.Model):
     __tablename__ = 'user'
-    TOKEN_EXPIRATION_DAYS = 1
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     email = db.Column(db.String, unique=True, nullable=False)
     password = db.Column(db.String, nullable=False)
     name = db.Column(db.String, nullable=False)
     joined_on = db.Column(db.Date, nullable=False)
+    # Bumped whenever the profile fields embedded in auth tokens change
+    profile_version = db.Column(db.Integer, nullable=False, default=1,
+                                server_default='1')
 
     def set_password(self, password):
         self.password = bcrypt.generate_password_hash(
@@ -26,19 +31,30 @@ class User(db.Model):
         self.set_password(password)
         self.name = name
         self.joined_on = joined_on or date.today()
+        self.profile_version = 1
 
     def encode_auth_token(self, user_id):
         """
         Generates an Auth Token
         :return: string
         """
-        td = timedelta(days=User.TOKEN_EXPIRATION_DAYS)
+        return User.encode_token_for(self)
+
+    @staticmethod
+    def encode_token_for(user):
+        """
+        Generates an Auth Token for a user, or any row with the user's
+        id, profile_version and profile fields
+        :return: string
+        """
+        td = timedelta(minutes=app.config.get('ACCESS_TOKEN_MINUTES'))
         payload = {
             'exp': datetime.utcnow() + td,
             'iat': datetime.utcnow(),
-            'sub': self.id,
+            'sub': user.id,
+            'ver': user.profile_version,
         }
-        payload.update(UserSchema().dump(self).data)
+        payload.update(TOKEN_PROFILE_SCHEMA.dump(user).data)
         return jwt.encode(
             payload,
             app.config.get('SECRET_KEY'),
@@ -52,15 +68,38 @@ class User(db.Model):
         :param auth_token:
         :return: integer|string
         """
+        return User.decode_auth_claims(auth_token)['sub']
+
+    @staticmethod
+    @traced('User.decode_auth_claims')
+    def decode_auth_claims(auth_token):
+        """
+        Decodes and verifies the auth token
+        :param auth_token:
+        :return: dict
+        """
         try:
-            payload = jwt.decode(auth_token, app.config.get('SECRET_KEY'))
-            return payload['sub']
+            return jwt.decode(auth_token, app.config.get('SECRET_KEY'))
         except jwt.ExpiredSignatureError:
             raise Exception('Signature expired. Please log in again.')
         except jwt.InvalidTokenError:
             raise Exception('Invalid token. Please log in again.')
 
 
+def profile_from_claims(claims):
+    """
+    Returns the user's profile from verified token claims, or None if the
+    profile has changed since the token was issued
+    """
+    if claims.get('ver') is None:
+        return None
+    if profile_versions.get(claims['sub']) != claims['ver']:
+        return None
+    profile = dict((k, claims[k]) for k in TOKEN_PROFILE_FIELDS)
+    profile['id'] = claims['sub']
+    return profile
+
+
 class Entry(db.Model):
     __tablename__ = 'entry'
     id = db.Column(db.Integer, primary_key=True)
@@ -68,8 +107,87 @@ class Entry(db.Model):
     date = db.Column(db.Date, nullable=False)
     notes = db.Column(db.Text)
     rating = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'date'),
+        db.Index('ix_entry_user_id_updated_at', 'user_id', 'updated_at'),
+    )
+    # Identify rows by user as well, so that the ORM's UPDATEs and DELETEs
+    # name the partition key when entry is partitioned by user_id (see
+    # migrations/versions)
+    __mapper_args__ = {'primary_key': [id, user_id]}
+
+
+class EntryTombstone(db.Model):
+    """ Records a deleted entry so that syncing clients can drop it """
+    __tablename__ = 'entry_tombstone'
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_entry_tombstone_user_id_deleted_at',
+                 'user_id', 'deleted_at'),
+    )
+
+
+ACTIVE_EXPORT_JOB = "status IN ('pending', 'running')"
+
+
+class ExportJob(db.Model):
+    """ A CSV export requested through POST /export/jobs """
+    __tablename__ = 'export_job'
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status = db.Column(db.String, nullable=False, default=PENDING)
+    # The user's data version the artifact was written for
+    data_version = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_export_job_user_id_data_version',
+                 'user_id', 'data_version'),
+        db.Index('ix_export_job_status', 'status'),
+        # At most one job per user is queued or running at a time
+        db.Index('ix_export_job_user_id_active', 'user_id', unique=True,
+                 postgresql_where=db.text(ACTIVE_EXPORT_JOB),
+                 sqlite_where=db.text(ACTIVE_EXPORT_JOB)),
+    )
+
+
+class YearReport(db.Model):
+    """ A user's year in review, written by `manage.py build_reports` """
+    __tablename__ = 'year_report'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    entry_count = db.Column(db.Integer, nullable=False)
+    rated_count = db.Column(db.Integer, nullable=False)
+    average_rating = db.Column(db.Float)
+    # Months (1-12) with the highest and lowest average rating
+    best_month = db.Column(db.Integer)
+    worst_month = db.Column(db.Integer)
+    # Most consecutive days with an entry
+    longest_streak = db.Column(db.Integer, nullable=False)
+    built_at = db.Column(db.DateTime, nullable=False,
+                         default=datetime.utcnow)
 
-    __table_args__ = (UniqueConstraint('user_id', 'date'),)
+    __table_args__ = (
+        db.Index('ix_year_report_year', 'year'),
+    )
 
 
 class BlacklistToken(db.Model):
@@ -83,7 +201,31 @@ class BlacklistToken(db.Model):
         self.blacklisted_on = datetime.utcnow()
 
 
-class UserSchema(Schema):
+class RefreshToken(db.Model):
+    """
+    A long-lived token that is traded for a new access token (and a new
+    refresh token) through POST /token/refresh. Only an HMAC of its secret
+    is stored. Each token is used once; the tokens that replace one
+    another share a family, which is revoked as a whole on logout or when
+    a used token is presented again.
+    """
+    __tablename__ = 'refresh_token'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    family = db.Column(db.String, nullable=False)
+    secret_hash = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_refresh_token_family', 'family'),
+        db.Index('ix_refresh_token_user_id', 'user_id'),
+    )
+
+
+class UserSchema(TracedSchema):
     id = fields.Int()
     email = fields.Str(required=True,
                        validate=validate.Email(error='Invalid email address'))
@@ -92,7 +234,7 @@ class UserSchema(Schema):
     joined_on = fields.Date(required=False)
 
 
-class EntrySchema(Schema):
+class EntrySchema(TracedSchema):
     id = fields.Int()
     user_id = fields.Int()
     date = fields.Date(required=True)
@@ -104,3 +246,74 @@ class EntrySchema(Schema):
         if data is not None and not 1 <= data <= 10:
             raise ValidationError('Rating must be between 1 and 10')
         return data
+
+
+# Fields that PATCH /entry and PATCH /user accept. Email and password
+# changes go through PUT /user, which checks the current password.
+ENTRY_EDITABLE_FIELDS = ('date', 'notes', 'rating')
+USER_EDITABLE_FIELDS = ('name',)
+
+
+class ExportJobSchema(TracedSchema):
+    id = fields.Int()
+    status = fields.Str()
+    data_version = fields.Str()
+    created_at = fields.DateTime()
+    finished_at = fields.DateTime()
+    error = fields.Str()
+
+
+class YearReportSchema(TracedSchema):
+    year = fields.Int()
+    entry_count = fields.Int()
+    rated_count = fields.Int()
+    average_rating = fields.Float(allow_none=True)
+    best_month = fields.Int(allow_none=True)
+    worst_month = fields.Int(allow_none=True)
+    longest_streak = fields.Int()
+    built_at = fields.DateTime()
+
+
+def encode_sync_cursor(timestamp):
+    """ Sync cursors are opaque to clients: microseconds since the epoch """
+    return str(int((timestamp - EPOCH).total_seconds() * 1000000))
+
+
+def decode_sync_cursor(cursor):
+    """
+    Decodes a cursor from encode_sync_cursor
+    :raises ValueError: if the cursor is malformed
+    """
+    return EPOCH + timedelta(microseconds=int(cursor))
+
+
+EPOCH = datetime(1970, 1, 1)
+
+# Only the profile fields the frontend reads are embedded in auth tokens
+TOKEN_PROFILE_FIELDS = ('email', 'name', 'joined_on')
+TOKEN_PROFILE_SCHEMA = UserSchema(only=TOKEN_PROFILE_FIELDS)
+
+
+class ProfileVersions(object):
+    """
+    The latest profile_version of each user, kept in the shared store
+    (RATELIMIT_STORAGE_URL) so that an edit through one worker is seen by
+    all of them. A lower version never replaces a higher one, and versions
+    read from a replica, which may lag, are not recorded.
+    """
+
+    @staticmethod
+    def key(user_id):
+        return 'profile:{}'.format(user_id)
+
+    def get(self, user_id):
+        return get_store().get_value(self.key(user_id))
+
+    def set(self, user_id, version):
+        if replica_enabled():
+            return
+        get_store().raise_value(self.key(user_id), version,
+                                app.config['PROFILE_VERSION_TTL'])
+
+
+profile_versions = ProfileVersions()
@@ -0,0 +1,204 @@
+import collections
+import hashlib
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2; profile CPU only
+    tracemalloc = None
+
+PROFILE_HEADER = 'X-Profile'
+# Only one request is profiled at a time: tracemalloc is process wide, and
+# concurrent profiles would skew each other
+profile_lock = threading.Lock()
+# Streams that never end, whose bodies could never be buffered
+UNPROFILED_PATHS = ('/entry/stream',)
+
+
+def sign(secret, timestamp):
+    return hmac.new(secret.encode('utf-8'),
+                    'profile:{}'.format(timestamp).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def profile_header_value(secret, timestamp=None):
+    """ Returns an X-Profile header value, valid from timestamp on """
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    return '{}:{}'.format(timestamp, sign(secret, timestamp))
+
+
+def valid_signature(value, secret, max_age):
+    try:
+        timestamp, signature = value.split(':', 1)
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    return (0 <= age <= max_age and
+            hmac.compare_digest(signature, sign(secret, timestamp)))
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def collapse(frame):
+    """ Returns a frame's stack, outermost first, as 'a;b;c' """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler(object):
+    """
+    Records the stack of one thread every interval seconds, from a
+    background thread. Samples are taken between the profiled thread's
+    GIL switches, so intervals below sys.getswitchinterval() gain little.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+
+def allocation_stacks(snapshot):
+    """ Sums the sizes of live allocations by collapsed traceback """
+    stacks = collections.Counter()
+    for stat in snapshot.statistics('traceback'):
+        frames = ['{}:{}'.format(os.path.basename(frame.filename),
+                                 frame.lineno)
+                  for frame in stat.traceback]
+        # Tracebacks run innermost first before Python 3.7
+        if sys.version_info < (3, 7):
+            frames.reverse()
+        stacks[';'.join(frames)] += stat.size
+    return stacks
+
+
+def write_folded(path, stacks):
+    """ Writes stacks in the collapsed format read by flamegraph.pl """
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+class RequestProfile(object):
+    def __init__(self, config, environ):
+        self.config = config
+        self.started = time.time()
+        self.name = '{}.{:03d}-{}-{}-{}'.format(
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime(self.started)),
+            int(self.started * 1000) % 1000, os.getpid(),
+            environ.get('REQUEST_METHOD'),
+            re.sub(r'[^A-Za-z0-9]+', '_',
+                   environ.get('PATH_INFO', '')).strip('_') or 'root'
+        )
+        self.sampler = Sampler(threading.current_thread().ident,
+                               config['PROFILE_INTERVAL'])
+
+    def start(self):
+        if tracemalloc is not None:
+            tracemalloc.start(self.config['PROFILE_ALLOC_FRAMES'])
+        self.sampler.start()
+
+    def stop(self, logger):
+        """ Stops profiling and writes the profile files """
+        self.sampler.stop()
+        allocations, peak = None, 0
+        if tracemalloc is not None:
+            allocations = allocation_stacks(tracemalloc.take_snapshot())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        directory = self.config['PROFILE_DIR']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, self.name)
+        write_folded(path + '.cpu.folded', self.sampler.stacks)
+        if allocations is not None:
+            write_folded(path + '.alloc.folded', allocations)
+        logger.info('Profiled %s in %.3fs: %d samples, %d bytes peak '
+                    'allocation', self.name, time.time() - self.started,
+                    sum(self.sampler.stacks.values()), peak)
+
+
+def should_profile(environ, config):
+    value = environ.get('HTTP_' + PROFILE_HEADER.upper().replace('-', '_'))
+    if value is not None:
+        return valid_signature(value, config['SECRET_KEY'],
+                               config['PROFILE_SIGNATURE_MAX_AGE'])
+    rate = config['PROFILE_SAMPLE_RATE']
+    return bool(rate) and random.random() < rate
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles whole requests, from the first before_request hook until the
+    last byte of a (possibly streamed) response body, which it buffers.
+    Endless streams (UNPROFILED_PATHS) are never profiled. Costs one
+    config lookup per request while PROFILE_ENABLED is off.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        config = self.app.config
+        if (not config.get('PROFILE_ENABLED') or
+                environ.get('PATH_INFO') in UNPROFILED_PATHS or
+                not should_profile(environ, config) or
+                not profile_lock.acquire(False)):
+            return self.wsgi_app(environ, start_response)
+
+        try:
+            profile = RequestProfile(config, environ)
+
+            def start_profiled_response(status, headers, exc_info=None):
+                headers.append(('X-Profile-Id', profile.name))
+                return start_response(status, headers, exc_info)
+
+            profile.start()
+            try:
+                app_iter = self.wsgi_app(environ, start_profiled_response)
+                try:
+                    body = list(app_iter)
+                finally:
+                    if hasattr(app_iter, 'close'):
+                        app_iter.close()
+            finally:
+                profile.stop(self.app.logger)
+            return body
+        finally:
+            profile_lock.release()
+
+
+def register_profiling(app):
+    app.wsgi_app = ProfilingMiddleware(app, app.wsgi_app)
@@ -0,0 +1,105 @@
+from datetime import datetime
+from sqlalchemy import bindparam, select
+from sqlalchemy.ext import baked
+from .models import User, Entry, BlacklistToken
+from .database import is_sqlite
+
+from eachday import db
+
+# Baked queries are built and compiled to SQL once per process, then rerun
+# with new parameters. The lambdas' code objects are the cache keys, so
+# each query must be built from the same lambdas every time.
+bakery = baked.bakery()
+
+# Rows fetched per round trip when streaming a user's entries
+ENTRY_ROWS_BATCH = 1000
+ENTRY_COLUMNS = [Entry.id, Entry.user_id, Entry.date, Entry.notes,
+                 Entry.rating]
+
+
+def entry_row_dict(row):
+    """ Returns an entry row as the dict EntrySchema would dump """
+    return {'id': row.id, 'user_id': row.user_id,
+            'date': row.date.isoformat(), 'notes': row.notes,
+            'rating': row.rating}
+
+
+def is_blacklisted(token):
+    query = bakery(lambda session: session.query(BlacklistToken.id))
+    query += lambda q: q.filter(BlacklistToken.token == bindparam('token'))
+    return query(db.session()).params(token=token).first() is not None
+
+
+def get_user(user_id):
+    """ Loads a user by id, from the session's identity map if present """
+    query = bakery(lambda session: session.query(User))
+    return query(db.session()).get(user_id)
+
+
+def get_user_by_email(email):
+    query = bakery(lambda session: session.query(User))
+    query += lambda q: q.filter(User.email == bindparam('email'))
+    return query(db.session()).params(email=email).first()
+
+
+def get_entry(user_id, entry_id):
+    """ Loads one of a user's entries, or None """
+    query = bakery(lambda session: session.query(Entry))
+    query += lambda q: q.filter(Entry.id == bindparam('entry_id'),
+                                Entry.user_id == bindparam('user_id'))
+    return (query(db.session())
+            .params(user_id=user_id, entry_id=entry_id)
+            .first())
+
+
+def iter_entry_rows(user_id):
+    """
+    Yields a user's entries, newest first, as EntrySchema-shaped dicts.
+    Selects plain columns in batches of ENTRY_ROWS_BATCH rather than ORM
+    objects, through a server-side cursor where the driver supports one.
+    The query runs when this is called, so it uses the caller's bind.
+    """
+    rows = iter(db.session.query(*ENTRY_COLUMNS)
+                .filter(Entry.user_id == user_id)
+                .order_by(Entry.date.desc())
+                .yield_per(ENTRY_ROWS_BATCH))
+    return (entry_row_dict(row) for row in rows)
+
+
+def update_returning(model, where, values, columns):
+    """
+    Runs a single UPDATE and returns the updated row's columns (or None if
+    no row matched), through RETURNING. SQLite has no RETURNING here, so it
+    reads the row back with a second statement.
+    """
+    table = model.__table__
+    statement = table.update().where(where).values(**values)
+    # Core statements bypass the flush that marks the session as having
+    # written, which read_only views rely on to stick to the primary
+    db.session.info['has_writes'] = True
+    if is_sqlite():
+        db.session.execute(statement, mapper=model.__mapper__)
+        query = select(columns).where(where)
+    else:
+        query = statement.returning(*columns)
+    return db.session.execute(query, mapper=model.__mapper__).first()
+
+
+def update_entry(user_id, entry_id, values):
+    """ Updates one of a user's entries, returning it as a dict or None """
+    values = dict(values, updated_at=datetime.utcnow())
+    row = update_returning(Entry,
+                           (Entry.id == entry_id) & (Entry.user_id == user_id),
+                           values, ENTRY_COLUMNS)
+    return entry_row_dict(row) if row is not None else None
+
+
+def update_user(user_id, values):
+    """
+    Updates a user's profile fields and bumps their profile version,
+    returning the user's row or None
+    """
+    values = dict(values, profile_version=User.profile_version + 1)
+    return update_returning(User, User.id == user_id, values,
+                            [User.id, User.email, User.name, User.joined_on,
+                             User.profile_version])
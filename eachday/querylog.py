@@ -0,0 +1,123 @@
+import time
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .log import log
+
+
+class QueryStats(object):
+    """ Running totals for the queries issued during a single request """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def record(self, duration):
+        self.count += 1
+        self.duration += duration
+
+
+TRANSACTION_PREFIXES = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT',
+                        'ROLLBACK TO SAVEPOINT')
+
+
+class QueryCounter(object):
+    """
+    Context manager that counts every statement executed by any engine
+    while it is active. Used by the tests to enforce query budgets.
+    Transaction control statements are not counted: the tests wrap each
+    test in a savepoint, and only SQLite sends an explicit BEGIN.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        if not statement.startswith(TRANSACTION_PREFIXES):
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        event.remove(Engine, 'after_cursor_execute', self._after_execute)
+
+
+def explain(conn, statement, parameters):
+    """
+    Runs EXPLAIN for a statement on a fresh DBAPI cursor, so that the
+    results of the original cursor are left untouched
+    """
+    prefix = 'EXPLAIN '
+    if conn.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' '.join(str(column) for column in row)
+                         for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def register_query_hooks(app):
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    @event.listens_for(Engine, 'handle_error')
+    def failed_cursor_execute(context):
+        # Failed statements never reach after_cursor_execute; drop their
+        # start time, or it would be paired with the connection's next one
+        starts = (context.connection is not None and
+                  context.connection.info.get('query_start_time'))
+        if starts:
+            starts.pop()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters,
+                             context, executemany):
+        duration = time.time() - conn.info['query_start_time'].pop()
+        if not has_app_context():
+            return
+
+        stats = g.get('query_stats')
+        if stats is not None:
+            stats.record(duration)
+
+        threshold = app.config.get('SLOW_QUERY_THRESHOLD')
+        if threshold is None or duration < threshold:
+            return
+
+        log.warning('Slow query (%.3fs): %s %r',
+                    duration, statement, parameters)
+        if (app.config.get('SLOW_QUERY_EXPLAIN') and
+                statement.lstrip().upper().startswith('SELECT')):
+            log.warning('Query plan:\n%s',
+                        explain(conn, statement, parameters))
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def log_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        budget = app.config.get('QUERY_BUDGET')
+        if budget is not None and stats.count > budget:
+            log.warning('Request %s %s ran %d queries (budget is %d)',
+                        request.method, request.path,
+                        stats.count, budget)
+        log.debug('Request ran %d queries in %.3fs',
+                  stats.count, stats.duration)
+        return response
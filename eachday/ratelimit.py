@@ -0,0 +1,292 @@
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import six
+from contextlib import contextmanager
+from flask import current_app, request
+from flask_restful import wraps
+from six.moves.urllib.parse import urlparse
+from .log import log
+from .utils import send_error
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def refill(tokens, last, now, capacity, rate):
+    """
+    Token bucket step: returns (tokens, retry_after). retry_after is 0
+    when a token was taken, otherwise the seconds until one is available.
+    """
+    tokens = min(capacity, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+# Seconds between sweeps of expired values from a MemoryStore
+SWEEP_SECONDS = 60
+
+
+class MemoryStore(object):
+    """ Buckets and values in dicts; only suitable for a single process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._values = {}
+        self._next_sweep = 0
+
+    def consume(self, key, capacity, rate):
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (capacity, now))
+            tokens, retry_after = refill(tokens, last, now, capacity, rate)
+            self._buckets[key] = (tokens, now)
+        return retry_after
+
+    def raise_value(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            current, expires = self._values.get(key, (None, 0))
+            if expires > now and current >= value:
+                value = current
+            self._values[key] = (value, now + ttl)
+            if now >= self._next_sweep:
+                self._values = dict((k, v) for k, v in self._values.items()
+                                    if v[1] > now)
+                self._next_sweep = now + SWEEP_SECONDS
+
+    def get_value(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, 0))
+        return value if expires > time.time() else None
+
+
+class SharedMemoryStore(object):
+    """
+    Buckets and values in a memory mapped file shared by every worker on
+    the host. Each key hashes to a fixed slot holding (key hash, tokens,
+    last update) or (key hash, value, expiry); a colliding key simply takes
+    the slot over, as a full bucket or a missing value.
+    """
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # flock() locks are shared by forked children that inherit the
+        # descriptor, so every worker process maps the file itself
+        if self._pid == os.getpid():
+            return
+        size = self.SLOT.size * self.slots
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def _slot(self, key):
+        """ Returns (key hash, slot offset) for a key """
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        key_hash = struct.unpack('<Q', digest[:8])[0] or 1
+        return key_hash, (key_hash % self.slots) * self.SLOT.size
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def consume(self, key, capacity, rate):
+        key_hash, offset = self._slot(key)
+        now = time.time()
+        with self._locked():
+            slot_hash, tokens, last = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash != key_hash:
+                tokens, last = capacity, now
+            tokens, retry_after = refill(tokens, last, now, capacity, rate)
+            self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+        return retry_after
+
+    def raise_value(self, key, value, ttl):
+        key_hash, offset = self._slot(key)
+        now = time.time()
+        with self._locked():
+            slot_hash, current, expires = self.SLOT.unpack_from(self._map,
+                                                                offset)
+            if slot_hash == key_hash and expires > now and current >= value:
+                value = current
+            self.SLOT.pack_into(self._map, offset, key_hash, value, now + ttl)
+
+    def get_value(self, key):
+        key_hash, offset = self._slot(key)
+        with self._locked():
+            slot_hash, value, expires = self.SLOT.unpack_from(self._map,
+                                                              offset)
+        if slot_hash != key_hash or expires <= time.time():
+            return None
+        return value
+
+
+class RedisStore(object):
+    """
+    Buckets and values in Redis (or anything speaking its protocol and
+    Lua), shared by every host
+    """
+    SCRIPT = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - last) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'last', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+return tostring(retry_after)
+'''
+    RAISE_SCRIPT = '''
+local current = tonumber(redis.call('GET', KEYS[1]))
+local value = tonumber(ARGV[1])
+if current ~= nil and current > value then
+    value = current
+end
+redis.call('SET', KEYS[1], tostring(value), 'PX', ARGV[2])
+'''
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('The redis package is required for '
+                               'RATELIMIT_STORAGE_URL ' + url)
+        self._redis = redis.StrictRedis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+        self._raise_script = self._redis.register_script(self.RAISE_SCRIPT)
+
+    def consume(self, key, capacity, rate):
+        return float(self._script(keys=['ratelimit:' + key],
+                                  args=[capacity, rate, repr(time.time())]))
+
+    def raise_value(self, key, value, ttl):
+        self._raise_script(keys=['value:' + key],
+                           args=[repr(value), int(math.ceil(ttl * 1000))])
+
+    def get_value(self, key):
+        value = self._redis.get('value:' + key)
+        return float(value) if value is not None else None
+
+
+def create_store(url):
+    """
+    Builds a store from a URL: memory://, shm:///path/to/file or
+    redis://host:port/db. Besides token buckets, stores keep small shared
+    values: raise_value(key, value, ttl) keeps the largest value set in
+    the last ttl seconds, and get_value(key) returns it, or None.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryStore()
+    if parsed.scheme == 'shm':
+        return SharedMemoryStore(parsed.path)
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisStore(url)
+    raise ValueError('Unsupported RATELIMIT_STORAGE_URL: ' + url)
+
+
+def get_store():
+    url = current_app.config['RATELIMIT_STORAGE_URL']
+    stores = current_app.extensions.setdefault('ratelimit', {})
+    if url not in stores:
+        stores[url] = create_store(url)
+    return stores[url]
+
+
+def too_many_requests(retry_after):
+    response = send_error('Too many requests. Please try again later.', 429)
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+def client_address():
+    """
+    The client's IP address. Behind RATELIMIT_TRUSTED_PROXIES reverse
+    proxies, each of which appends the address it got the request from to
+    X-Forwarded-For, that is the address the outermost one saw; anything
+    the client put before it is ignored.
+    """
+    proxies = current_app.config.get('RATELIMIT_TRUSTED_PROXIES', 0)
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    addresses = [address.strip() for address in forwarded.split(',')
+                 if address.strip()]
+    addresses.append(request.remote_addr)
+    return addresses[max(len(addresses) - 1 - proxies, 0)]
+
+
+def request_email():
+    """
+    The email in the request's JSON body, or None. The body is decoded
+    here rather than with request.get_json, which would cache a failed
+    parse, so the view still rejects a malformed body with a 400.
+    """
+    try:
+        data = json.loads(request.get_data(as_text=True))
+    except ValueError:
+        return None
+    email = data.get('email') if isinstance(data, dict) else None
+    return email if isinstance(email, six.string_types) else None
+
+
+def rate_limited(scope):
+    """
+    Rejects a view with 429 once the client's IP address, or the email in
+    the JSON body, runs out of tokens. Runs before the view, so rejected
+    requests never reach the database or bcrypt.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            config = current_app.config
+            if not config.get('RATELIMIT_ENABLED'):
+                return func(*args, **kwargs)
+
+            email = request_email()
+            limits = [('ip', client_address(),
+                       config['RATELIMIT_PER_IP'])]
+            if email:
+                limits.append(('email', email.strip().lower(),
+                               config['RATELIMIT_PER_EMAIL']))
+
+            store = get_store()
+            for kind, value, (capacity, period) in limits:
+                key = '{}:{}:{}'.format(scope, kind, value)
+                retry_after = store.consume(key, capacity,
+                                            float(capacity) / period)
+                if retry_after:
+                    log.info('Rate limited %s for %s %s', scope, kind, value)
+                    return too_many_requests(retry_after)
+            return func(*args, **kwargs)
+        return wrapped
+    return decorator
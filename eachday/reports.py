@@ -0,0 +1,145 @@
+import collections
+import itertools
+import multiprocessing
+import time
+from datetime import date, datetime, timedelta
+from .models import User, Entry, YearReport
+
+from eachday import app, db
+
+# Users summarised per grouped query (and per task handed to a worker)
+REPORT_CHUNK_USERS = 500
+
+
+def summarize(user_id, year, rows):
+    """
+    Summarises one user's (date, rating) rows for a year, in date order,
+    as YearReport column values
+    """
+    ratings = [rating for _, rating in rows if rating is not None]
+    by_month = collections.defaultdict(list)
+    for day, rating in rows:
+        if rating is not None:
+            by_month[day.month].append(rating)
+    averages = sorted((sum(r) / float(len(r)), month)
+                      for month, r in by_month.items())
+
+    longest = streak = 0
+    previous = None
+    for day, _ in rows:
+        streak = streak + 1 if day - timedelta(days=1) == previous else 1
+        longest = max(longest, streak)
+        previous = day
+
+    return {
+        'user_id': user_id,
+        'year': year,
+        'entry_count': len(rows),
+        'rated_count': len(ratings),
+        'average_rating': (sum(ratings) / float(len(ratings))
+                           if ratings else None),
+        # Ties go to the earlier month
+        'best_month': (max(averages, key=lambda a: (a[0], -a[1]))[1]
+                       if averages else None),
+        'worst_month': averages[0][1] if averages else None,
+        'longest_streak': longest,
+        'built_at': datetime.utcnow(),
+    }
+
+
+def chunk_reports(user_ids, year):
+    """ Summarises a chunk of users from a single query for their entries """
+    rows = (db.session.query(Entry.user_id, Entry.date, Entry.rating)
+            .filter(Entry.user_id.in_(user_ids),
+                    Entry.date >= date(year, 1, 1),
+                    Entry.date < date(year + 1, 1, 1))
+            .order_by(Entry.user_id, Entry.date))
+    entries = dict((user_id, [(row.date, row.rating) for row in group])
+                   for user_id, group in itertools.groupby(
+                       rows, lambda row: row.user_id))
+    return [summarize(user_id, year, entries.get(user_id, []))
+            for user_id in user_ids]
+
+
+def build_chunk(user_ids, year):
+    """ Writes (or rewrites) the reports for a chunk of users """
+    reports = chunk_reports(user_ids, year)
+    (YearReport.query
+     .filter(YearReport.user_id.in_(user_ids), YearReport.year == year)
+     .delete(synchronize_session=False))
+    db.session.execute(YearReport.__table__.insert(), reports)
+    db.session.commit()
+    return len(reports)
+
+
+def iter_user_chunks(year, chunk_size, rebuild=False):
+    """
+    Yields lists of user ids in id order, a query per chunk. Unless
+    rebuilding, users that already have a report for the year are
+    skipped, so an interrupted run picks up where it stopped.
+    """
+    last_id = 0
+    while True:
+        query = db.session.query(User.id).filter(User.id > last_id)
+        if not rebuild:
+            query = query.filter(~db.session.query(YearReport.user_id)
+                                 .filter(YearReport.user_id == User.id,
+                                         YearReport.year == year)
+                                 .exists())
+        user_ids = [row.id for row in
+                    query.order_by(User.id).limit(chunk_size)]
+        # Don't hold a transaction open while the chunk is processed
+        db.session.rollback()
+        if not user_ids:
+            return
+        yield user_ids
+        last_id = user_ids[-1]
+
+
+def init_worker():
+    app.app_context().push()
+
+
+def build_reports(year, workers=1, chunk_size=REPORT_CHUNK_USERS,
+                  rebuild=False, progress=None):
+    """
+    Builds every user's report for a year, fanning chunks out to a pool of
+    worker processes (or running them in this one when workers is 1).
+    At most two chunks per worker are queued at a time. Calls progress
+    with the users done so far and the elapsed seconds after each chunk,
+    and returns the same pair.
+    """
+    started = time.time()
+    done = 0
+    chunks = iter_user_chunks(year, chunk_size, rebuild)
+
+    def finished(count):
+        total = done + count
+        if progress is not None:
+            progress(total, time.time() - started)
+        return total
+
+    if workers <= 1:
+        for user_ids in chunks:
+            done = finished(build_chunk(user_ids, year))
+        return done, time.time() - started
+
+    # Forked workers must not share the parent's connections
+    db.session.remove()
+    db.engine.dispose()
+    pool = multiprocessing.Pool(workers, initializer=init_worker)
+    try:
+        pending = collections.deque()
+        for user_ids in chunks:
+            pending.append(pool.apply_async(build_chunk, (user_ids, year)))
+            while len(pending) >= 2 * workers:
+                done = finished(pending.popleft().get())
+        while pending:
+            done = finished(pending.popleft().get())
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return done, time.time() - started
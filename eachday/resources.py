@@ -1,44 +1,95 @@
 import flask
-from flask import request, Response
+from flask import request, Response, current_app
 from flask_restful import Resource, wraps
-from .models import User, Entry, BlacklistToken, UserSchema, EntrySchema
-from .utils import send_error, send_success, send_data, InvalidJSONException
-import six
-import csv
+from .models import (User, Entry, EntryTombstone, BlacklistToken, ExportJob,
+                     YearReport, UserSchema, EntrySchema, ExportJobSchema,
+                     YearReportSchema, ENTRY_EDITABLE_FIELDS,
+                     USER_EDITABLE_FIELDS, profile_from_claims,
+                     profile_versions, encode_sync_cursor, decode_sync_cursor)
+from .utils import (send_error, send_success, send_data, stream_data,
+                    spool, send_spooled, InvalidJSONException)
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from datetime import datetime, timedelta
+import os
 from .log import log
+from .database import read_only, serialized_write
+from .ratelimit import rate_limited
+from .queries import (is_blacklisted, get_user, get_user_by_email,
+                      get_entry, iter_entry_rows, update_entry, update_user)
+from .batch import validate_calls, run_batch
+from .exports import (iter_csv, export_rows, data_version, artifact_path,
+                      uses_copy, copy_csv)
+from .tracing import span
+from .events import publish_entry, get_bus, stream_events
+from .tokens import (RefreshTokenError, issue_refresh_token,
+                     rotate_refresh_token, revoke_refresh_token,
+                     revoke_user_tokens)
 
 from eachday import db, bcrypt
 
 
+def authenticate():
+    """
+    Checks the request's auth token. Returns its claims and the token, or
+    an error response to send instead.
+    """
+    auth_header = request.headers.get('Authorization')
+    if auth_header:
+        auth_token = auth_header.split(' ')[1]
+    else:
+        log.info('Rejecting auth because no token provided')
+        return None, None, send_error('Please provide an auth token', 401)
+
+    if auth_token == flask.g.get('batch_token'):
+        # A sub-request of /batch, which already checked this token
+        return flask.g.auth_claims, auth_token, None
+
+    try:
+        claims = User.decode_auth_claims(auth_token)
+    except Exception as e:
+        log.info('Rejecting auth token: %s', auth_token)
+        return None, None, send_error(str(e), 401)
+
+    # Errors past this point (e.g. an exhausted connection pool) are
+    # server problems and go to the app's error handlers, not a 401
+    if is_blacklisted(auth_token):
+        log.info('Rejecting auth because token is blacklisted')
+        return None, None, send_error(
+            'Token blacklisted. Please log in again.', 401
+        )
+    return claims, auth_token, None
+
+
 def validate_auth(func):
     @wraps(func)
     def wrapped(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
-            auth_token = auth_header.split(' ')[1]
-        else:
-            log.info('Rejecting auth because no token provided')
-            return send_error('Please provide an auth token', 401)
-
-        try:
-            user_id = User.decode_auth_token(auth_token)
-            blacklist_token = (BlacklistToken.query
-                               .filter_by(token=auth_token)
-                               .first())
-            if blacklist_token is not None:
-                log.info('Rejecting auth because token is blacklisted')
-                return send_error(
-                    'Token blacklisted. Please log in again.', 401
-                )
-            flask.g.auth_token = auth_token
-            log.debug('Authentication successful')
-            return func(user_id=user_id, *args, **kwargs)
-        except Exception as e:
-            log.info('Rejecting auth token: {}'.format(auth_token))
-            return send_error(str(e), 401)
+        with span('validate_auth'):
+            claims, auth_token, error = authenticate()
+        if error is not None:
+            return error
+
+        user_id = claims['sub']
+        flask.g.auth_token = auth_token
+        flask.g.auth_claims = claims
+        flask.g.user_id = user_id
+        log.debug('Authentication successful')
+        return func(user_id=user_id, *args, **kwargs)
     return wrapped
 
 
+def commit_and_send_tokens(message, code, user, refresh_token):
+    """ Commits a new refresh token and sends it with an access token """
+    # Encoded before the commit expires the user's attributes
+    auth_token = User.encode_token_for(user).decode()
+    db.session.commit()
+    return send_success(
+        message, code,
+        auth_token=auth_token,
+        refresh_token=refresh_token,
+        expires_in=current_app.config['ACCESS_TOKEN_MINUTES'] * 60
+    )
+
+
 def json_load_failed(self):
     raise InvalidJSONException
 
@@ -51,17 +102,23 @@ def get_json():
 class UserResource(Resource):
     method_decorators = [validate_auth]
 
+    @read_only
     def get(self, user_id=None):
-        log.info('Getting user info for user: {}'.format(user_id))
-        user = db.session.query(User).filter_by(id=user_id).first()
+        log.info('Getting user info for user: %s', user_id)
+        profile = profile_from_claims(flask.g.auth_claims)
+        if profile is not None:
+            return send_data(profile)
+
+        user = get_user(user_id)
         if not user:
             return send_error('Invalid user id', 404)
 
+        profile_versions.set(user.id, user.profile_version)
         return send_data(UserSchema().dump(user).data)
 
     def put(self, user_id=None):
-        log.info('Modifying user info for user: {}'.format(user_id))
-        user = db.session.query(User).filter_by(id=user_id).first()
+        log.info('Modifying user info for user: %s', user_id)
+        user = get_user(user_id)
         if not user:
             return send_error('Invalid user id', 404)
 
@@ -73,8 +130,12 @@ class UserResource(Resource):
                      'invalid password provided')
             return send_error('Invalid password.', 401)
 
+        refresh_token = None
         if data.get('new_password'):
             user.set_password(data['new_password'])
+            # Sign out every other device
+            revoke_user_tokens(user.id)
+            refresh_token = issue_refresh_token(user.id)
 
         if data.get('email'):
             user.email = data['email']
@@ -82,59 +143,122 @@ class UserResource(Resource):
         if data.get('name'):
             user.name = data['name']
 
+        user.profile_version += 1
         db.session.add(user)
         db.session.commit()
+        profile_versions.set(user.id, user.profile_version)
 
         payload = UserSchema().dump(user).data
         payload['auth_token'] = user.encode_auth_token(user.id).decode()
+        if refresh_token is not None:
+            payload['refresh_token'] = refresh_token
+        return send_data(payload)
+
+    def patch(self, user_id=None):
+        ''' Updates fields that need no password check in one statement '''
+        data = get_json()
+        if set(data) - set(USER_EDITABLE_FIELDS):
+            return send_error('Only {} can be changed without a password'
+                              .format(', '.join(USER_EDITABLE_FIELDS)))
+        args, errors = UserSchema(only=USER_EDITABLE_FIELDS,
+                                  partial=True).load(data)
+        if errors:
+            return send_error(errors)
+        if not args:
+            return send_error('No fields to update')
+
+        user = update_user(user_id, args)
+        db.session.commit()
+        if user is None:
+            return send_error('Invalid user id', 404)
+        log.info('Patched user %s', user_id)
+        profile_versions.set(user.id, user.profile_version)
+
+        payload = UserSchema().dump(user).data
+        payload['auth_token'] = User.encode_token_for(user).decode()
         return send_data(payload)
 
 
 class RegisterResource(Resource):
+    @rate_limited('register')
     def post(self):
         args, errors = UserSchema().load(get_json())
         if errors:
             return send_error(errors)
 
-        user = db.session.query(User).filter_by(email=args['email']).first()
+        user = get_user_by_email(args['email'])
         if user:
             return send_error('User already exists.')
 
-        log.info('Creating user with email {}'.format(args['email']))
+        log.info('Creating user with email %s', args['email'])
         user = User(**args)
         db.session.add(user)
-        db.session.commit()
-        auth_token = user.encode_auth_token(user.id)
-        return send_success('Successfully registered.', 201,
-                            auth_token=auth_token.decode())
+        db.session.flush()
+        refresh_token = issue_refresh_token(user.id)
+        return commit_and_send_tokens('Successfully registered.', 201, user,
+                                      refresh_token)
 
 
 class LoginResource(Resource):
+    @rate_limited('login')
     def post(self):
         data = get_json()
         email, password = data['email'], data['password']
 
-        user = db.session.query(User).filter_by(email=email).first()
+        user = get_user_by_email(email)
         if not user:
-            log.info('User with email "{}" does not exist'.format(email))
+            log.info('User with email "%s" does not exist', email)
             return send_error('User does not exist.', 404)
 
         if bcrypt.check_password_hash(user.password, password):
-            auth_token = user.encode_auth_token(user.id)
-            return send_success('Successfully logged in.', 200,
-                                auth_token=auth_token.decode())
+            refresh_token = issue_refresh_token(user.id)
+            return commit_and_send_tokens('Successfully logged in.', 200,
+                                          user, refresh_token)
         else:
             return send_error('Invalid login.', 401)
 
 
+class TokenRefreshResource(Resource):
+    @serialized_write
+    def post(self):
+        '''
+        Trades a refresh token for a new access token and refresh token,
+        with no password check
+        '''
+        data = get_json()
+        try:
+            user, refresh_token = rotate_refresh_token(
+                data.get('refresh_token')
+            )
+        except RefreshTokenError as e:
+            db.session.commit()
+            log.info('Rejecting refresh token: %s', e)
+            return send_error(str(e), 401)
+        return commit_and_send_tokens('Token refreshed.', 200, user,
+                                      refresh_token)
+
+
 class LogoutResource(Resource):
     method_decorators = [validate_auth]
 
     def post(self, user_id=None):
+        '''
+        Revokes the refresh token sent in the body, leaving the short-lived
+        access token to expire. Without one, the access token is
+        blacklisted instead.
+        '''
+        data = request.get_json(force=True, silent=True) or {}
+        if data.get('refresh_token'):
+            if not revoke_refresh_token(data['refresh_token'], user_id):
+                return send_error('Invalid refresh token.', 401)
+            log.info('Revoked refresh tokens for user %s', user_id)
+            db.session.commit()
+            return send_success('Successfully logged out')
+
         auth_token = flask.g.auth_token
         blacklist_token = BlacklistToken(token=auth_token)
 
-        log.info('Blacklisting token {}'.format(auth_token))
+        log.info('Blacklisting token %s', auth_token)
         db.session.add(blacklist_token)
         db.session.commit()
         return send_success('Successfully logged out')
@@ -143,39 +267,41 @@ class LogoutResource(Resource):
 class EntryResource(Resource):
     method_decorators = [validate_auth]
 
+    @read_only
     def get(self, user_id=None, entry_id=None):
-        entries = db.session.query(Entry).filter_by(user_id=user_id)
-
         if not entry_id:
-            return send_data(EntrySchema(many=True).dump(
-                entries.order_by(Entry.date.desc()).all()).data)
+            return stream_data(iter_entry_rows(user_id))
 
-        entry = entries.filter_by(id=entry_id).first()
+        entry = get_entry(user_id, entry_id)
         if not entry:
             return send_error('Invalid entry id', 404)
 
-        log.info('Returning info for entry {}'.format(entry_id))
+        log.info('Returning info for entry %s', entry_id)
         return send_data(EntrySchema().dump(entry).data)
 
+    @serialized_write
     def post(self, user_id=None, entry_id=None):
         args, errors = EntrySchema().load(get_json())
         if errors:
             return send_error(errors)
 
-        entry = Entry.query.filter_by(date=args['date']).first()
-        if entry:
-            return send_error('An entry for this date already exists!')
-
+        # The (user_id, date) unique constraint rejects duplicates, so
+        # there is no need for a separate SELECT beforehand
         entry = Entry(user_id=user_id, **args)
-
         db.session.add(entry)
-        db.session.commit()
-        log.info('Created new entry {}'.format(entry.id))
+        try:
+            db.session.flush()
+            publish_entry(user_id, 'entry.created', entry)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return send_error('An entry for this date already exists!')
+        log.info('Created new entry %s', entry.id)
         return send_data(EntrySchema().dump(entry).data, 201)
 
+    @serialized_write
     def put(self, entry_id, user_id=None):
-        entry = db.session.query(Entry).filter_by(
-            user_id=user_id, id=entry_id).first()
+        entry = get_entry(user_id, entry_id)
 
         if not entry:
             return send_error('Invalid entry id', 404)
@@ -193,49 +319,259 @@ class EntryResource(Resource):
         for k, v in args.items():
             setattr(entry, k, v)
 
-        log.info('Altering entry {}'.format(entry_id))
+        log.info('Altering entry %s', entry_id)
         db.session.add(entry)
+        publish_entry(user_id, 'entry.updated', entry)
         db.session.commit()
         return send_data(EntrySchema().dump(entry).data, 200)
 
+    @serialized_write
+    def patch(self, entry_id, user_id=None):
+        ''' Updates only the supplied fields, in a single statement '''
+        data = get_json()
+        if data.get('rating') == 0:
+            data['rating'] = None
+
+        args, errors = EntrySchema(only=ENTRY_EDITABLE_FIELDS,
+                                   partial=True).load(data)
+        if errors:
+            return send_error(errors)
+        if not args:
+            return send_error('No fields to update')
+
+        try:
+            entry = update_entry(user_id, entry_id, args)
+            if entry is not None:
+                publish_entry(user_id, 'entry.updated', entry)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return send_error('An entry for this date already exists!')
+        if entry is None:
+            return send_error('Invalid entry id', 404)
+        log.info('Patched entry %s', entry_id)
+        return send_data(entry)
+
+    @serialized_write
     def delete(self, entry_id, user_id=None):
-        entry = db.session.query(Entry).filter_by(
-            user_id=user_id, id=entry_id).first()
+        entry = get_entry(user_id, entry_id)
 
         if not entry:
             return send_error('Invalid entry id', 404)
 
-        log.info('Deleting entry {}'.format(entry_id))
+        log.info('Deleting entry %s', entry_id)
         db.session.delete(entry)
+        db.session.add(EntryTombstone(entry_id=entry.id, user_id=user_id))
+        publish_entry(user_id, 'entry.deleted', entry_id=entry.id)
         db.session.commit()
         return send_success('Successfully deleted entry.', 200)
 
 
+class EntryStreamResource(Resource):
+    method_decorators = [validate_auth]
+
+    def get(self, user_id=None):
+        ''' Streams the user's entry changes as server-sent events '''
+        bus = get_bus(current_app._get_current_object())
+        keepalive = current_app.config['EVENTS_KEEPALIVE']
+        subscription = bus.subscribe(user_id)
+        # Idle streams shouldn't hold on to a database connection
+        db.session.close()
+
+        # Runs after the request context is gone
+        def generate():
+            try:
+                for chunk in stream_events(subscription, keepalive):
+                    yield chunk
+            finally:
+                bus.unsubscribe(subscription)
+        return Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+
+class EntryChangesResource(Resource):
+    method_decorators = [validate_auth]
+
+    # Not read_only: the cursor is the time of this sync, so it must not
+    # skip rows that a lagging replica hasn't applied yet
+    def get(self, user_id=None):
+        '''
+        Returns the entries created or changed, and the ids of entries
+        deleted, since the cursor from the client's previous sync
+        '''
+        now = datetime.utcnow()
+        cursor = request.args.get('since')
+        since = None
+        if cursor:
+            try:
+                since = decode_sync_cursor(cursor)
+            except (ValueError, OverflowError):
+                return send_error('Invalid cursor')
+
+        config = flask.current_app.config
+        retention = timedelta(days=config['SYNC_TOMBSTONE_DAYS'])
+        reset = since is None or since < now - retention
+
+        entries = db.session.query(Entry).filter_by(user_id=user_id)
+        deleted = []
+        if not reset:
+            # Rows written by transactions that were still in flight at
+            # the previous sync carry earlier timestamps, so look back a
+            # little and let clients apply the overlap idempotently
+            since -= timedelta(seconds=config['SYNC_CURSOR_OVERLAP'])
+            entries = entries.filter(Entry.updated_at > since)
+            deleted = [t.entry_id for t in
+                       db.session.query(EntryTombstone.entry_id)
+                       .filter(EntryTombstone.user_id == user_id,
+                               EntryTombstone.deleted_at > since)]
+
+        return send_data({
+            'entries': EntrySchema(many=True).dump(
+                entries.order_by(Entry.date.desc()).all()).data,
+            'deleted': deleted,
+            'reset': reset,
+            'cursor': encode_sync_cursor(now),
+        })
+
+
 class ExportResource(Resource):
     method_decorators = [validate_auth]
 
+    @read_only
     def get(self, user_id):
         ''' Returns a CSV version of entries '''
-        entries = Entry.query.filter_by(user_id=user_id).all()
-        buf = six.StringIO()
-        writer = csv.writer(buf)
-        writer.writerow(['Date', 'Rating', 'Notes'])
-        for e in entries:
-            writer.writerow([e.date, e.rating, e.notes])
+        headers = {'Content-disposition': 'attachment; filename=export.csv'}
+        connection = db.session.connection(mapper=Entry.__mapper__)
+        if not uses_copy(connection):
+            return Response(''.join(iter_csv(export_rows(user_id))),
+                            mimetype='text/csv', headers=headers)
+        # COPY writes to a spool rather than to the client, so it ends (and
+        # the connection is released) however slowly the CSV downloads
+        body = spool()
+        copy_csv(connection, user_id, body)
+        return send_spooled(body, mimetype='text/csv', headers=headers)
+
+
+class ExportJobsResource(Resource):
+    method_decorators = [validate_auth]
 
-        return Response(buf.getvalue(),
-                        mimetype='text/csv',
-                        headers={'Content-disposition':
-                                 'attachment; filename=export.csv'})
+    def post(self, user_id=None):
+        '''
+        Queues an export for the export worker, unless one for the user's
+        current data is already done or queued
+        '''
+        version = data_version(user_id)
+        done = (ExportJob.query
+                .filter_by(user_id=user_id, data_version=version,
+                           status=ExportJob.DONE)
+                .order_by(ExportJob.id.desc())
+                .first())
+        if done and os.path.exists(artifact_path(user_id, version)):
+            return send_data(ExportJobSchema().dump(done).data)
+
+        job = (ExportJob.query
+               .filter(ExportJob.user_id == user_id,
+                       ExportJob.status.in_([ExportJob.PENDING,
+                                             ExportJob.RUNNING]))
+               .first())
+        if job is None:
+            job = ExportJob(user_id=user_id)
+            db.session.add(job)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent request queued one first (see
+                # ix_export_job_user_id_active); answer with that
+                db.session.rollback()
+                return self.post(user_id)
+            log.info('Queued export job %s', job.id)
+        return send_data(ExportJobSchema().dump(job).data, 202)
+
+
+class YearReportResource(Resource):
+    method_decorators = [validate_auth]
+
+    @read_only
+    def get(self, year, user_id=None):
+        ''' Returns the user's year in review, once it has been built '''
+        report = YearReport.query.filter_by(user_id=user_id,
+                                            year=year).first()
+        if not report:
+            return send_error('No report for this year', 404)
+        return send_data(YearReportSchema().dump(report).data)
+
+
+class ExportJobResource(Resource):
+    method_decorators = [validate_auth]
+
+    def get(self, job_id, user_id=None):
+        job = ExportJob.query.filter_by(user_id=user_id, id=job_id).first()
+        if not job:
+            return send_error('Invalid export job id', 404)
+        return send_data(ExportJobSchema().dump(job).data)
+
+
+class ExportArtifactResource(Resource):
+    method_decorators = [validate_auth]
+
+    def get(self, job_id, user_id=None):
+        ''' Sends a finished export; supports Range requests '''
+        job = ExportJob.query.filter_by(user_id=user_id, id=job_id).first()
+        if not job:
+            return send_error('Invalid export job id', 404)
+
+        path = None
+        if job.status == ExportJob.DONE:
+            path = artifact_path(user_id, job.data_version)
+        if path is None or not os.path.exists(path):
+            return send_error('Export is not available', 409,
+                              job=ExportJobSchema().dump(job).data)
+
+        response = flask.send_file(path, mimetype='text/csv',
+                                   as_attachment=True,
+                                   attachment_filename='export.csv',
+                                   conditional=True)
+        response.headers['Cache-Control'] = 'private, max-age=0'
+        return response
+
+
+class BatchResource(Resource):
+    method_decorators = [validate_auth]
+
+    def post(self, user_id=None):
+        '''
+        Runs several API calls in one round trip. Takes
+        {"requests": [{"method": "GET", "path": "/user"}, ...]} (with an
+        optional "body" per request, and "parallel": true to run a batch of
+        GETs concurrently) and returns each call's status and body, in order
+        '''
+        body = get_json()
+        if not isinstance(body, dict):
+            return send_error('Expected a JSON object')
+        calls = body.get('requests')
+        error = validate_calls(calls)
+        if error:
+            return send_error(error)
+        return send_data(run_batch(calls, bool(body.get('parallel'))))
 
 
 def create_apis(api):
     api.add_resource(UserResource, '/user')
     api.add_resource(EntryResource, '/entry/<int:entry_id>', '/entry')
+    api.add_resource(EntryChangesResource, '/entry/changes')
+    api.add_resource(EntryStreamResource, '/entry/stream')
     api.add_resource(LoginResource, '/login')
     api.add_resource(LogoutResource, '/logout')
+    api.add_resource(TokenRefreshResource, '/token/refresh')
     api.add_resource(RegisterResource, '/register')
     api.add_resource(ExportResource, '/export')
+    api.add_resource(ExportJobsResource, '/export/jobs')
+    api.add_resource(ExportJobResource, '/export/jobs/<int:job_id>')
+    api.add_resource(ExportArtifactResource,
+                     '/export/jobs/<int:job_id>/artifact')
+    api.add_resource(BatchResource, '/batch')
+    api.add_resource(YearReportResource, '/reports/<int:year>')
 
 
 def register_error_handlers(app):
@@ -244,6 +580,14 @@ def register_error_handlers(app):
         log.info(error)
         return send_error('Invalid JSON body')
 
+    @app.errorhandler(PoolTimeoutError)
+    def pool_exhausted(error):
+        log.warning('Connection pool exhausted: %s', error)
+        db.session.rollback()
+        response = send_error('Service temporarily unavailable.', 503)
+        response.headers['Retry-After'] = '1'
+        return response
+
     @app.errorhandler(Exception)
     def generic_exception(error):
         log.error(error)
@@ -0,0 +1,240 @@
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import posixpath
+import re
+from flask import current_app, request
+from werkzeug.wsgi import wrap_file
+from .utils import send_error
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Precompressed variants written next to each file by compress_directory,
+# in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE_TYPES = ('application/javascript', 'application/json',
+                      'image/svg+xml')
+# Relative asset references in pages, which get versioned by content hash
+ASSET_REFERENCE = re.compile(r'''((?:src|href)=["'])([^"'?#:]+)(["'])''')
+
+# First path segments of API routes, which never fall back to index.html
+API_PREFIXES = ('batch', 'entry', 'export', 'logout', 'metrics', 'reports',
+                'token', 'user')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+def guess_mimetype(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    # A fixed mtime keeps the output (and its ETag) reproducible
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def compress(data):
+    """ Returns {encoding: compressed bytes} for every available encoding """
+    variants = {'gzip': gzip_bytes(data)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data)
+    return variants
+
+
+def compress_directory(root):
+    """
+    Writes .gz (and, with the brotli package, .br) variants of the text
+    assets under root, for StaticIndex to serve. Variants that come out no
+    smaller than the original are skipped.
+    """
+    written = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            mimetype = guess_mimetype(path)
+            if (name.endswith(('.gz', '.br')) or
+                    not (mimetype.startswith('text/') or
+                         mimetype in COMPRESSIBLE_TYPES)):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = compress(data)
+            for encoding, suffix in ENCODINGS:
+                compressed = variants.get(encoding)
+                if compressed is None or len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+                written.append(path + suffix)
+    return written
+
+
+class StaticFile(object):
+    """ What is known about a file without touching the filesystem """
+
+    def __init__(self, path, digest, mtime, variants, content=None):
+        self.path = path
+        self.digest = digest
+        self.mtime = mtime
+        self.mimetype = guess_mimetype(path)
+        # {encoding: (path, size)}; the None encoding is the file itself
+        self.variants = variants
+        # {encoding: bytes}, for pages rewritten in memory
+        self.content = content
+
+    def encodings(self):
+        return self.content if self.content is not None else self.variants
+
+
+class StaticIndex(object):
+    """
+    Content hashes, sizes and compressed variants of every file under root,
+    collected once so that requests never stat the filesystem. Pages get
+    their relative asset references rewritten to absolute, versioned URLs
+    (dist/bundle.js -> /dist/bundle.js?v=<hash>), which can then be cached
+    as immutable.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+        self.refresh()
+
+    def refresh(self):
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(('.gz', '.br')):
+                    continue
+                path = os.path.join(directory, name)
+                url = os.path.relpath(path, self.root).replace(os.sep, '/')
+                mtime = os.path.getmtime(path)
+                variants = {None: (path, os.path.getsize(path))}
+                for encoding, suffix in ENCODINGS:
+                    variant = path + suffix
+                    # Ignore variants left over from an earlier build
+                    if (os.path.exists(variant) and
+                            os.path.getmtime(variant) >= mtime):
+                        variants[encoding] = (variant,
+                                              os.path.getsize(variant))
+                files[url] = StaticFile(path, file_digest(path), mtime,
+                                        variants)
+
+        for url, static_file in files.items():
+            if static_file.mimetype == 'text/html':
+                self.version_page(url, static_file, files)
+        self.files = files
+
+    def version_page(self, url, page, files):
+        def versioned(match):
+            reference = match.group(2)
+            if reference.startswith('//'):
+                return match.group(0)
+            target = posixpath.normpath(
+                posixpath.join(posixpath.dirname(url), reference)
+            ).lstrip('/')
+            if target not in files:
+                return match.group(0)
+            return '{}/{}?v={}{}'.format(match.group(1), target,
+                                         files[target].digest,
+                                         match.group(3))
+
+        with open(page.path, 'rb') as f:
+            html = f.read().decode('utf-8')
+        data = ASSET_REFERENCE.sub(versioned, html).encode('utf-8')
+        page.content = compress(data)
+        page.content[None] = data
+        page.digest = hashlib.sha1(data).hexdigest()[:16]
+
+    def lookup(self, path, client_route=False):
+        """ Finds a file, falling back to index.html for client routes """
+        static_file = self.files.get(path or 'index.html')
+        if (static_file is None and client_route and
+                '.' not in posixpath.basename(path)):
+            static_file = self.files.get('index.html')
+        return static_file
+
+
+def is_client_route(path):
+    """
+    Whether a path could be a route of the frontend: a page requested by a
+    browser, outside the API. Anything else gets a 404 rather than
+    index.html when no file matches.
+    """
+    if path.split('/', 1)[0] in API_PREFIXES:
+        return False
+    return any(value == 'text/html' for value, _ in request.accept_mimetypes)
+
+
+def choose_encoding(static_file):
+    available = static_file.encodings()
+    for encoding, _ in ENCODINGS:
+        if encoding in available and encoding in request.accept_encodings:
+            return encoding
+    return None
+
+
+def serve_static(path=''):
+    static_file = current_app.extensions['static_index'].lookup(
+        path, is_client_route(path)
+    )
+    if static_file is None:
+        return send_error('Not found', 404)
+
+    encoding = choose_encoding(static_file)
+    response = current_app.response_class(mimetype=static_file.mimetype)
+    response.set_etag(static_file.digest +
+                      ('-' + encoding if encoding else ''))
+    response.last_modified = static_file.mtime
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.content_encoding = encoding
+    if request.args.get('v') == static_file.digest:
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        response.headers['Cache-Control'] = REVALIDATE
+
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    if static_file.content is not None:
+        response.set_data(static_file.content[encoding])
+    else:
+        # wrap_file hands the file to the server's wsgi.file_wrapper, which
+        # sends it with sendfile() where the server supports it
+        filename, size = static_file.variants[encoding]
+        response.response = wrap_file(request.environ, open(filename, 'rb'))
+        response.direct_passthrough = True
+        response.content_length = size
+    return response
+
+
+def register_static(app):
+    """ Serves the frontend build from STATIC_DIR, when it is set """
+    root = app.config.get('STATIC_DIR')
+    if not root:
+        return
+    index = StaticIndex(root)
+    app.extensions['static_index'] = index
+    app.logger.info('Serving %d static files from %s', len(index.files), root)
+    app.add_url_rule('/', 'frontend', serve_static)
+    app.add_url_rule('/<path:path>', 'frontend', serve_static)
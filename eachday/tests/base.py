@@ -1,19 +1,92 @@
+import os
+import unittest
+from contextlib import contextmanager
 from eachday import app, db
+from eachday.config import TestingConfig
+from eachday.querylog import QueryCounter
 from flask_testing import TestCase
+from sqlalchemy import event
+
+# The schema is built once per test run (or once per template database by
+# `manage.py test --workers`), not once per test
+_schema_ready = bool(os.getenv('TEST_SCHEMA_READY'))
+
+# Set TEST_DATABASE_URI (e.g. to sqlite:////tmp/eachday_test.db) to run the
+# suite against another database
+test_database_uri = (os.getenv('TEST_DATABASE_URI') or
+                     TestingConfig.SQLALCHEMY_DATABASE_URI)
+postgres_only = unittest.skipUnless(
+    test_database_uri.startswith('postgresql'), 'Needs Postgres'
+)
 
 
 class BaseTestCase(TestCase):
     """ Base Tests for setup/config """
 
+    # Run each test inside a transaction that is rolled back afterwards.
+    # Tests that need real commits (e.g. to observe them from another
+    # connection) set this to False and get their rows deleted instead.
+    transactional = True
+
     def create_app(self):
         app.config.from_object('eachday.config.TestingConfig')
+        app.config['SQLALCHEMY_DATABASE_URI'] = test_database_uri
         app.logger.setLevel('WARN')
         return app
 
     def setUp(self):
-        db.create_all()
-        db.session.commit()
+        global _schema_ready
+        # Recent writes and profile versions live in the shared store
+        app.extensions.pop('ratelimit', None)
+        if not _schema_ready:
+            db.drop_all()
+            db.create_all()
+            _schema_ready = True
+
+        if self.transactional:
+            self._begin_test_transaction()
 
     def tearDown(self):
+        if self.transactional:
+            self._rollback_test_transaction()
+        else:
+            db.session.remove()
+            for table in reversed(db.metadata.sorted_tables):
+                db.session.execute(table.delete())
+            db.session.commit()
         db.session.remove()
-        db.drop_all()
+
+    def _begin_test_transaction(self):
+        """
+        Binds the scoped session to a connection with an open transaction,
+        and runs the test in a SAVEPOINT that is restarted whenever the
+        code under test commits or rolls back
+        """
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+        session = db.session.session_factory(bind=self._connection,
+                                             binds={})
+        session.begin_nested()
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        db.session.registry.set(session)
+
+    def _rollback_test_transaction(self):
+        db.session.close()
+        self._transaction.rollback()
+        self._connection.close()
+
+    @contextmanager
+    def assertMaxQueries(self, max_queries):
+        """ Fails if the enclosed block runs more than max_queries queries """
+        with QueryCounter() as counter:
+            yield counter
+        if counter.count > max_queries:
+            self.fail('Expected at most {} queries, but {} were run:\n{}'
+                      .format(max_queries, counter.count,
+                              '\n'.join(counter.statements)))
@@ -0,0 +1,101 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from datetime import date
+
+from eachday import db
+from eachday.analytics import (dump_analytics, read_npy, write_npy,
+                               month_range, STATE_FILE)
+from eachday.models import User, Entry
+from eachday.tests.base import BaseTestCase
+
+
+class TestNpy(unittest.TestCase):
+    def test_round_trip(self):
+        import array
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'a.npy')
+        try:
+            write_npy(path, '<i4', array.array('i', [1, -2, 3]))
+            with open(path, 'rb') as f:
+                header = f.read(128)
+            # Data starts on a 64 byte boundary, as NumPy expects
+            self.assertEqual((header.index(b'\n') + 1) % 64, 0)
+            self.assertEqual(list(read_npy(path)), [1, -2, 3])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_month_range(self):
+        self.assertEqual(month_range('2017-12'),
+                         (date(2017, 12, 1), date(2018, 1, 1)))
+
+
+class TestDumpAnalytics(BaseTestCase):
+    def setUp(self):
+        super(TestDumpAnalytics, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.users = [User(email='user{}@bar.com'.format(i), password='test',
+                           name='joe') for i in range(2)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        first, second = self.users
+        db.session.add_all([
+            Entry(user_id=second.id, date=date(2017, 1, 5), rating=7,
+                  notes='hello'),
+            Entry(user_id=first.id, date=date(2017, 1, 5)),
+            Entry(user_id=first.id, date=date(2017, 2, 1), rating=3,
+                  notes=''),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestDumpAnalytics, self).tearDown()
+
+    def column(self, month, name):
+        return list(read_npy(os.path.join(self.directory, 'month=' + month,
+                                          name + '.npy')))
+
+    def test_dump(self):
+        written, removed = dump_analytics(self.directory, 'npy')
+        self.assertEqual((written, removed), (['2017-01', '2017-02'], []))
+        first, second = self.users
+        self.assertEqual(self.column('2017-01', 'user_id'),
+                         [first.id, second.id])
+        self.assertEqual(self.column('2017-01', 'date'),
+                         [(date(2017, 1, 5) - date(1970, 1, 1)).days] * 2)
+        self.assertEqual(self.column('2017-01', 'rating'), [0, 7])
+        self.assertEqual(self.column('2017-01', 'notes_length'), [0, 5])
+        self.assertEqual(self.column('2017-02', 'rating'), [3])
+
+    def test_incremental(self):
+        dump_analytics(self.directory, 'npy')
+        self.assertEqual(dump_analytics(self.directory, 'npy'), ([], []))
+
+        entry = Entry.query.filter_by(date=date(2017, 1, 5),
+                                      user_id=self.users[0].id).one()
+        entry.rating = 9
+        db.session.add(Entry(user_id=self.users[1].id, date=date(2017, 3, 1)))
+        db.session.commit()
+        self.assertEqual(dump_analytics(self.directory, 'npy'),
+                         (['2017-01', '2017-03'], []))
+        self.assertEqual(self.column('2017-01', 'rating'), [9, 7])
+
+        Entry.query.filter_by(date=date(2017, 2, 1)).delete()
+        db.session.commit()
+        self.assertEqual(dump_analytics(self.directory, 'npy'),
+                         ([], ['2017-02']))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'month=2017-02')))
+        with open(os.path.join(self.directory, STATE_FILE)) as f:
+            self.assertEqual(sorted(json.load(f)['months']),
+                             ['2017-01', '2017-03'])
+
+        written, _ = dump_analytics(self.directory, 'npy', full=True)
+        self.assertEqual(written, ['2017-01', '2017-03'])
+
+
+if __name__ == '__main__':
+    unittest.main()
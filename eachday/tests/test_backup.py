@@ -0,0 +1,130 @@
+import unittest
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import date
+
+from eachday import db
+from eachday.backup import (BackupError, IterFile, backup, restore,
+                            id_ranges, MANIFEST)
+from eachday.models import User, Entry, BlacklistToken, RefreshToken
+from eachday.tests.base import BaseTestCase, postgres_only
+from eachday.tokens import issue_refresh_token
+
+
+class TestHelpers(unittest.TestCase):
+    def test_id_ranges(self):
+        self.assertEqual(id_ranges(1, 5, 2), [(1, 2), (3, 4), (5, 5)])
+        self.assertEqual(id_ranges(None, None, 2), [])
+
+    def test_iter_file(self):
+        f = IterFile(iter(['ab', 'cde', 'f']))
+        self.assertEqual([f.read(2), f.read(3), f.read(5), f.read(1)],
+                         ['ab', 'cde', 'f', ''])
+
+
+class TestBackupRestore(BaseTestCase):
+    # Backups read through their own connection, so rows must be committed
+    transactional = False
+    workers = 1
+
+    def setUp(self):
+        super(TestBackupRestore, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        users = [User(email='user{}@bar.com'.format(i), password='test',
+                      name='joe') for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        for i, user in enumerate(users):
+            for day in range(1, i + 2):
+                db.session.add(Entry(user_id=user.id, date=date(2017, 1, day),
+                                     rating=day, notes='deja "vu",'
+                                     if day == 2 else None))
+        db.session.add(Entry(user_id=users[0].id, date=date(2017, 2, 1),
+                             notes=''))
+        db.session.add(BlacklistToken('token'))
+        issue_refresh_token(users[0].id)
+        db.session.commit()
+        self.expected = self.snapshot()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestBackupRestore, self).tearDown()
+
+    def snapshot(self):
+        tables = [User.__table__, Entry.__table__, BlacklistToken.__table__,
+                  RefreshToken.__table__]
+        rows = [[tuple(row) for row in db.session.execute(
+            table.select().order_by(table.c.id))] for table in tables]
+        db.session.rollback()
+        return rows
+
+    def empty_tables(self):
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+    def test_round_trip(self):
+        manifest = backup(self.directory, workers=self.workers, chunk_ids=2)
+        chunks = [(c['table'], c['rows']) for c in manifest['chunks']]
+        self.assertEqual(chunks, [('user', 2), ('user', 2), ('user', 1),
+                                  ('entry', 4), ('entry', 7), ('entry', 5),
+                                  ('blacklist_token', 1),
+                                  ('refresh_token', 1)])
+
+        self.empty_tables()
+        counts = restore(self.directory, workers=self.workers)
+        self.assertEqual(dict(counts), {'user': 5, 'entry': 16,
+                                        'blacklist_token': 1,
+                                        'refresh_token': 1})
+        self.assertEqual(self.snapshot(), self.expected)
+        self.assertTrue(any(i['name'] == 'ix_entry_user_id_updated_at'
+                            for i in db.inspect(db.engine)
+                            .get_indexes('entry')))
+
+        # New rows get ids after the restored ones
+        user = User(email='new@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        self.assertGreater(user.id, max(r[0] for r in self.expected[0]))
+
+    def test_restore_needs_empty_tables(self):
+        backup(self.directory, workers=self.workers)
+        with self.assertRaises(BackupError):
+            restore(self.directory, workers=self.workers)
+        with self.assertRaises(BackupError):
+            backup(self.directory, workers=self.workers)
+
+    def test_checksum_mismatch(self):
+        manifest = backup(self.directory, workers=self.workers)
+        chunk = [c for c in manifest['chunks'] if c['table'] == 'entry'][0]
+        path = os.path.join(self.directory, chunk['file'])
+        with gzip.open(path, 'rb') as f:
+            lines = f.readlines()
+        with gzip.open(path, 'wb') as f:
+            f.writelines(lines[:-1])
+
+        self.empty_tables()
+        with self.assertRaises(BackupError):
+            restore(self.directory, workers=self.workers)
+        db.session.rollback()
+        self.assertEqual(Entry.query.count(), 0)
+
+    def test_unknown_format(self):
+        backup(self.directory, workers=self.workers)
+        with open(os.path.join(self.directory, MANIFEST), 'w') as f:
+            json.dump({'format': 'other'}, f)
+        self.empty_tables()
+        with self.assertRaises(BackupError):
+            restore(self.directory)
+
+
+@postgres_only
+class TestParallelBackupRestore(TestBackupRestore):
+    workers = 2
+
+
+if __name__ == '__main__':
+    unittest.main()
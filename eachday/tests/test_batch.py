@@ -0,0 +1,129 @@
+import unittest
+import json
+from datetime import date
+
+from eachday import db
+from eachday.models import User, Entry, BlacklistToken
+from eachday.tests.base import BaseTestCase
+
+
+class TestBatchResource(BaseTestCase):
+    def setUp(self):
+        super(TestBatchResource, self).setUp()
+        user = User(
+            email='foo@bar.com',
+            password='test',
+            name='joe'
+        )
+        db.session.add(user)
+        db.session.commit()
+        self.user = user
+        self.auth_token = user.encode_auth_token(user.id).decode()
+        db.session.add(Entry(user_id=user.id, date=date(2017, 1, 1),
+                             rating=5, notes='Great day'))
+        db.session.commit()
+
+    def batch(self, payload):
+        resp = self.client.post(
+            '/batch',
+            data=json.dumps(payload),
+            headers={
+                'Authorization': 'Bearer ' + self.auth_token
+            }
+        )
+        return resp, json.loads(resp.data.decode())
+
+    def test_batch_reads(self):
+        resp, data = self.batch({'requests': [
+            {'method': 'GET', 'path': '/user'},
+            {'path': '/entry'},
+        ]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['status'], 'success')
+        user, entries = data['data']
+        self.assertEqual(user['status'], 200)
+        self.assertEqual(user['body']['data']['email'], 'foo@bar.com')
+        self.assertEqual(entries['status'], 200)
+        self.assertEqual(len(entries['body']['data']), 1)
+
+    def test_batch_writes_in_order(self):
+        resp, data = self.batch({'requests': [
+            {'method': 'POST', 'path': '/entry',
+             'body': {'date': '2017-01-02', 'rating': 3}},
+            {'method': 'GET', 'path': '/entry'},
+        ]})
+        created, entries = data['data']
+        self.assertEqual(created['status'], 201)
+        self.assertEqual(len(entries['body']['data']), 2)
+
+    def test_sub_request_errors(self):
+        resp, data = self.batch({'requests': [
+            {'path': '/entry/{}'.format(self.user.id + 1000)},
+            {'method': 'POST', 'path': '/entry', 'body': {'rating': 3}},
+            {'path': '/user'},
+        ]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([r['status'] for r in data['data']],
+                         [404, 400, 200])
+
+    def test_authenticates_once(self):
+        with self.assertMaxQueries(4):
+            self.batch({'requests': [{'path': '/entry'}] * 3})
+
+    def test_invalid_batches(self):
+        for payload in ([],
+                        {'requests': []},
+                        {'requests': [{'method': 'GET'}]},
+                        {'requests': [{'method': 'HEAD', 'path': '/user'}]},
+                        {'requests': [{'path': '/batch'}]},
+                        {'requests': [{'path': '/entry/stream'}]},
+                        {'requests': [{'path': '/entry/stream/?a=1'}]},
+                        {'requests': [{'method': 'POST', 'path': '/logout'},
+                                      {'path': '/user'}]},
+                        {'requests': [{'path': '/user'}] * 21}):
+            resp, data = self.batch(payload)
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(data['status'], 'error')
+
+    def test_blacklisted_token(self):
+        db.session.add(BlacklistToken(self.auth_token))
+        db.session.commit()
+        resp, data = self.batch({'requests': [{'path': '/user'}]})
+        self.assertEqual(resp.status_code, 401)
+
+
+class TestParallelBatch(BaseTestCase):
+    # Parallel sub-requests run on their own connections, so they need to
+    # see committed rows
+    transactional = False
+
+    def test_parallel_reads(self):
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        for day in range(1, 4):
+            db.session.add(Entry(user_id=user.id, date=date(2017, 1, day),
+                                 rating=day))
+        db.session.commit()
+        entry_ids = [e.id for e in Entry.query.order_by(Entry.date)]
+
+        resp = self.client.post(
+            '/batch',
+            data=json.dumps({
+                'parallel': True,
+                'requests': [{'path': '/entry/{}'.format(entry_id)}
+                             for entry_id in entry_ids]
+            }),
+            headers={
+                'Authorization': 'Bearer ' +
+                user.encode_auth_token(user.id).decode()
+            }
+        )
+        data = json.loads(resp.data.decode())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([r['body']['data']['id'] for r in data['data']],
+                         entry_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
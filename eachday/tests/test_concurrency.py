@@ -0,0 +1,218 @@
+import unittest
+import json
+import time
+from werkzeug.test import EnvironBuilder
+
+from eachday import app, db
+from eachday.concurrency import (AIMDLimit, ConcurrencyLimitMiddleware,
+                                 endpoint_class, get_limits)
+from eachday.models import User
+from eachday.tests.base import BaseTestCase
+
+
+class TestEndpointClass(unittest.TestCase):
+    def test_classes(self):
+        self.assertEqual(endpoint_class('POST', '/login'), 'auth')
+        self.assertEqual(endpoint_class('POST', '/register'), 'auth')
+        self.assertEqual(endpoint_class('PUT', '/user'), 'auth')
+        self.assertEqual(endpoint_class('GET', '/user'), 'reads')
+        self.assertEqual(endpoint_class('GET', '/export'), 'export')
+        self.assertEqual(endpoint_class('POST', '/export/jobs'), 'export')
+        self.assertEqual(endpoint_class('GET', '/entry'), 'reads')
+        self.assertEqual(endpoint_class('POST', '/entry'), 'writes')
+        self.assertEqual(endpoint_class('POST', '/token/refresh'), 'writes')
+        self.assertIsNone(endpoint_class('GET', '/entry/stream'))
+        self.assertIsNone(endpoint_class('POST', '/batch'))
+
+
+class TestAIMDLimit(unittest.TestCase):
+    def setUp(self):
+        self.limit = AIMDLimit('reads', 4, 2, 6, 0.1, 0.5)
+
+    def test_acquire(self):
+        self.assertTrue(all(self.limit.acquire() for _ in range(4)))
+        self.assertFalse(self.limit.acquire())
+        self.limit.release()
+        self.assertFalse(self.limit.acquire(cap=2))
+        self.assertTrue(self.limit.acquire())
+        self.assertEqual((self.limit.admitted, self.limit.shed), (5, 2))
+
+    def test_increase_when_used(self):
+        self.limit.sample(0.01, False)
+        self.assertEqual(self.limit.limit, 4)
+        for _ in range(3):
+            self.limit.acquire()
+        for _ in range(5):
+            self.limit.sample(0.01, False)
+        self.assertEqual(self.limit.limit, 6)
+        self.assertEqual(self.limit.increases, 2)
+
+    def test_decrease(self):
+        self.limit.sample(0.5, False)
+        self.assertEqual(self.limit.limit, 2)
+        self.limit.sample(0.01, True)
+        self.assertEqual(self.limit.limit, 2)
+        self.assertEqual(self.limit.decreases, 1)
+
+
+class TestMiddleware(BaseTestCase):
+    def setUp(self):
+        super(TestMiddleware, self).setUp()
+        app.config['CONCURRENCY_LIMIT_ENABLED'] = True
+        self.limits = app.config['CONCURRENCY_LIMITS']
+        app.config['CONCURRENCY_LIMITS'] = {
+            'reads': (2, 1, 2, 1000),
+            'writes': (2, 1, 2, 1000),
+            'auth': (2, 1, 2, 1000),
+            'export': (2, 1, 2, 1000),
+        }
+        app.extensions.pop('concurrency', None)
+        self.middleware = ConcurrencyLimitMiddleware(app, self.inner)
+
+    def tearDown(self):
+        app.config['CONCURRENCY_LIMIT_ENABLED'] = False
+        app.config['CONCURRENCY_LIMITS'] = self.limits
+        super(TestMiddleware, self).tearDown()
+
+    def inner(self, environ, start_response):
+        start_response(environ.get('HTTP_X_STATUS', '200 OK'), [])
+        return [b'ok']
+
+    def call(self, method, path, status=None):
+        headers = {'X-Status': status} if status else {}
+        environ = EnvironBuilder(path=path, method=method,
+                                 headers=headers).get_environ()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        body = self.middleware(environ, start_response)
+        return response, body
+
+    def hold(self, method, path):
+        """ Starts a request and returns its unclosed body """
+        return self.call(method, path)[1]
+
+    def status(self, method, path):
+        response, body = self.call(method, path)
+        if hasattr(body, 'close'):
+            body.close()
+        return response['status']
+
+    def test_sheds_over_limit(self):
+        held = [self.hold('GET', '/entry') for _ in range(2)]
+        response, body = self.call('GET', '/entry')
+        self.assertEqual(response['status'], '503 SERVICE UNAVAILABLE')
+        self.assertEqual(response['headers']['Retry-After'], '1')
+        self.assertEqual(json.loads(b''.join(body).decode()),
+                         {'status': 'error',
+                          'error': 'Service temporarily unavailable.'})
+        # Each class has its own limit
+        self.assertEqual(self.status('POST', '/entry'), '200 OK')
+
+        # Slots are held until the body is closed
+        held.pop().close()
+        self.assertEqual(self.status('GET', '/entry'), '200 OK')
+
+    def test_reads_favoured(self):
+        held = [self.hold('POST', '/login')]
+        self.assertEqual(self.status('POST', '/login'), '200 OK')
+        held += [self.hold('GET', '/entry') for _ in range(2)]
+        self.assertEqual(self.status('GET', '/entry'),
+                         '503 SERVICE UNAVAILABLE')
+        # With reads shedding, logins and exports get their minimum
+        self.assertEqual(self.status('POST', '/login'),
+                         '503 SERVICE UNAVAILABLE')
+        self.assertEqual(self.status('GET', '/export'), '200 OK')
+        held.append(self.hold('GET', '/export'))
+        self.assertEqual(self.status('GET', '/export'),
+                         '503 SERVICE UNAVAILABLE')
+
+        # Once reads stop shedding, logins get their own limit back
+        get_limits(app).classes['reads'].last_shed = time.time() - 2
+        self.assertEqual(self.status('POST', '/login'), '200 OK')
+
+    def test_overload_lowers_limit(self):
+        self.call('POST', '/entry', '503 SERVICE UNAVAILABLE')
+        self.assertAlmostEqual(get_limits(app).classes['writes'].limit, 1.8)
+
+    def test_unlimited(self):
+        held = [self.hold('GET', '/entry/stream') for _ in range(5)]
+        self.assertEqual(self.status('GET', '/entry/stream'),
+                         '200 OK')
+
+    def test_metrics(self):
+        self.status('GET', '/entry')
+        held = [self.hold('POST', '/login') for _ in range(3)]
+        app.config['CONCURRENCY_METRICS_ALLOWED_IPS'] = ('10.0.0.5',)
+        try:
+            resp = self.client.get('/metrics',
+                                   environ_base={'REMOTE_ADDR': '10.0.0.5'})
+        finally:
+            app.config['CONCURRENCY_METRICS_ALLOWED_IPS'] = ()
+        self.assertEqual(resp.status_code, 200)
+        lines = resp.data.decode().splitlines()
+        self.assertIn('# TYPE eachday_concurrency_limit gauge', lines)
+        self.assertIn('eachday_concurrency_limit{class="reads"} 2', lines)
+        self.assertIn('eachday_concurrency_inflight{class="auth"} 2', lines)
+        self.assertIn('eachday_concurrency_requests_total'
+                      '{class="auth",decision="shed"} 1', lines)
+        self.assertIn('eachday_concurrency_requests_total'
+                      '{class="reads",decision="admitted"} 1', lines)
+
+    def test_metrics_need_allowed_address_or_token(self):
+        # Closed unless configured, even to the loopback address a local
+        # reverse proxy would connect from
+        for address in ('127.0.0.1', '::1'):
+            resp = self.client.get('/metrics',
+                                   environ_base={'REMOTE_ADDR': address})
+            self.assertEqual(resp.status_code, 403)
+        remote = {'REMOTE_ADDR': '203.0.113.9'}
+        resp = self.client.get('/metrics', environ_base=remote)
+        self.assertEqual(resp.status_code, 403)
+        app.config['CONCURRENCY_METRICS_TOKEN'] = 'secret'
+        try:
+            resp = self.client.get('/metrics', environ_base=remote,
+                                   headers={'Authorization': 'Bearer nope'})
+            self.assertEqual(resp.status_code, 403)
+            resp = self.client.get('/metrics', environ_base=remote,
+                                   headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['CONCURRENCY_METRICS_TOKEN'] = None
+
+    def test_batch_sub_requests_use_their_class(self):
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        held = [self.hold('GET', '/export') for _ in range(2)]
+        resp = self.client.post('/batch', data=json.dumps({'requests': [
+            {'path': '/export'}, {'path': '/user'},
+        ]}), headers={'Authorization': 'Bearer ' +
+                      user.encode_auth_token(user.id).decode()})
+        self.assertEqual(resp.status_code, 200)
+        export, profile = json.loads(resp.data.decode())['data']
+        self.assertEqual(export['status'], 503)
+        self.assertEqual(export['body']['error'],
+                         'Service temporarily unavailable.')
+        self.assertEqual(profile['status'], 200)
+        reads = get_limits(app).classes['reads']
+        self.assertEqual((reads.admitted, reads.inflight), (1, 0))
+
+    def test_app_requests(self):
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        resp = self.client.get('/user', headers={
+            'Authorization': 'Bearer ' +
+            user.encode_auth_token(user.id).decode()
+        })
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+        reads = get_limits(app).classes['reads']
+        self.assertEqual((reads.admitted, reads.inflight), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
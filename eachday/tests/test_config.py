@@ -1,7 +1,10 @@
+import os
 import unittest
 from flask import current_app
 from flask_testing import TestCase
+from mock import patch
 from eachday import app
+from eachday.config import env_flag
 
 
 class TestDevelopmentConfig(TestCase):
@@ -38,5 +41,16 @@ class TestProductionConfig(TestCase):
         self.assertFalse(app.config['DEBUG'])
 
 
+class TestEnvFlag(unittest.TestCase):
+    def test_env_flag(self):
+        for value, expected in (('1', True), ('true', True), ('Yes', True),
+                                ('0', False), ('false', False), ('', False)):
+            with patch.dict('os.environ', {'DATABASE_PGBOUNCER': value}):
+                self.assertEqual(env_flag('DATABASE_PGBOUNCER'), expected)
+        with patch.dict('os.environ'):
+            os.environ.pop('DATABASE_PGBOUNCER', None)
+            self.assertFalse(env_flag('DATABASE_PGBOUNCER'))
+
+
 if __name__ == '__main__':
     unittest.main()
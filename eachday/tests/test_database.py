@@ -0,0 +1,261 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from eachday import app, db
+from eachday.database import recent_writes
+from eachday.models import User, profile_versions
+from eachday.querylog import QueryCounter, TRANSACTION_PREFIXES
+from eachday.tests.base import BaseTestCase, postgres_only
+from freezegun import freeze_time
+from mock import patch
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError, TimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class TestEngineOptions(BaseTestCase):
+    def engine_options(self):
+        options = {'pool_size': 5, 'pool_timeout': 5}
+        uri = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        db.apply_driver_hacks(app, uri, options)
+        return options
+
+    @postgres_only
+    def test_connect_timeout(self):
+        options = self.engine_options()
+        self.assertEqual(options['connect_args']['connect_timeout'],
+                         app.config['DATABASE_CONNECT_TIMEOUT'])
+        self.assertEqual(options['pool_size'], 5)
+
+    @postgres_only
+    def test_pgbouncer_mode(self):
+        app.config['DATABASE_PGBOUNCER'] = True
+        try:
+            options = self.engine_options()
+        finally:
+            app.config['DATABASE_PGBOUNCER'] = False
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('pool_timeout', options)
+
+    def test_pool_pre_ping(self):
+        db.session.remove()
+        app.config['SQLALCHEMY_POOL_PRE_PING'] = True
+        try:
+            with QueryCounter() as counter:
+                db.session.execute('SELECT 2')
+        finally:
+            app.config['SQLALCHEMY_POOL_PRE_PING'] = False
+        self.assertEqual(counter.statements, ['SELECT 1', 'SELECT 2'])
+
+
+@postgres_only
+class TestStatementTimeout(BaseTestCase):
+    # SET LOCAL has to be seen ending with a real transaction
+    transactional = False
+
+    def tearDown(self):
+        app.config['DATABASE_STATEMENT_TIMEOUT'] = None
+        super(TestStatementTimeout, self).tearDown()
+
+    def test_statement_timeout(self):
+        app.config['DATABASE_STATEMENT_TIMEOUT'] = 10
+        with self.assertRaises(OperationalError):
+            db.session.execute('SELECT pg_sleep(1)')
+        db.session.rollback()
+
+    def test_statement_timeout_is_transaction_local(self):
+        app.config['DATABASE_STATEMENT_TIMEOUT'] = 1234
+        timeout = db.session.execute('SHOW statement_timeout').scalar()
+        self.assertEqual(timeout, '1234ms')
+        db.session.commit()
+
+        app.config['DATABASE_STATEMENT_TIMEOUT'] = None
+        timeout = db.session.execute('SHOW statement_timeout').scalar()
+        self.assertNotEqual(timeout, '1234ms')
+
+
+class TestPoolExhaustion(BaseTestCase):
+    @patch('eachday.resources.is_blacklisted')
+    def test_pool_timeout_returns_503(self, is_blacklisted):
+        is_blacklisted.side_effect = TimeoutError('QueuePool limit reached')
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        resp = self.client.get('/export', headers={
+            'Authorization': 'Bearer ' +
+            user.encode_auth_token(user.id).decode()
+        })
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        data = json.loads(resp.data.decode())
+        self.assertEqual(data['status'], 'error')
+        self.assertEqual(data['error'], 'Service temporarily unavailable.')
+
+    def test_pool_timeout_returns_503_in_production(self):
+        # Exceptions no longer propagate, as in production, so they reach
+        # Flask-RESTful's error handling first
+        app.config.update(TESTING=False, PROPAGATE_EXCEPTIONS=False)
+        try:
+            self.test_pool_timeout_returns_503()
+        finally:
+            app.config.update(TESTING=True, PROPAGATE_EXCEPTIONS=None)
+
+
+class TestReplicaRouting(BaseTestCase):
+    # The replica engine reads over its own connection, so it only sees
+    # committed rows
+    transactional = False
+
+    def setUp(self):
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': app.config['SQLALCHEMY_DATABASE_URI']
+        }
+        db.session.remove()
+        super(TestReplicaRouting, self).setUp()
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        self.user = user
+        self.auth_token = user.encode_auth_token(user.id).decode()
+        self.replica = db.get_engine(app, bind='replica')
+        self.engines = []
+        # manage.py runs the suite inside one app context, so g.user_id
+        # may be left over from an earlier test's request
+        app.extensions.pop('ratelimit', None)
+
+    def tearDown(self):
+        super(TestReplicaRouting, self).tearDown()
+        app.config['SQLALCHEMY_BINDS'] = None
+
+    def record_engine(self, conn, cursor, statement, parameters,
+                      context, executemany):
+        self.engines.append((conn.engine, statement))
+
+    def request(self, method, path, **kwargs):
+        event.listen(Engine, 'after_cursor_execute', self.record_engine)
+        try:
+            return getattr(self.client, method)(path, headers={
+                'Authorization': 'Bearer ' + self.auth_token
+            }, **kwargs)
+        finally:
+            event.remove(Engine, 'after_cursor_execute', self.record_engine)
+
+    def replica_statements(self):
+        return [s for e, s in self.engines
+                if e is self.replica and
+                not s.startswith(TRANSACTION_PREFIXES)]
+
+    def test_reads_use_replica(self):
+        resp = self.request('get', '/entry')
+        self.assertEqual(resp.status_code, 200)
+        statements = self.replica_statements()
+        self.assertEqual(len(statements), 1)
+        self.assertIn('FROM entry', statements[0])
+
+        # The blacklist check always runs on the primary
+        primary = [s for e, s in self.engines if e is not self.replica]
+        self.assertIn('FROM blacklist_token', primary[0])
+
+    def test_writes_use_primary(self):
+        resp = self.request('post', '/entry',
+                            data=json.dumps({'rating': 5,
+                                             'date': '2017-01-01'}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.replica_statements(), [])
+
+    def test_reads_stick_to_primary_after_write(self):
+        self.request('post', '/entry',
+                     data=json.dumps({'rating': 5, 'date': '2017-01-01'}),
+                     content_type='application/json')
+        self.engines = []
+        resp = self.request('get', '/entry')
+        self.assertEqual(len(json.loads(resp.data.decode())['data']), 1)
+        self.assertEqual(self.replica_statements(), [])
+
+        # Once the window has passed, reads go back to the replica
+        with freeze_time(datetime.now() + timedelta(minutes=1)):
+            self.engines = []
+            self.request('get', '/entry')
+        self.assertEqual(len(self.replica_statements()), 1)
+
+    def test_sync_uses_primary(self):
+        resp = self.request('get', '/entry/changes')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.replica_statements(), [])
+
+    def test_replica_reads_leave_profile_version(self):
+        # A lagging replica could return an old version
+        db.session.expunge_all()
+        resp = self.request('get', '/user')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.replica_statements()), 1)
+        self.assertIsNone(profile_versions.get(self.user.id))
+
+        self.request('patch', '/user', data=json.dumps({'name': 'bob'}))
+        self.assertEqual(profile_versions.get(self.user.id), 2)
+
+    def test_sticky_writes_expire(self):
+        recent_writes.record(1)
+        self.assertTrue(recent_writes.is_recent(1, 5))
+        self.assertFalse(recent_writes.is_recent(2, 5))
+        self.assertFalse(recent_writes.is_recent(1, 0))
+        with freeze_time(datetime.now() + timedelta(minutes=1)):
+            self.assertFalse(recent_writes.is_recent(1, 5))
+
+    def test_sticky_writes_shared_between_workers(self):
+        directory = tempfile.mkdtemp()
+        app.config['RATELIMIT_STORAGE_URL'] = 'shm://' + directory + '/s'
+        try:
+            recent_writes.record(1)
+            # As seen by another worker, which maps the file itself
+            app.extensions.pop('ratelimit', None)
+            self.assertTrue(recent_writes.is_recent(1, 5))
+        finally:
+            shutil.rmtree(directory)
+            app.config['RATELIMIT_STORAGE_URL'] = 'memory://'
+            app.extensions.pop('ratelimit', None)
+
+
+class TestSQLiteMode(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_engine(self, uri):
+        options = {'pool_size': 5, 'max_overflow': 10}
+        url = make_url(uri)
+        db.apply_driver_hacks(app, url, options)
+        return create_engine(url, **options), options
+
+    def test_file_database(self):
+        path = os.path.join(self.dir, 'eachday.db')
+        engine, options = self.create_engine('sqlite:///' + path)
+        self.assertIs(options['poolclass'], QueuePool)
+        self.assertFalse(options['connect_args']['check_same_thread'])
+
+        conn = engine.connect()
+        self.assertEqual(conn.scalar('PRAGMA journal_mode'), 'wal')
+        self.assertEqual(conn.scalar('PRAGMA foreign_keys'), 1)
+        self.assertEqual(conn.scalar('PRAGMA synchronous'), 1)
+        conn.close()
+        engine.dispose()
+
+    def test_memory_database(self):
+        engine, options = self.create_engine('sqlite://')
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('max_overflow', options)
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,14 @@
+import csv
+import io
+import re
 import unittest
+from mock import patch
 
-from eachday import db
-from eachday.models import User, Entry
-from eachday.tests.base import BaseTestCase
+from eachday import app, db
+from eachday.models import User, Entry, EntrySchema
+from eachday.querylog import QueryCounter
+from eachday.tests.base import (BaseTestCase, postgres_only,
+                                test_database_uri)
 from datetime import date, timedelta
 
 import json
@@ -158,6 +164,53 @@ class TestEntryResource(BaseTestCase):
         self.assertEqual(entry1.notes, data['data']['notes'])
         self.assertEqual(resp.status_code, 200)
 
+    def test_entry_list_streamed(self):
+        for day in range(1, 8):
+            db.session.add(Entry(user_id=self.user.id, rating=day,
+                                 notes='"quoted"\n' if day % 2 else None,
+                                 date=date(2017, 1, day)))
+        db.session.commit()
+        entries = (Entry.query.filter_by(user_id=self.user.id)
+                   .order_by(Entry.date.desc()).all())
+
+        with patch('eachday.utils.STREAM_CHUNK_ITEMS', 3):
+            resp = self.client.get(
+                '/entry',
+                headers={
+                    'Authorization': 'Bearer ' + self.auth_token
+                }
+            )
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertEqual(resp.content_length, len(resp.data))
+        data = json.loads(resp.data.decode())
+        self.assertEqual(data, {
+            'status': 'success',
+            'data': EntrySchema(many=True).dump(entries).data
+        })
+
+    def test_statements_name_user_id(self):
+        """ Every entry statement can be pruned to one user's partition """
+        entry = Entry(user_id=self.user.id, rating=1, date=date(2017, 1, 1))
+        db.session.add(entry)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + self.auth_token}
+
+        with QueryCounter() as counter:
+            self.client.get('/entry', headers=headers)
+            self.client.get('/entry/{}'.format(entry.id), headers=headers)
+            self.client.put('/entry/{}'.format(entry.id), headers=headers,
+                            data=json.dumps({'rating': 2}))
+            self.client.patch('/entry/{}'.format(entry.id), headers=headers,
+                              data=json.dumps({'rating': 3}))
+            self.client.get('/export', headers=headers)
+            self.client.delete('/entry/{}'.format(entry.id),
+                               headers=headers)
+        statements = [s for s in counter.statements
+                      if re.search(r'\b(FROM|UPDATE) entry\b', s)]
+        self.assertGreaterEqual(len(statements), 6)
+        for statement in statements:
+            self.assertIn('entry.user_id =', statement)
+
     def test_entry_editing(self):
         entry1 = Entry(user_id=self.user.id,
                        rating=1,
@@ -186,6 +239,78 @@ class TestEntryResource(BaseTestCase):
         self.assertEqual('changed', data['data']['notes'])
         self.assertEqual(resp.status_code, 200)
 
+    def patch_entry(self, entry_id, data, auth_token=None):
+        resp = self.client.patch(
+            '/entry/{}'.format(entry_id),
+            data=json.dumps(data),
+            headers={
+                'Authorization': 'Bearer ' + (auth_token or self.auth_token)
+            },
+            content_type='application/json'
+        )
+        return resp, json.loads(resp.data.decode())
+
+    def test_entry_patch(self):
+        entry = Entry(user_id=self.user.id, rating=1, notes='foobar',
+                      date=date(2017, 1, 1))
+        other = Entry(user_id=self.user.id, date=date(2017, 1, 2))
+        db.session.add_all([entry, other])
+        db.session.commit()
+        entry_id, updated_at = entry.id, entry.updated_at
+
+        resp, data = self.patch_entry(entry_id, {'rating': 7})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['data'], {
+            'id': entry_id, 'user_id': self.user.id, 'date': '2017-01-01',
+            'notes': 'foobar', 'rating': 7
+        })
+        db.session.expire_all()
+        entry = Entry.query.get((entry_id, self.user.id))
+        self.assertEqual(entry.rating, 7)
+        self.assertGreater(entry.updated_at, updated_at)
+
+        resp, data = self.patch_entry(entry_id, {'rating': 0})
+        self.assertIsNone(data['data']['rating'])
+
+        # Only the supplied fields are validated, and ids can't be changed
+        resp, data = self.patch_entry(entry_id, {'notes': 'new',
+                                                 'user_id': self.user2.id})
+        self.assertEqual(data['data']['notes'], 'new')
+        self.assertEqual(data['data']['user_id'], self.user.id)
+
+    def test_reject_bad_entry_patches(self):
+        entry = Entry(user_id=self.user.id, date=date(2017, 1, 1))
+        other = Entry(user_id=self.user.id, date=date(2017, 1, 2))
+        db.session.add_all([entry, other])
+        db.session.commit()
+
+        resp, data = self.patch_entry(entry.id, {'rating': 11})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('rating', data['error'])
+        resp, data = self.patch_entry(entry.id, {'date': '2017-01-02'})
+        self.assertEqual(data['error'],
+                         'An entry for this date already exists!')
+        resp, data = self.patch_entry(entry.id, {})
+        self.assertEqual(data['error'], 'No fields to update')
+
+        user2_token = self.user2.encode_auth_token(self.user2.id).decode()
+        resp, data = self.patch_entry(entry.id, {'rating': 5}, user2_token)
+        self.assertEqual(resp.status_code, 404)
+        self.assertIsNone(Entry.query.get((entry.id, self.user.id)).rating)
+
+    @postgres_only
+    def test_entry_patch_is_one_statement(self):
+        entry = Entry(user_id=self.user.id, date=date(2017, 1, 1))
+        db.session.add(entry)
+        db.session.commit()
+        entry_id = entry.id
+
+        with QueryCounter() as counter:
+            self.patch_entry(entry_id, {'notes': 'autosaved'})
+        statements = [s for s in counter.statements if 'entry' in s]
+        self.assertEqual(len(statements), 1)
+        self.assertRegexpMatches(statements[0], r'^UPDATE entry .*RETURNING')
+
     def test_reject_unauthorized_edits(self):
         entry1 = Entry(user_id=self.user.id,
                        rating=1,
@@ -321,18 +446,69 @@ class TestEntryResource(BaseTestCase):
         db.session.add(entry2)
         db.session.commit()
 
-        resp = self.client.get(
-            '/export',
-            headers={
-                'Authorization': 'Bearer ' + self.auth_token
-            }
-        )
-        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
-        self.assertEqual(resp.status_code, 200)
+        def export():
+            resp = self.client.get(
+                '/export',
+                headers={
+                    'Authorization': 'Bearer ' + self.auth_token
+                }
+            )
+            self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+            self.assertEqual(resp.status_code, 200)
+            return resp.data.decode()
+
         expected = ('Date,Rating,Notes\r\n'
                     '2017-01-01,1,foobar\r\n'
                     '2017-01-02,5,deadbeef\r\n')
-        self.assertEqual(resp.data.decode(), expected)
+        app.config['EXPORT_COPY'] = False
+        self.assertEqual(export(), expected)
+        if test_database_uri.startswith('postgresql'):
+            # Postgres' COPY ends lines with \n
+            app.config['EXPORT_COPY'] = True
+            self.assertEqual(export(), expected.replace('\r\n', '\n'))
+
+    @postgres_only
+    def test_copy_export_matches_csv_writer(self):
+        notes = ['', None, 'a, "quoted"\nline', 'plain']
+        for i, note in enumerate(notes):
+            db.session.add(Entry(user_id=self.user.id, notes=note,
+                                 rating=i or None, date=date(2017, 1, i + 1)))
+        db.session.add(Entry(user_id=self.user2.id, date=date(2017, 1, 1)))
+        db.session.commit()
+
+        def export():
+            resp = self.client.get('/export', headers={
+                'Authorization': 'Bearer ' + self.auth_token
+            })
+            self.assertEqual(resp.status_code, 200)
+            return list(csv.reader(io.StringIO(resp.data.decode())))
+
+        with patch('eachday.resources.export_rows') as export_rows:
+            copied = export()
+        self.assertFalse(export_rows.called)
+        app.config['EXPORT_COPY'] = False
+        self.assertEqual(copied, export())
+        self.assertEqual(len(copied), 5)
+
+    @postgres_only
+    def test_copy_export_spooled(self):
+        for day in range(1, 31):
+            db.session.add(Entry(user_id=self.user.id, notes='x' * 100,
+                                 date=date(2017, 1, day)))
+        db.session.commit()
+        with patch('eachday.utils.SPOOL_MEMORY_BYTES', 1000):
+            resp = self.client.get('/export', buffered=False, headers={
+                'Authorization': 'Bearer ' + self.auth_token
+            })
+        # COPY has written the whole CSV before any of it is sent
+        length = resp.content_length
+        body = b''.join(resp.response)
+        resp.close()
+        self.assertEqual(len(body), length)
+        self.assertEqual(body.count(b'\n'), 31)
+        # The connection is usable again
+        self.assertEqual(Entry.query.filter_by(user_id=self.user.id)
+                         .count(), 30)
 
     def test_handle_reject_new_entry_on_day_with_entry(self):
         # Test rejecting a new entry that occurs on a date
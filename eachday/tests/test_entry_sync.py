@@ -0,0 +1,114 @@
+import unittest
+import json
+from datetime import date, datetime, timedelta
+
+from eachday import app, db
+from eachday.models import User, Entry, EntryTombstone, encode_sync_cursor
+from eachday.tests.base import BaseTestCase
+
+
+class TestEntryChanges(BaseTestCase):
+    def setUp(self):
+        super(TestEntryChanges, self).setUp()
+        # Cursors are exact in these tests, which run one request at a time
+        app.config['SYNC_CURSOR_OVERLAP'] = 0
+        user = User(
+            email='foo@bar.com',
+            password='test',
+            name='joe'
+        )
+        db.session.add(user)
+        db.session.commit()
+        self.user = user
+        self.auth_token = user.encode_auth_token(user.id).decode()
+
+    def tearDown(self):
+        app.config['SYNC_CURSOR_OVERLAP'] = 5
+        super(TestEntryChanges, self).tearDown()
+
+    def get_changes(self, since=None):
+        resp = self.client.get(
+            '/entry/changes',
+            query_string={'since': since} if since else {},
+            headers={
+                'Authorization': 'Bearer ' + self.auth_token
+            }
+        )
+        return resp, json.loads(resp.data.decode())
+
+    def add_entry(self, day, **kwargs):
+        entry = Entry(user_id=self.user.id, date=date(2017, 1, day),
+                      **kwargs)
+        db.session.add(entry)
+        db.session.commit()
+        return entry
+
+    def test_initial_sync(self):
+        entry = self.add_entry(1, rating=5)
+        resp, data = self.get_changes()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['status'], 'success')
+        self.assertTrue(data['data']['reset'])
+        self.assertEqual([e['id'] for e in data['data']['entries']],
+                         [entry.id])
+        self.assertEqual(data['data']['deleted'], [])
+        self.assertIn('cursor', data['data'])
+
+    def test_only_changes_since_cursor(self):
+        unchanged = self.add_entry(1, rating=5)
+        edited = self.add_entry(2, rating=5)
+        deleted = self.add_entry(3, rating=5)
+        _, data = self.get_changes()
+        cursor = data['data']['cursor']
+
+        created = self.add_entry(4, rating=5)
+        self.client.put(
+            '/entry/{}'.format(edited.id),
+            data=json.dumps({'rating': 9}),
+            content_type='application/json',
+            headers={'Authorization': 'Bearer ' + self.auth_token}
+        )
+        self.client.delete(
+            '/entry/{}'.format(deleted.id),
+            headers={'Authorization': 'Bearer ' + self.auth_token}
+        )
+
+        resp, data = self.get_changes(cursor)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(data['data']['reset'])
+        changed = dict((e['id'], e) for e in data['data']['entries'])
+        self.assertEqual(sorted(changed), sorted([created.id, edited.id]))
+        self.assertNotIn(unchanged.id, changed)
+        self.assertEqual(changed[edited.id]['rating'], 9)
+        self.assertEqual(data['data']['deleted'], [deleted.id])
+
+    def test_other_users_changes_hidden(self):
+        other = User(email='baz@bar.com', password='test', name='moe')
+        db.session.add(other)
+        db.session.commit()
+        _, data = self.get_changes()
+        cursor = data['data']['cursor']
+
+        db.session.add(Entry(user_id=other.id, date=date(2017, 1, 1)))
+        db.session.add(EntryTombstone(entry_id=42, user_id=other.id))
+        db.session.commit()
+        _, data = self.get_changes(cursor)
+        self.assertEqual(data['data']['entries'], [])
+        self.assertEqual(data['data']['deleted'], [])
+
+    def test_expired_cursor_resets(self):
+        entry = self.add_entry(1, rating=5)
+        old = encode_sync_cursor(datetime.utcnow() - timedelta(days=365))
+        _, data = self.get_changes(old)
+        self.assertTrue(data['data']['reset'])
+        self.assertEqual([e['id'] for e in data['data']['entries']],
+                         [entry.id])
+
+    def test_invalid_cursor(self):
+        resp, data = self.get_changes('yesterday')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(data['error'], 'Invalid cursor')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import json
+from datetime import date
+
+from eachday import app, db
+from eachday.events import (EventBus, event_payload, publish_entry, get_bus,
+                            stream_events, MAX_PAYLOAD_BYTES)
+from eachday.models import User, Entry
+from eachday.tests.base import BaseTestCase, postgres_only
+
+
+class TestEventBus(unittest.TestCase):
+    def test_dispatch_by_user(self):
+        bus = EventBus(app, listen=False)
+        mine, other = bus.subscribe(1), bus.subscribe(2)
+        bus.dispatch(event_payload(1, 'entry.deleted', entry_id=5))
+        self.assertEqual(json.loads(mine.queue.get_nowait())['id'], 5)
+        self.assertTrue(other.queue.empty())
+
+        bus.unsubscribe(mine)
+        bus.unsubscribe(other)
+        self.assertEqual(dict(bus.subscriptions), {})
+
+    def test_slow_client_resyncs(self):
+        bus = EventBus(app, listen=False)
+        subscription = bus.subscribe(1)
+        for i in range(app.config['EVENTS_QUEUE_SIZE'] + 1):
+            bus.dispatch(event_payload(1, 'entry.deleted', entry_id=i))
+        events = stream_events(subscription, keepalive=0)
+        self.assertEqual(next(events), 'retry: 5000\n\n')
+        self.assertEqual(next(events), 'event: resync\ndata: {}\n\n')
+        self.assertEqual(next(events), 'event: entry.deleted\n'
+                                       'data: {"id": 0, '
+                                       '"type": "entry.deleted"}\n\n')
+
+    def test_large_entries_sent_by_id(self):
+        entry = {'id': 3, 'notes': 'x' * MAX_PAYLOAD_BYTES}
+        payload = json.loads(event_payload(1, 'entry.updated', entry))
+        self.assertEqual(payload, {'user_id': 1, 'type': 'entry.updated',
+                                   'id': 3})
+
+
+class TestEntryStream(BaseTestCase):
+    def setUp(self):
+        super(TestEntryStream, self).setUp()
+        app.config['EVENTS_BACKEND'] = 'local'
+        self.user = User(email='foo@bar.com', password='test', name='joe')
+        self.other = User(email='baz@bar.com', password='test', name='moe')
+        db.session.add_all([self.user, self.other])
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, self.other.id
+        self.headers = {'Authorization': 'Bearer ' +
+                        self.user.encode_auth_token(self.user.id).decode()}
+
+    def test_stream(self):
+        stream = self.client.get('/entry/stream', headers=self.headers,
+                                 buffered=False)
+        self.assertEqual(stream.mimetype, 'text/event-stream')
+        events = iter(stream.response)
+        self.assertEqual(next(events), b'retry: 5000\n\n')
+
+        db.session.add(Entry(user_id=self.other_id, date=date(2017, 1, 1)))
+        db.session.commit()
+        resp = self.client.post('/entry', headers=self.headers,
+                                data=json.dumps({'date': '2017-01-01'}))
+        entry_id = json.loads(resp.data.decode())['data']['id']
+        self.client.patch('/entry/{}'.format(entry_id), headers=self.headers,
+                          data=json.dumps({'rating': 3}))
+        self.client.delete('/entry/{}'.format(entry_id),
+                           headers=self.headers)
+
+        received = []
+        for _ in range(3):
+            lines = next(events).decode().splitlines()
+            received.append((lines[0], json.loads(lines[1][len('data: '):])))
+        self.assertEqual([name for name, _ in received],
+                         ['event: entry.created', 'event: entry.updated',
+                          'event: entry.deleted'])
+        self.assertEqual(received[0][1]['entry']['date'], '2017-01-01')
+        self.assertEqual(received[1][1]['entry']['rating'], 3)
+        self.assertEqual(received[2][1], {'id': entry_id,
+                                          'type': 'entry.deleted'})
+        stream.close()
+        self.assertNotIn(self.user_id, get_bus(app).subscriptions)
+
+    def test_rolled_back_writes_not_sent(self):
+        bus = get_bus(app)
+        subscription = bus.subscribe(self.user.id)
+        try:
+            entry = Entry(user_id=self.user.id, date=date(2017, 1, 1))
+            db.session.add(entry)
+            db.session.flush()
+            publish_entry(self.user.id, 'entry.created', entry)
+            db.session.rollback()
+            self.assertTrue(subscription.queue.empty())
+        finally:
+            bus.unsubscribe(subscription)
+
+
+@postgres_only
+class TestNotify(BaseTestCase):
+    # NOTIFY is only delivered once the transaction really commits
+    transactional = False
+
+    def test_listen_notify(self):
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        bus = get_bus(app)
+        subscription = bus.subscribe(user.id)
+        try:
+            entry = Entry(user_id=user.id, date=date(2017, 1, 1), rating=4)
+            db.session.add(entry)
+            db.session.flush()
+            publish_entry(user.id, 'entry.created', entry)
+            db.session.commit()
+            payload = json.loads(subscription.queue.get(timeout=5))
+        finally:
+            bus.unsubscribe(subscription)
+        self.assertEqual(payload['type'], 'entry.created')
+        self.assertEqual(payload['entry']['rating'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
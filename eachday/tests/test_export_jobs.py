@@ -0,0 +1,165 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+from sqlalchemy import event
+
+from eachday import app, db
+from eachday.exports import run_worker
+from eachday.models import User, Entry, ExportJob
+from eachday.tests.base import BaseTestCase, postgres_only
+
+
+class TestExportJobs(BaseTestCase):
+    def setUp(self):
+        super(TestExportJobs, self).setUp()
+        self.export_dir = tempfile.mkdtemp()
+        self.old_export_dir = app.config['EXPORT_DIR']
+        app.config['EXPORT_DIR'] = self.export_dir
+        user = User(
+            email='foo@bar.com',
+            password='test',
+            name='joe'
+        )
+        db.session.add(user)
+        db.session.commit()
+        self.user = user
+        self.auth_token = user.encode_auth_token(user.id).decode()
+        db.session.add(Entry(user_id=user.id, date=date(2017, 1, 1),
+                             rating=5, notes='Great day'))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['EXPORT_DIR'] = self.old_export_dir
+        shutil.rmtree(self.export_dir)
+        super(TestExportJobs, self).tearDown()
+
+    def request(self, method, url, **kwargs):
+        headers = kwargs.pop('headers', {})
+        headers['Authorization'] = 'Bearer ' + self.auth_token
+        return getattr(self.client, method)(url, headers=headers, **kwargs)
+
+    def create_job(self):
+        resp = self.request('post', '/export/jobs')
+        return resp, json.loads(resp.data.decode())
+
+    def test_create_job(self):
+        resp, data = self.create_job()
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(data['data']['status'], ExportJob.PENDING)
+
+        # Asking again while it is queued returns the same job
+        resp, again = self.create_job()
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(again['data']['id'], data['data']['id'])
+
+    def test_process_and_download(self):
+        resp, data = self.create_job()
+        job_id = data['data']['id']
+
+        resp = self.request('get', '/export/jobs/{}/artifact'.format(job_id))
+        self.assertEqual(resp.status_code, 409)
+
+        run_worker(once=True)
+
+        resp = self.request('get', '/export/jobs/{}'.format(job_id))
+        data = json.loads(resp.data.decode())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['data']['status'], ExportJob.DONE)
+
+        resp = self.request('get', '/export/jobs/{}/artifact'.format(job_id))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(resp.data.decode(),
+                         'Date,Rating,Notes\r\n2017-01-01,5,Great day\r\n')
+        resp.close()
+
+    def test_range_request(self):
+        resp, data = self.create_job()
+        run_worker(once=True)
+        resp = self.request(
+            'get', '/export/jobs/{}/artifact'.format(data['data']['id']),
+            headers={'Range': 'bytes=0-3'}
+        )
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data.decode(), 'Date')
+        resp.close()
+
+    def test_unchanged_data_reuses_artifact(self):
+        resp, data = self.create_job()
+        run_worker(once=True)
+
+        resp, again = self.create_job()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(again['data']['id'], data['data']['id'])
+        self.assertEqual(ExportJob.query.count(), 1)
+
+    def test_changed_data_queues_new_export(self):
+        resp, data = self.create_job()
+        run_worker(once=True)
+        db.session.add(Entry(user_id=self.user.id, date=date(2017, 1, 2),
+                             rating=3))
+        db.session.commit()
+
+        resp, again = self.create_job()
+        self.assertEqual(resp.status_code, 202)
+        self.assertNotEqual(again['data']['id'], data['data']['id'])
+
+        run_worker(once=True)
+        user_dir = os.path.join(self.export_dir, str(self.user.id))
+        # The artifact for the old version is replaced
+        self.assertEqual(len(os.listdir(user_dir)), 1)
+
+    def test_other_users_job(self):
+        resp, data = self.create_job()
+        other = User(email='other@bar.com', password='test', name='bob')
+        db.session.add(other)
+        db.session.commit()
+        self.auth_token = other.encode_auth_token(other.id).decode()
+
+        resp = self.request('get',
+                            '/export/jobs/{}'.format(data['data']['id']))
+        self.assertEqual(resp.status_code, 404)
+
+
+class TestConcurrentExportJobs(BaseTestCase):
+    # The competing job is committed through another connection
+    transactional = False
+
+    @postgres_only
+    def test_concurrent_requests_share_a_job(self):
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        competing = []
+
+        def queue_competing_job(session, context, instances):
+            # Another request queues a job after this one found none
+            if competing:
+                return
+            with db.engine.begin() as connection:
+                result = connection.execute(
+                    ExportJob.__table__.insert().values(
+                        user_id=user.id, status=ExportJob.PENDING,
+                        created_at=datetime.utcnow()))
+            competing.append(result.inserted_primary_key[0])
+
+        session = db.session()
+        event.listen(session, 'before_flush', queue_competing_job)
+        try:
+            resp = self.client.post('/export/jobs', headers={
+                'Authorization': 'Bearer ' +
+                user.encode_auth_token(user.id).decode()
+            })
+        finally:
+            event.remove(session, 'before_flush', queue_competing_job)
+        self.assertEqual(resp.status_code, 202)
+        data = json.loads(resp.data.decode())
+        self.assertEqual(data['data']['id'], competing[0])
+        self.assertEqual(ExportJob.query.count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import json
+import logging
+import sys
+from six.moves import queue
+
+from eachday.log import JSONFormatter, QueueHandler
+
+
+class TestJSONFormatter(unittest.TestCase):
+    def make_record(self, msg, args, exc_info=None):
+        return logging.LogRecord('eachday', logging.INFO, __file__, 1,
+                                 msg, args, exc_info)
+
+    def test_json_output(self):
+        record = self.make_record('Created new entry %s', (42,))
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual(data['message'], 'Created new entry 42')
+        self.assertEqual(data['level'], 'INFO')
+        self.assertEqual(data['logger'], 'eachday')
+        self.assertIn('timestamp', data)
+        self.assertNotIn('exception', data)
+
+    def test_json_exception(self):
+        try:
+            raise ValueError('Uh oh')
+        except ValueError:
+            record = self.make_record('Failed', (), sys.exc_info())
+        data = json.loads(JSONFormatter().format(record))
+        self.assertIn('ValueError: Uh oh', data['exception'])
+
+
+@unittest.skipIf(QueueHandler is None, 'Queue handlers need Python 3')
+class TestLazyQueueHandler(unittest.TestCase):
+    def test_record_not_formatted_on_caller(self):
+        from eachday.log import LazyQueueHandler
+
+        class Unformattable(object):
+            def __str__(self):
+                raise AssertionError('Formatted on the request thread')
+
+        records = queue.Queue()
+        LazyQueueHandler(records).handle(logging.LogRecord(
+            'eachday', logging.INFO, __file__, 1, '%s', (Unformattable(),),
+            None
+        ))
+        record = records.get_nowait()
+        self.assertEqual(record.msg, '%s')
+
+    def test_full_queue_drops_records(self):
+        from eachday.log import LazyQueueHandler
+        records = queue.Queue(1)
+        handler = LazyQueueHandler(records)
+        dropped = LazyQueueHandler.dropped
+        for i in range(3):
+            handler.handle(logging.LogRecord(
+                'eachday', logging.INFO, __file__, 1, 'msg', (), None
+            ))
+        self.assertEqual(records.qsize(), 1)
+        self.assertEqual(LazyQueueHandler.dropped, dropped + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
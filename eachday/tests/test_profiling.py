@@ -0,0 +1,103 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+from eachday import app, db
+from eachday.models import User
+from eachday.profiling import (PROFILE_HEADER, profile_header_value,
+                               valid_signature, collapse, tracemalloc)
+from eachday.tests.base import BaseTestCase
+
+
+class TestSignature(unittest.TestCase):
+    def test_valid_signature(self):
+        value = profile_header_value('secret')
+        self.assertTrue(valid_signature(value, 'secret', 60))
+        self.assertFalse(valid_signature(value, 'other', 60))
+        self.assertFalse(valid_signature('garbage', 'secret', 60))
+
+    def test_expired_signature(self):
+        value = profile_header_value('secret', time.time() - 120)
+        self.assertFalse(valid_signature(value, 'secret', 60))
+
+    def test_collapse(self):
+        def inner():
+            import sys
+            return collapse(sys._getframe())
+        stack = inner().split(';')
+        self.assertTrue(stack[-1].startswith('inner (test_profiling.py:'))
+        self.assertTrue(stack[-2].startswith('test_collapse '))
+
+
+class TestRequestProfiling(BaseTestCase):
+    def setUp(self):
+        super(TestRequestProfiling, self).setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        app.config['PROFILE_DIR'] = self.profile_dir
+        app.config['PROFILE_ENABLED'] = True
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        self.auth_token = user.encode_auth_token(user.id).decode()
+
+    def tearDown(self):
+        app.config['PROFILE_ENABLED'] = False
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        shutil.rmtree(self.profile_dir)
+        super(TestRequestProfiling, self).tearDown()
+
+    def get_entries(self, **headers):
+        headers['Authorization'] = 'Bearer ' + self.auth_token
+        return self.client.get('/entry', headers=headers)
+
+    def test_signed_header(self):
+        resp = self.get_entries(**{
+            PROFILE_HEADER: profile_header_value(app.config['SECRET_KEY'])
+        })
+        self.assertEqual(resp.status_code, 200)
+        name = resp.headers['X-Profile-Id']
+        self.assertIn('GET-entry', name)
+        files = sorted(os.listdir(self.profile_dir))
+        expected = [name + '.cpu.folded']
+        if tracemalloc is not None:
+            expected.insert(0, name + '.alloc.folded')
+            with open(os.path.join(self.profile_dir, expected[0])) as f:
+                line = f.readline()
+            self.assertRegexpMatches(line, r'^\S.*:\d+ \d+$')
+        self.assertEqual(files, expected)
+
+    def test_invalid_header(self):
+        resp = self.get_entries(**{PROFILE_HEADER: '1:nope'})
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_disabled(self):
+        app.config['PROFILE_ENABLED'] = False
+        resp = self.get_entries(**{
+            PROFILE_HEADER: profile_header_value(app.config['SECRET_KEY'])
+        })
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_sample_rate(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.assertIn('X-Profile-Id', self.get_entries().headers)
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        self.assertNotIn('X-Profile-Id', self.get_entries().headers)
+
+    def test_event_stream_not_profiled(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        stream = self.client.get('/entry/stream', buffered=False, headers={
+            'Authorization': 'Bearer ' + self.auth_token
+        })
+        self.assertNotIn('X-Profile-Id', stream.headers)
+        self.assertEqual(next(iter(stream.response)), b'retry: 5000\n\n')
+        stream.close()
+        # Other requests can still be profiled
+        self.assertIn('X-Profile-Id', self.get_entries().headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from datetime import date
+
+from eachday import db
+from eachday.models import User, Entry, BlacklistToken
+from eachday.queries import (is_blacklisted, get_user, get_user_by_email,
+                             get_entry, iter_entry_rows)
+from eachday.tests.base import BaseTestCase
+
+
+class TestQueries(BaseTestCase):
+    def setUp(self):
+        super(TestQueries, self).setUp()
+        self.user = User(email='foo@bar.com', password='test', name='joe')
+        self.other = User(email='other@bar.com', password='test', name='bob')
+        db.session.add_all([self.user, self.other])
+        db.session.commit()
+        for day in (1, 2):
+            db.session.add(Entry(user_id=self.user.id,
+                                 date=date(2017, 1, day)))
+        db.session.commit()
+
+    def test_lookups(self):
+        self.assertFalse(is_blacklisted('token'))
+        db.session.add(BlacklistToken('token'))
+        db.session.commit()
+        self.assertTrue(is_blacklisted('token'))
+
+        self.assertEqual(get_user_by_email('foo@bar.com').id, self.user.id)
+        self.assertIsNone(get_user_by_email('nobody@bar.com'))
+
+        entries = list(iter_entry_rows(self.user.id))
+        self.assertEqual([e['date'] for e in entries],
+                         ['2017-01-02', '2017-01-01'])
+        self.assertEqual(list(iter_entry_rows(self.other.id)), [])
+        entry = get_entry(self.user.id, entries[0]['id'])
+        self.assertEqual(entry.date, date(2017, 1, 2))
+        self.assertIsNone(get_entry(self.other.id, entries[0]['id']))
+
+    def test_get_user_uses_identity_map(self):
+        user_id = self.user.id
+        db.session.expunge_all()
+        user = get_user(user_id)
+        with self.assertMaxQueries(0):
+            self.assertIs(get_user(user_id), user)
+        self.assertIsNone(get_user(user_id + 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
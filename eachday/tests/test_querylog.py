@@ -0,0 +1,124 @@
+import unittest
+import json
+from datetime import date
+
+from eachday import app, db
+from eachday.models import User, Entry
+from eachday.tests.base import BaseTestCase
+from mock import patch
+from sqlalchemy.exc import DBAPIError
+
+
+class TestQueryBudgets(BaseTestCase):
+    def setUp(self):
+        super(TestQueryBudgets, self).setUp()
+        user = User(
+            email='foo@bar.com',
+            password='test',
+            name='joe'
+        )
+        db.session.add(user)
+        db.session.commit()
+        self.user = user
+        self.auth_token = user.encode_auth_token(user.id).decode()
+        entry = Entry(user_id=user.id, rating=5, date=date(2017, 1, 1))
+        db.session.add(entry)
+        db.session.commit()
+        self.entry_id = entry.id
+
+    def auth_headers(self):
+        return {'Authorization': 'Bearer ' + self.auth_token}
+
+    def test_user_get_budget(self):
+        with self.assertMaxQueries(2):
+            resp = self.client.get('/user', headers=self.auth_headers())
+        self.assertEqual(resp.status_code, 200)
+
+    def test_entry_list_budget(self):
+        with self.assertMaxQueries(2):
+            resp = self.client.get('/entry', headers=self.auth_headers())
+        self.assertEqual(resp.status_code, 200)
+
+    def test_entry_create_budget(self):
+        # Writes include a NOTIFY for GET /entry/stream on Postgres
+        with self.assertMaxQueries(4):
+            resp = self.client.post(
+                '/entry',
+                data=json.dumps({'rating': 5, 'date': '2017-01-02'}),
+                content_type='application/json',
+                headers=self.auth_headers()
+            )
+        self.assertEqual(resp.status_code, 201)
+
+    def test_entry_edit_budget(self):
+        # Writes include a NOTIFY for GET /entry/stream on Postgres
+        with self.assertMaxQueries(5):
+            resp = self.client.put(
+                '/entry/{}'.format(self.entry_id),
+                data=json.dumps({'rating': 7}),
+                content_type='application/json',
+                headers=self.auth_headers()
+            )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_export_budget(self):
+        with self.assertMaxQueries(2):
+            resp = self.client.get('/export', headers=self.auth_headers())
+        self.assertEqual(resp.status_code, 200)
+
+    def test_budget_failure(self):
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(0):
+                self.client.get('/entry', headers=self.auth_headers())
+
+
+class TestSlowQueryLog(BaseTestCase):
+    def setUp(self):
+        super(TestSlowQueryLog, self).setUp()
+        app.config['SLOW_QUERY_THRESHOLD'] = 0
+        app.config['SLOW_QUERY_EXPLAIN'] = True
+
+    def tearDown(self):
+        app.config['SLOW_QUERY_THRESHOLD'] = None
+        app.config['SLOW_QUERY_EXPLAIN'] = False
+        super(TestSlowQueryLog, self).tearDown()
+
+    @patch('eachday.querylog.log')
+    def test_slow_query_logged_with_plan(self, LogMock):
+        User.query.filter_by(email='foo@bar.com').first()
+        messages = [c[0][0] for c in LogMock.warning.call_args_list]
+        self.assertIn('Slow query (%.3fs): %s %r', messages)
+        self.assertIn('Query plan:\n%s', messages)
+
+    @patch('eachday.querylog.log')
+    def test_request_over_budget_logged(self, LogMock):
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        auth_token = user.encode_auth_token(user.id).decode()
+
+        budget = app.config['QUERY_BUDGET']
+        app.config['QUERY_BUDGET'] = 0
+        try:
+            self.client.get('/entry', headers={
+                'Authorization': 'Bearer ' + auth_token
+            })
+        finally:
+            app.config['QUERY_BUDGET'] = budget
+        messages = [c[0][0] for c in LogMock.warning.call_args_list]
+        self.assertIn('Request %s %s ran %d queries (budget is %d)',
+                      messages)
+
+
+class TestQueryTiming(BaseTestCase):
+    def test_failed_statements_leave_no_start_time(self):
+        with db.engine.connect() as connection:
+            for _ in range(3):
+                with self.assertRaises(DBAPIError):
+                    connection.execute('SELECT * FROM no_such_table')
+            connection.execute('SELECT 1')
+            self.assertEqual(connection.info['query_start_time'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
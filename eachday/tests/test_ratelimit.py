@@ -0,0 +1,187 @@
+import unittest
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from freezegun import freeze_time
+
+from eachday import app
+from eachday.ratelimit import (refill, create_store, MemoryStore,
+                               SharedMemoryStore)
+from eachday.tests.base import BaseTestCase
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_refill(self):
+        # Full bucket hands out a token
+        self.assertEqual(refill(3, 0, 0, 3, 1), (2, 0))
+        # Empty bucket reports how long until the next token
+        self.assertEqual(refill(0, 0, 0.5, 3, 1), (0.5, 0.5))
+        # Refilling never goes past the burst capacity
+        self.assertEqual(refill(0, 0, 100, 3, 1), (2, 0))
+
+    def test_create_store(self):
+        self.assertIsInstance(create_store('memory://'), MemoryStore)
+        store = create_store('shm:///tmp/eachday-ratelimit-test')
+        self.assertIsInstance(store, SharedMemoryStore)
+        self.assertEqual(store.path, '/tmp/eachday-ratelimit-test')
+        with self.assertRaises(ValueError):
+            create_store('carrier-pigeon://')
+
+    def test_memory_store(self):
+        store = MemoryStore()
+        self.assertEqual(store.consume('a', 2, 0.001), 0)
+        self.assertEqual(store.consume('a', 2, 0.001), 0)
+        self.assertGreater(store.consume('a', 2, 0.001), 0)
+        self.assertEqual(store.consume('b', 2, 0.001), 0)
+
+    def test_memory_store_values(self):
+        store = MemoryStore()
+        self.assertIsNone(store.get_value('a'))
+        store.raise_value('a', 2, 60)
+        store.raise_value('a', 1, 60)
+        self.assertEqual(store.get_value('a'), 2)
+        with freeze_time(datetime.now() + timedelta(minutes=2)):
+            self.assertIsNone(store.get_value('a'))
+            # Expired values are swept out as others are set
+            store.raise_value('b', 1, 60)
+            store.raise_value('a', 1, 60)
+        self.assertEqual(store.get_value('a'), 1)
+        self.assertEqual(sorted(store._values), ['a', 'b'])
+        with freeze_time(datetime.now() + timedelta(minutes=5)):
+            store.raise_value('c', 1, 60)
+        self.assertEqual(list(store._values), ['c'])
+
+
+def consume_from_worker(path, results):
+    store = SharedMemoryStore(path, slots=16)
+    results.put(store.consume('login:ip:1.2.3.4', 5, 0.001))
+
+
+class TestSharedMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'buckets')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared_between_processes(self):
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=consume_from_worker,
+                                           args=(self.path, results))
+                   for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        retry_afters = [results.get() for _ in workers]
+        self.assertEqual(retry_afters.count(0), 5)
+        store = SharedMemoryStore(self.path, slots=16)
+        self.assertGreater(store.consume('login:ip:1.2.3.4', 5, 0.001), 0)
+
+    def test_values(self):
+        store = SharedMemoryStore(self.path, slots=16)
+        store.raise_value('version:1', 3, 60)
+        store.raise_value('version:1', 2, 60)
+        other = SharedMemoryStore(self.path, slots=16)
+        self.assertEqual(other.get_value('version:1'), 3)
+        self.assertIsNone(other.get_value('version:2'))
+        with freeze_time(datetime.now() + timedelta(minutes=2)):
+            self.assertIsNone(other.get_value('version:1'))
+
+
+class TestRateLimitedResources(BaseTestCase):
+    def setUp(self):
+        super(TestRateLimitedResources, self).setUp()
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMIT_PER_EMAIL'] = (2, 60)
+        app.extensions.pop('ratelimit', None)
+
+    def tearDown(self):
+        app.config['RATELIMIT_ENABLED'] = False
+        app.config['RATELIMIT_PER_EMAIL'] = (5, 60)
+        app.extensions.pop('ratelimit', None)
+        super(TestRateLimitedResources, self).tearDown()
+
+    def login(self, email):
+        return self.client.post(
+            '/login',
+            data=json.dumps({'email': email, 'password': 'hunter2'}),
+            content_type='application/json'
+        )
+
+    def test_login_rate_limited_by_email(self):
+        self.assertEqual(self.login('joe@gmail.com').status_code, 404)
+        self.assertEqual(self.login('JOE@gmail.com').status_code, 404)
+
+        with self.assertMaxQueries(0):
+            resp = self.login('joe@gmail.com')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '30')
+        data = json.loads(resp.data.decode())
+        self.assertEqual(data['status'], 'error')
+
+        # Other accounts aren't affected
+        self.assertEqual(self.login('moe@gmail.com').status_code, 404)
+
+    def test_register_rate_limited_by_ip(self):
+        app.config['RATELIMIT_PER_IP'] = (1, 60)
+        try:
+            resp = self.client.post(
+                '/register',
+                data=json.dumps({'email': 'joe@gmail.com',
+                                 'password': '123456',
+                                 'name': 'joe'}),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.status_code, 201)
+            resp = self.client.post(
+                '/register',
+                data=json.dumps({'email': 'moe@gmail.com',
+                                 'password': '123456',
+                                 'name': 'moe'}),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.status_code, 429)
+        finally:
+            app.config['RATELIMIT_PER_IP'] = (20, 60)
+
+    def test_malformed_json_rejected_by_view(self):
+        for path in ('/login', '/register'):
+            resp = self.client.post(path, data='{"email": ',
+                                    content_type='application/json')
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(json.loads(resp.data.decode())['error'],
+                             'Invalid JSON body')
+
+    def test_ip_behind_trusted_proxies(self):
+        app.config['RATELIMIT_PER_IP'] = (1, 60)
+
+        def login(email, forwarded_for):
+            return self.client.post(
+                '/login',
+                data=json.dumps({'email': email, 'password': 'hunter2'}),
+                headers={'X-Forwarded-For': forwarded_for},
+                environ_base={'REMOTE_ADDR': '10.0.0.1'}
+            ).status_code
+        try:
+            # Without trusted proxies, the proxy's address is the client's
+            self.assertEqual(login('a@gmail.com', '1.1.1.1'), 404)
+            self.assertEqual(login('b@gmail.com', '2.2.2.2'), 429)
+
+            app.config['RATELIMIT_TRUSTED_PROXIES'] = 1
+            self.assertEqual(login('c@gmail.com', '1.1.1.1'), 404)
+            self.assertEqual(login('d@gmail.com', '2.2.2.2'), 404)
+            # Addresses the client forwarded itself are ignored
+            self.assertEqual(login('e@gmail.com', '3.3.3.3, 2.2.2.2'), 429)
+        finally:
+            app.config['RATELIMIT_PER_IP'] = (20, 60)
+            app.config['RATELIMIT_TRUSTED_PROXIES'] = 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import json
+from datetime import date
+
+from eachday import db
+from eachday.models import User, Entry, YearReport
+from eachday.reports import summarize, build_reports
+from eachday.tests.base import BaseTestCase, postgres_only
+
+
+class TestSummarize(unittest.TestCase):
+    def test_summary(self):
+        rows = [(date(2017, 1, 1), 4), (date(2017, 1, 2), 6),
+                (date(2017, 1, 3), None), (date(2017, 3, 5), 9),
+                (date(2017, 3, 6), 1), (date(2017, 6, 1), 2)]
+        report = summarize(1, 2017, rows)
+        self.assertEqual(report['entry_count'], 6)
+        self.assertEqual(report['rated_count'], 5)
+        self.assertAlmostEqual(report['average_rating'], 4.4)
+        # January and March both average 5; the earlier month wins
+        self.assertEqual(report['best_month'], 1)
+        self.assertEqual(report['worst_month'], 6)
+        self.assertEqual(report['longest_streak'], 3)
+
+    def test_no_entries(self):
+        report = summarize(1, 2017, [])
+        self.assertEqual((report['entry_count'], report['average_rating'],
+                          report['best_month'], report['longest_streak']),
+                         (0, None, None, 0))
+
+
+class TestBuildReports(BaseTestCase):
+    def setUp(self):
+        super(TestBuildReports, self).setUp()
+        self.users = [User(email='user{}@bar.com'.format(i), password='test',
+                           name='joe') for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        for i, user in enumerate(self.users):
+            for day in range(1, i + 2):
+                db.session.add(Entry(user_id=user.id,
+                                     date=date(2017, 2, day), rating=day))
+            db.session.add(Entry(user_id=user.id, date=date(2016, 12, 31),
+                                 rating=10))
+        db.session.commit()
+
+    def test_build_and_resume(self):
+        progress = []
+        done, _ = build_reports(2017, workers=1, chunk_size=2,
+                                progress=lambda *args: progress.append(args))
+        self.assertEqual(done, 3)
+        self.assertEqual([p[0] for p in progress], [2, 3])
+        report = YearReport.query.filter_by(user_id=self.users[2].id,
+                                            year=2017).one()
+        self.assertEqual((report.entry_count, report.average_rating,
+                          report.longest_streak), (3, 2.0, 3))
+
+        # Users that already have a report are skipped
+        YearReport.query.filter_by(user_id=self.users[1].id).delete()
+        db.session.commit()
+        done, _ = build_reports(2017, workers=1, chunk_size=2)
+        self.assertEqual(done, 1)
+        done, _ = build_reports(2017, workers=1, chunk_size=2, rebuild=True)
+        self.assertEqual(done, 3)
+        self.assertEqual(YearReport.query.count(), 3)
+
+    def test_endpoint(self):
+        build_reports(2017, workers=1)
+        auth_token = self.users[1].encode_auth_token(
+            self.users[1].id).decode()
+        resp = self.client.get('/reports/2017', headers={
+            'Authorization': 'Bearer ' + auth_token
+        })
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data.decode())['data']
+        self.assertEqual((data['year'], data['entry_count'],
+                          data['best_month']), (2017, 2, 2))
+
+        resp = self.client.get('/reports/2016', headers={
+            'Authorization': 'Bearer ' + auth_token
+        })
+        self.assertEqual(resp.status_code, 404)
+
+
+@postgres_only
+class TestParallelBuildReports(BaseTestCase):
+    # Worker processes only see committed rows
+    transactional = False
+
+    def test_process_pool(self):
+        users = [User(email='user{}@bar.com'.format(i), password='test',
+                      name='joe') for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add_all([Entry(user_id=user.id, date=date(2017, 5, 1),
+                                  rating=7) for user in users])
+        db.session.commit()
+
+        done, _ = build_reports(2017, workers=2, chunk_size=2)
+        self.assertEqual(done, 5)
+        self.assertEqual(
+            [r.entry_count for r in YearReport.query.filter_by(year=2017)],
+            [1] * 5
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,7 +29,9 @@ class TestExceptionHandler(BaseTestCase):
         # Inject function into /login to raise an exception
         def raise_error(self):
             raise view_exception
-        LoginResource.post = raise_error
+        patcher = patch.object(LoginResource, 'post', raise_error)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
         resp = self.client.post('/login')
         self.assertEqual(resp.status_code, 500)
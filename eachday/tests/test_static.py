@@ -0,0 +1,110 @@
+import unittest
+import gzip
+import io
+import os
+import shutil
+import tempfile
+from flask import Flask
+from flask_testing import TestCase
+
+from eachday.static import register_static, compress_directory
+
+INDEX_HTML = '''<html>
+  <head><link rel="stylesheet" href="//cdn.example.com/ui.css"></head>
+  <body><script src="dist/bundle.js"></script></body>
+</html>'''
+BUNDLE_JS = 'console.log("each day");\n' * 100
+
+
+class TestStaticFiles(TestCase):
+    def create_app(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'dist'))
+        with open(os.path.join(self.root, 'index.html'), 'w') as f:
+            f.write(INDEX_HTML)
+        with open(os.path.join(self.root, 'dist', 'bundle.js'), 'w') as f:
+            f.write(BUNDLE_JS)
+        compress_directory(self.root)
+
+        app = Flask(__name__)
+        app.config['STATIC_DIR'] = self.root
+        register_static(app)
+        return app
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def bundle_url(self):
+        index = self.app.extensions['static_index']
+        return '/dist/bundle.js?v=' + index.files['dist/bundle.js'].digest
+
+    def test_compress_directory(self):
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root, 'dist', 'bundle.js.gz')
+        ))
+
+    def test_index_references_versioned_assets(self):
+        resp = self.client.get('/')
+        self.assertEqual(resp.status_code, 200)
+        html = resp.data.decode()
+        self.assertIn('src="{}"'.format(self.bundle_url()), html)
+        self.assertIn('href="//cdn.example.com/ui.css"', html)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+    def test_client_routes_get_index(self):
+        html = {'Accept': 'text/html,application/xhtml+xml,*/*;q=0.8'}
+        resp = self.client.get('/dashboard', headers=html)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<script', resp.data.decode())
+        self.assertEqual(self.client.get('/missing.js',
+                                         headers=html).status_code, 404)
+
+    def test_api_and_non_page_requests_not_found(self):
+        html = {'Accept': 'text/html'}
+        for path in ('/entry/abc', '/export/jobs/x', '/reports', '/token'):
+            resp = self.client.get(path, headers=html)
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.mimetype, 'application/json')
+        for accept in ('application/json', '*/*', None):
+            headers = {'Accept': accept} if accept else {}
+            resp = self.client.get('/dashboard', headers=headers)
+            self.assertEqual(resp.status_code, 404)
+
+    def test_versioned_asset_is_immutable(self):
+        resp = self.client.get(self.bundle_url())
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(resp.data.decode(), BUNDLE_JS)
+        self.assertEqual(resp.content_length, len(BUNDLE_JS))
+        resp.close()
+
+        resp = self.client.get('/dist/bundle.js?v=stale')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        resp.close()
+
+    def test_precompressed_variant(self):
+        resp = self.client.get(self.bundle_url(),
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(resp.data))
+                         .read().decode(), BUNDLE_JS)
+        resp.close()
+
+    def test_not_modified(self):
+        resp = self.client.get('/dist/bundle.js')
+        etag = resp.headers['ETag']
+        resp.close()
+        resp = self.client.get('/dist/bundle.js',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+    def test_no_stat_per_request(self):
+        os.remove(os.path.join(self.root, 'index.html'))
+        # Pages are held in memory once indexed
+        self.assertEqual(self.client.get('/').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import json
+from freezegun import freeze_time
+from datetime import datetime, timedelta
+from mock import patch
+
+from eachday import db
+from eachday.models import User, BlacklistToken, RefreshToken
+from eachday.tests.base import BaseTestCase
+
+
+class TestRefreshTokens(BaseTestCase):
+    def setUp(self):
+        super(TestRefreshTokens, self).setUp()
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def post(self, url, data, auth_token=None):
+        headers = {}
+        if auth_token:
+            headers['Authorization'] = 'Bearer ' + auth_token
+        resp = self.client.post(url, data=json.dumps(data), headers=headers,
+                                content_type='application/json')
+        return resp, json.loads(resp.data.decode())
+
+    def login(self):
+        resp, data = self.post('/login', {'email': 'foo@bar.com',
+                                          'password': 'test'})
+        self.assertEqual(resp.status_code, 200)
+        return data
+
+    def refresh(self, refresh_token):
+        return self.post('/token/refresh', {'refresh_token': refresh_token})
+
+    def test_login_issues_short_lived_tokens(self):
+        data = self.login()
+        self.assertEqual(data['expires_in'], 15 * 60)
+        claims = User.decode_auth_claims(data['auth_token'])
+        self.assertEqual(claims['exp'] - claims['iat'], 15 * 60)
+        token = RefreshToken.query.filter_by(user_id=self.user_id).one()
+        # Only a hash of the secret is stored
+        self.assertNotIn(token.secret_hash, data['refresh_token'])
+
+    def test_refresh_rotates(self):
+        data = self.login()
+        with patch('eachday.resources.bcrypt.check_password_hash') as check:
+            with self.assertMaxQueries(3):
+                resp, refreshed = self.refresh(data['refresh_token'])
+        self.assertFalse(check.called)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(refreshed['message'], 'Token refreshed.')
+        self.assertNotEqual(refreshed['refresh_token'], data['refresh_token'])
+        self.assertEqual(
+            User.decode_auth_claims(refreshed['auth_token'])['name'], 'joe'
+        )
+        resp = self.client.get('/user', headers={
+            'Authorization': 'Bearer ' + refreshed['auth_token']
+        })
+        self.assertEqual(resp.status_code, 200)
+
+        resp, again = self.refresh(refreshed['refresh_token'])
+        self.assertEqual(resp.status_code, 200)
+
+    def test_reuse_revokes_family(self):
+        first = self.login()['refresh_token']
+        _, refreshed = self.refresh(first)
+        resp, data = self.refresh(first)
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(data['error'],
+                         'Refresh token already used. Please log in again.')
+        # The token issued from the reused one is revoked too
+        resp, _ = self.refresh(refreshed['refresh_token'])
+        self.assertEqual(resp.status_code, 401)
+
+    def test_other_sessions_unaffected(self):
+        first, second = self.login(), self.login()
+        self.refresh(first['refresh_token'])
+        self.refresh(first['refresh_token'])
+        resp, _ = self.refresh(second['refresh_token'])
+        self.assertEqual(resp.status_code, 200)
+
+    def test_invalid_and_expired(self):
+        refresh_token = self.login()['refresh_token']
+        token_id = refresh_token.split('.')[0]
+        for value in ('', 'nope', token_id + '.wrong', '999999.abc'):
+            resp, data = self.refresh(value)
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(data['error'],
+                             'Invalid refresh token. Please log in again.')
+
+        with freeze_time(datetime.utcnow() + timedelta(days=31)):
+            resp, data = self.refresh(refresh_token)
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(data['error'],
+                         'Refresh token expired. Please log in again.')
+
+    def test_logout_revokes_refresh_token(self):
+        data = self.login()
+        resp, _ = self.post('/logout', {'refresh_token':
+                                        data['refresh_token']},
+                            data['auth_token'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(BlacklistToken.query.count(), 0)
+        resp, _ = self.refresh(data['refresh_token'])
+        self.assertEqual(resp.status_code, 401)
+
+    def test_logout_with_another_users_token(self):
+        data = self.login()
+        other = User(email='baz@bar.com', password='test', name='moe')
+        db.session.add(other)
+        db.session.commit()
+        resp, _ = self.post('/logout', {'refresh_token':
+                                        data['refresh_token']},
+                            other.encode_auth_token(other.id).decode())
+        self.assertEqual(resp.status_code, 401)
+        resp, _ = self.refresh(data['refresh_token'])
+        self.assertEqual(resp.status_code, 200)
+
+    def test_password_change_signs_out_other_devices(self):
+        data = self.login()
+        resp = self.client.put('/user', data=json.dumps({
+            'password': 'test', 'new_password': 'better'
+        }), headers={'Authorization': 'Bearer ' + data['auth_token']})
+        changed = json.loads(resp.data.decode())['data']
+        resp, _ = self.refresh(data['refresh_token'])
+        self.assertEqual(resp.status_code, 401)
+        resp, _ = self.refresh(changed['refresh_token'])
+        self.assertEqual(resp.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import unittest
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date
+from six.moves import BaseHTTPServer
+
+from eachday import app, db
+from eachday.log import RequestIdFilter
+from eachday.models import User, Entry
+from eachday.tracing import (REQUEST_ID_HEADER, Trace, OTLPExporter,
+                             stage_report)
+from eachday.tests.base import BaseTestCase
+
+
+class TestStageReport(unittest.TestCase):
+    def record(self, request_id, name, duration, root=False):
+        return {'trace_id': 't', 'request_id': request_id, 'name': name,
+                'duration_ms': duration,
+                'attributes': {'http.route': '/login'} if root else {}}
+
+    def test_report(self):
+        records = []
+        for i in range(1, 101):
+            records += [self.record(i, 'POST /login', i, root=True),
+                        self.record(i, 'db.query', 1),
+                        self.record(i, 'db.query', 1),
+                        self.record(i, 'bcrypt.check_password_hash',
+                                    i - 2)]
+        route = stage_report(records)['POST /login']
+        self.assertEqual((route['count'], route['p50'], route['p99']),
+                         (100, 50, 99))
+        self.assertEqual(route['stages']['db.query']['p99'], 2)
+        self.assertEqual(route['stages']['bcrypt.check_password_hash']
+                         ['p50'], 48)
+        self.assertAlmostEqual(route['stages']['db.query']['p99_share'],
+                               (2 / 99.0 + 2 / 100.0) / 2)
+
+
+class CollectorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.received.append(json.loads(self.rfile.read(length).decode()))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOTLPExporter(unittest.TestCase):
+    def test_export_to_collector(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                           CollectorHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        trace = Trace('req-1')
+        root = trace.start_span('GET /entry', {'http.route': '/entry',
+                                               'http.status_code': 200})
+        trace.end_span(trace.start_span('db.query'))
+        trace.end_span(root)
+        try:
+            OTLPExporter('http://127.0.0.1:{}/v1/traces'.format(
+                server.server_address[1]), 'eachday').export([trace])
+        finally:
+            thread.join()
+            server.server_close()
+
+        payload = CollectorHandler.received.pop()
+        spans = payload['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual([s['name'] for s in spans],
+                         ['GET /entry', 'db.query'])
+        self.assertEqual(spans[0]['kind'], 2)
+        self.assertNotIn('parentSpanId', spans[0])
+        self.assertEqual(spans[1]['parentSpanId'], spans[0]['spanId'])
+        self.assertEqual(spans[1]['traceId'], trace.trace_id)
+        self.assertIn({'key': 'http.status_code',
+                       'value': {'intValue': '200'}},
+                      spans[0]['attributes'])
+
+
+class TestRequestTracing(BaseTestCase):
+    def setUp(self):
+        super(TestRequestTracing, self).setUp()
+        self.trace_dir = tempfile.mkdtemp()
+        self.trace_file = os.path.join(self.trace_dir, 'spans.jsonl')
+        app.config['TRACE_FILE'] = self.trace_file
+        app.config['TRACING_ENABLED'] = True
+        user = User(email='foo@bar.com', password='test', name='joe')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(Entry(user_id=user.id, date=date(2017, 1, 1)))
+        db.session.commit()
+        self.auth_token = user.encode_auth_token(user.id).decode()
+
+    def tearDown(self):
+        shutil.rmtree(self.trace_dir)
+        super(TestRequestTracing, self).tearDown()
+
+    def spans(self):
+        with open(self.trace_file) as f:
+            return [json.loads(line) for line in f]
+
+    def get_entries(self, **headers):
+        headers['Authorization'] = 'Bearer ' + self.auth_token
+        resp = self.client.get('/entry', headers=headers)
+        # The trace is exported once the server has sent the body and
+        # closed it
+        resp.data
+        resp.close()
+        return resp
+
+    def test_entry_spans(self):
+        resp = self.get_entries()
+        self.assertEqual(resp.status_code, 200)
+        spans = self.spans()
+        by_name = dict((s['name'], s) for s in spans)
+        root = by_name['GET /entry']
+        self.assertIsNone(root['parent_id'])
+        self.assertEqual(root['attributes']['http.status_code'], 200)
+        self.assertEqual(root['request_id'], resp.headers[REQUEST_ID_HEADER])
+
+        auth = by_name['validate_auth']
+        self.assertEqual(auth['parent_id'], root['span_id'])
+        self.assertEqual(by_name['User.decode_auth_claims']['parent_id'],
+                         auth['span_id'])
+        queries = [s for s in spans if s['name'] == 'db.query']
+        self.assertIn(auth['span_id'], [q['parent_id'] for q in queries])
+        self.assertIn('json.encode', by_name)
+        self.assertEqual(len(set(s['trace_id'] for s in spans)), 1)
+
+    def test_login_spans(self):
+        resp = self.client.post('/login', data=json.dumps(dict(
+            email='foo@bar.com', password='test'
+        )), content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+        names = set(s['name'] for s in self.spans())
+        self.assertTrue(names.issuperset([
+            'POST /login', 'bcrypt.check_password_hash', 'db.query',
+            'UserSchema.dump', 'json.encode'
+        ]))
+
+    def test_propagated_ids(self):
+        trace_id, parent_id = 'a' * 32, 'b' * 16
+        resp = self.get_entries(**{
+            REQUEST_ID_HEADER: 'upstream-123',
+            'traceparent': '00-{}-{}-01'.format(trace_id, parent_id)
+        })
+        self.assertEqual(resp.headers[REQUEST_ID_HEADER], 'upstream-123')
+        root = self.spans()[0]
+        self.assertEqual((root['trace_id'], root['parent_id']),
+                         (trace_id, parent_id))
+        self.assertEqual(root['request_id'], 'upstream-123')
+
+    def test_root_span_covers_body(self):
+        resp = self.client.get('/entry', headers={
+            'Authorization': 'Bearer ' + self.auth_token
+        })
+        # The request has been torn down, but its body hasn't been sent
+        self.assertFalse(os.path.exists(self.trace_file))
+        time.sleep(0.05)
+        resp.data
+        resp.close()
+        root = [s for s in self.spans() if s['parent_id'] is None]
+        self.assertEqual([s['name'] for s in root], ['GET /entry'])
+        self.assertGreaterEqual(root[0]['duration_ms'], 50)
+
+    def test_batch_is_one_trace(self):
+        resp = self.client.post('/batch', data=json.dumps({'requests': [
+            {'path': '/entry'}, {'path': '/user'}, {'path': '/entry'}
+        ]}), headers={'Authorization': 'Bearer ' + self.auth_token,
+                      REQUEST_ID_HEADER: 'batch-1'})
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+        self.assertEqual(resp.headers[REQUEST_ID_HEADER], 'batch-1')
+        spans = self.spans()
+        self.assertEqual(set(s['request_id'] for s in spans),
+                         set(['batch-1']))
+        root = [s for s in spans if s['parent_id'] is None]
+        self.assertEqual([s['name'] for s in root], ['POST /batch'])
+        self.assertEqual(
+            len([s for s in spans if s['name'] == 'json.encode']), 4
+        )
+
+    def test_unsafe_request_id_replaced(self):
+        resp = self.get_entries(**{REQUEST_ID_HEADER: '<script>'})
+        self.assertRegexpMatches(resp.headers[REQUEST_ID_HEADER],
+                                 r'^[0-9a-f]{32}$')
+
+    def test_disabled(self):
+        app.config['TRACING_ENABLED'] = False
+        resp = self.get_entries()
+        self.assertIn(REQUEST_ID_HEADER, resp.headers)
+        self.assertFalse(os.path.exists(self.trace_file))
+
+    def test_log_records_carry_request_id(self):
+        records = []
+
+        class Collector(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        handler = Collector()
+        handler.addFilter(RequestIdFilter())
+        app.logger.addHandler(handler)
+        app.logger.setLevel('INFO')
+        try:
+            self.client.get('/entry', headers={
+                'Authorization': 'Bearer nope', REQUEST_ID_HEADER: 'abc'
+            })
+        finally:
+            app.logger.removeHandler(handler)
+        self.assertTrue(records)
+        self.assertEqual(set(r.request_id for r in records), set(['abc']))
+
+
+if __name__ == '__main__':
+    unittest.main()
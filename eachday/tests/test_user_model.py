@@ -43,9 +43,11 @@ class TestUserModel(BaseTestCase):
         auth_token = user.encode_auth_token(user.id)
         self.assertIsInstance(auth_token, bytes)
         data = jwt.decode(auth_token, 'test_secret_key')
-        self.assertEqual(data['id'], user.id)
+        self.assertEqual(data['sub'], user.id)
+        self.assertEqual(data['ver'], 1)
         self.assertEqual(data['email'], user.email)
         self.assertNotIn('password', data)
+        self.assertNotIn('id', data)
         self.assertEqual(data['joined_on'], '2017-01-01')
         self.assertEqual(data['name'], 'joe')
 
@@ -1,8 +1,10 @@
 import unittest
+import shutil
+import tempfile
 from datetime import date
 
 import json
-from eachday import db, bcrypt
+from eachday import app, db, bcrypt
 from eachday.models import User
 from eachday.tests.base import BaseTestCase
 
@@ -138,5 +140,85 @@ class TestUserResource(BaseTestCase):
             bcrypt.check_password_hash(self.user.password, 'foobar')
         )
 
+    def test_user_get_from_token_claims(self):
+        """ Test that a current token's claims answer GET /user """
+        headers = {'Authorization': 'Bearer ' + self.token}
+        first = self.client.get('/user', headers=headers)
+
+        # Only the blacklist check should hit the database now
+        with self.assertMaxQueries(1):
+            second = self.client.get('/user', headers=headers)
+        self.assertEqual(json.loads(first.data.decode()),
+                         json.loads(second.data.decode()))
+        data = json.loads(second.data.decode())
+        self.assertEqual(data['data']['id'], self.user.id)
+        self.assertEqual(data['data']['joined_on'], '2017-01-01')
+
+    def test_user_get_after_profile_change(self):
+        """ Test that tokens issued before a profile edit aren't trusted """
+        headers = {'Authorization': 'Bearer ' + self.token}
+        self.client.get('/user', headers=headers)
+        self.client.put('/user', headers=headers, data=json.dumps({
+            'name': 'Donald Knuth',
+            'password': 'test'
+        }))
+
+        response = self.client.get('/user', headers=headers)
+        data = json.loads(response.data.decode())
+        self.assertEqual(data['data']['name'], 'Donald Knuth')
+
+    def test_profile_change_seen_by_other_workers(self):
+        """ Test that every worker stops trusting an edited profile """
+        directory = tempfile.mkdtemp()
+        app.config['RATELIMIT_STORAGE_URL'] = 'shm://' + directory + '/s'
+        try:
+            headers = {'Authorization': 'Bearer ' + self.token}
+            self.client.get('/user', headers=headers)
+            self.client.patch('/user', headers=headers,
+                              data=json.dumps({'name': 'bob'}))
+            # As seen by another worker, which maps the file itself
+            app.extensions.pop('ratelimit', None)
+            response = self.client.get('/user', headers=headers)
+        finally:
+            shutil.rmtree(directory)
+            app.config['RATELIMIT_STORAGE_URL'] = 'memory://'
+            app.extensions.pop('ratelimit', None)
+        data = json.loads(response.data.decode())
+        self.assertEqual(data['data']['name'], 'bob')
+
+    def test_user_patch(self):
+        """ Test that the name can be changed without a password """
+        response = self.client.patch(
+            '/user',
+            data=json.dumps({'name': 'bob'}),
+            headers={'Authorization': 'Bearer ' + self.token}
+        )
+        data = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['data']['name'], 'bob')
+        self.assertEqual(data['data']['email'], 'foo@bar.com')
+        claims = User.decode_auth_claims(data['data']['auth_token'])
+        self.assertEqual((claims['name'], claims['ver']), ('bob', 2))
+
+        # Tokens issued before the change no longer answer GET /user
+        response = self.client.get(
+            '/user',
+            headers={'Authorization': 'Bearer ' + self.token}
+        )
+        data = json.loads(response.data.decode())
+        self.assertEqual(data['data']['name'], 'bob')
+
+    def test_user_patch_needs_password_for_email(self):
+        """ Test that PATCH can't change fields that need a password """
+        response = self.client.patch(
+            '/user',
+            data=json.dumps({'email': 'evil@bar.com'}),
+            headers={'Authorization': 'Bearer ' + self.token}
+        )
+        self.assertEqual(response.status_code, 400)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.user.id).email, 'foo@bar.com')
+
+
 if __name__ == '__main__':
     unittest.main()
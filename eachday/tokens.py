@@ -0,0 +1,115 @@
+import binascii
+import hashlib
+import hmac
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from .models import User, RefreshToken
+
+from eachday import db
+
+
+class RefreshTokenError(Exception):
+    pass
+
+
+def new_secret():
+    return binascii.hexlify(os.urandom(32)).decode()
+
+
+def hash_secret(secret):
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    return hmac.new(key, secret.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def issue_refresh_token(user_id, family=None):
+    """
+    Adds a refresh token for the user to the session, in a new family
+    unless one is given, and returns it as '<id>.<secret>'
+    """
+    secret = new_secret()
+    token = RefreshToken(
+        user_id=user_id,
+        family=family or new_secret()[:32],
+        secret_hash=hash_secret(secret),
+        expires_at=(datetime.utcnow() +
+                    timedelta(days=current_app.config['REFRESH_TOKEN_DAYS'])),
+    )
+    db.session.add(token)
+    db.session.flush()
+    return '{}.{}'.format(token.id, secret)
+
+
+def find_refresh_token(value):
+    """
+    Looks a refresh token up by id, with its user, and returns them if
+    the secret matches, else None
+    """
+    token_id, _, secret = (value or '').partition('.')
+    if not token_id.isdigit() or not secret:
+        return None
+    found = (db.session.query(RefreshToken, User)
+             .join(User, User.id == RefreshToken.user_id)
+             .filter(RefreshToken.id == int(token_id))
+             .first())
+    if found is None or not hmac.compare_digest(
+            found[0].secret_hash, hash_secret(secret)):
+        return None
+    return found
+
+
+def revoke_family(family):
+    return (RefreshToken.query
+            .filter(RefreshToken.family == family,
+                    RefreshToken.revoked_at.is_(None))
+            .update({'revoked_at': datetime.utcnow()},
+                    synchronize_session=False))
+
+
+def revoke_user_tokens(user_id):
+    return (RefreshToken.query
+            .filter(RefreshToken.user_id == user_id,
+                    RefreshToken.revoked_at.is_(None))
+            .update({'revoked_at': datetime.utcnow()},
+                    synchronize_session=False))
+
+
+def rotate_refresh_token(value):
+    """
+    Uses up a refresh token and returns its user with the token that
+    replaces it. Raises RefreshTokenError with a message for the client
+    if the token can't be used; the session should be committed either
+    way, as reusing a token revokes its family.
+    """
+    found = find_refresh_token(value)
+    if found is None:
+        raise RefreshTokenError('Invalid refresh token. Please log in again.')
+    token, user = found
+    now = datetime.utcnow()
+    if token.revoked_at is not None:
+        # Whoever holds the token that replaced this one may have stolen
+        # it, so end the session on every device it was passed to
+        revoke_family(token.family)
+        raise RefreshTokenError('Refresh token already used. '
+                                'Please log in again.')
+    if token.expires_at <= now:
+        raise RefreshTokenError('Refresh token expired. Please log in again.')
+
+    # Only one of two concurrent uses of a token gets to replace it
+    used = (RefreshToken.query
+            .filter(RefreshToken.id == token.id,
+                    RefreshToken.revoked_at.is_(None))
+            .update({'revoked_at': now}, synchronize_session=False))
+    if not used:
+        raise RefreshTokenError('Refresh token already used. '
+                                'Please log in again.')
+    return user, issue_refresh_token(user.id, token.family)
+
+
+def revoke_refresh_token(value, user_id):
+    """ Revokes a user's refresh token and every token in its family """
+    found = find_refresh_token(value)
+    if found is None or found[0].user_id != user_id:
+        return False
+    revoke_family(found[0].family)
+    return True
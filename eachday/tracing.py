@@ -0,0 +1,456 @@
+import atexit
+import collections
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import marshmallow
+from flask import g, request, has_app_context
+from flask_bcrypt import Bcrypt
+from six.moves import queue
+from six.moves.urllib.request import Request, urlopen
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+from .batch import SUB_REQUEST_KEY
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+# Incoming request ids are echoed into logs, so only accept plain ones
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+# W3C trace context, so callers can make our spans part of their trace
+TRACEPARENT_PATTERN = re.compile(
+    r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$'
+)
+STATEMENT_ATTRIBUTE_LENGTH = 200
+# WSGI environ key of the function that exports a request's trace once its
+# body has been sent (see TraceExportMiddleware)
+EXPORT_TRACE_KEY = 'eachday.export_trace'
+
+
+def new_id(nbytes):
+    return '{:0{}x}'.format(random.getrandbits(nbytes * 8), nbytes * 2)
+
+
+class Span(object):
+    __slots__ = ('name', 'span_id', 'parent_id', 'start', 'end',
+                 'attributes')
+
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Trace(object):
+    """ The spans recorded while handling one request """
+
+    def __init__(self, request_id, trace_id=None, parent_id=None):
+        self.request_id = request_id
+        self.trace_id = trace_id or new_id(16)
+        self.parent_id = parent_id
+        self.spans = []
+        self._open = []
+
+    def start_span(self, name, attributes=None):
+        parent_id = self._open[-1].span_id if self._open else self.parent_id
+        span = Span(name, parent_id, attributes or {})
+        self.spans.append(span)
+        self._open.append(span)
+        return span
+
+    def end_span(self, span):
+        span.end = time.time()
+        # Also closes any spans opened inside this one and never ended,
+        # e.g. a statement that raised before after_cursor_execute
+        while self._open:
+            if self._open.pop() is span:
+                break
+
+    def finish(self):
+        while self._open:
+            self.end_span(self._open[0])
+
+    def to_dicts(self):
+        return [{
+            'trace_id': self.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'request_id': self.request_id,
+            'name': span.name,
+            'start': span.start,
+            'duration_ms': round(span.duration * 1000, 3),
+            'attributes': span.attributes,
+        } for span in self.spans]
+
+
+def current_trace():
+    return g.get('trace') if has_app_context() else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """ Records the enclosed block as a span of the request's trace """
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, attributes)
+    try:
+        yield current
+    finally:
+        trace.end_span(current)
+
+
+def traced(name):
+    """ Decorator form of span() """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+class TracedSchema(marshmallow.Schema):
+    """ Schema whose dump and load calls are recorded as spans """
+
+    def dump(self, *args, **kwargs):
+        with span(type(self).__name__ + '.dump', many=bool(self.many)):
+            return super(TracedSchema, self).dump(*args, **kwargs)
+
+    def load(self, *args, **kwargs):
+        with span(type(self).__name__ + '.load', many=bool(self.many)):
+            return super(TracedSchema, self).load(*args, **kwargs)
+
+
+class TracedBcrypt(Bcrypt):
+    """ Bcrypt whose hashing calls are recorded as spans """
+
+    def generate_password_hash(self, *args, **kwargs):
+        with span('bcrypt.generate_password_hash'):
+            return super(TracedBcrypt, self).generate_password_hash(
+                *args, **kwargs
+            )
+
+    def check_password_hash(self, *args, **kwargs):
+        with span('bcrypt.check_password_hash'):
+            return super(TracedBcrypt, self).check_password_hash(
+                *args, **kwargs
+            )
+
+
+class FileExporter(object):
+    """ Appends spans to a file, one JSON object per line """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, traces):
+        with open(self.path, 'a') as f:
+            for trace in traces:
+                for record in trace.to_dicts():
+                    f.write(json.dumps(record, default=str) + '\n')
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        # int64 values are strings in the OTLP JSON encoding
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_payload(traces, service_name):
+    """ Builds an OTLP/HTTP JSON ExportTraceServiceRequest """
+    spans = []
+    for trace in traces:
+        for span in trace.spans:
+            attributes = dict(span.attributes, request_id=trace.request_id)
+            record = {
+                'traceId': trace.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                # SPAN_KIND_SERVER for the request span, INTERNAL otherwise
+                'kind': 2 if 'http.route' in span.attributes else 1,
+                'startTimeUnixNano': str(int(span.start * 1e9)),
+                'endTimeUnixNano': str(int(span.end * 1e9)),
+                'attributes': [{'key': key, 'value': otlp_value(value)}
+                               for key, value in sorted(attributes.items())],
+            }
+            if span.parent_id:
+                record['parentSpanId'] = span.parent_id
+            if span.attributes.get('http.status_code', 0) >= 500:
+                record['status'] = {'code': 2}
+            spans.append(record)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': otlp_value(service_name)}
+        ]},
+        'scopeSpans': [{'scope': {'name': 'eachday.tracing'},
+                        'spans': spans}],
+    }]}
+
+
+class OTLPExporter(object):
+    """
+    Posts spans to an OTLP/HTTP collector (or anything that accepts the
+    same JSON, e.g. a local stand-in while testing)
+    """
+
+    def __init__(self, endpoint, service_name, timeout=5):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def export(self, traces):
+        body = json.dumps(otlp_payload(traces, self.service_name))
+        req = Request(self.endpoint, data=body.encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+        urlopen(req, timeout=self.timeout).close()
+
+
+class BackgroundExporter(object):
+    """
+    Hands finished traces to a writer thread, which exports whatever has
+    queued up in one batch. Drops traces rather than blocking when the
+    queue is full or the exporter fails.
+    """
+    dropped = 0
+
+    def __init__(self, exporter, logger, size, batch_size=100):
+        self.exporter = exporter
+        self.logger = logger
+        self.batch_size = batch_size
+        self.queue = queue.Queue(size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def export(self, traces):
+        for trace in traces:
+            try:
+                self.queue.put_nowait(trace)
+            except queue.Full:
+                BackgroundExporter.dropped += 1
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [trace for trace in batch if trace is not None]
+            if not batch:
+                continue
+            try:
+                self.exporter.export(batch)
+            except Exception:
+                BackgroundExporter.dropped += len(batch)
+                self.logger.warning('Failed to export %d traces',
+                                    len(batch), exc_info=True)
+
+
+def create_exporter(config):
+    if config['TRACE_EXPORTER'] == 'otlp':
+        return OTLPExporter(config['TRACE_OTLP_ENDPOINT'],
+                            config['TRACE_SERVICE_NAME'])
+    return FileExporter(config['TRACE_FILE'])
+
+
+def get_exporter(app):
+    """ Returns the app's exporter, rebuilt whenever its settings change """
+    config = app.config
+    key = (config['TRACE_EXPORTER'], config['TRACE_FILE'],
+           config['TRACE_OTLP_ENDPOINT'], config['TRACE_ASYNC'])
+    cached = app.extensions.get('tracing')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    exporter = create_exporter(config)
+    if config['TRACE_ASYNC']:
+        exporter = BackgroundExporter(exporter, app.logger,
+                                      config['TRACE_QUEUE_SIZE'])
+    app.extensions['tracing'] = (key, exporter)
+    return exporter
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a non-empty list """
+    ordered = sorted(values)
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+def stage_report(records):
+    """
+    Summarises exported span records by route: request latency at p50 and
+    p99, and for each stage the time it took per request at p50 and p99
+    plus its mean share of the requests at or above the route's p99
+    """
+    requests = collections.defaultdict(list)
+    for record in records:
+        requests[record['trace_id'], record['request_id']].append(record)
+
+    routes = collections.defaultdict(list)
+    for spans in requests.values():
+        roots = [s for s in spans if 'http.route' in s['attributes']]
+        if not roots:
+            continue
+        stages = collections.Counter()
+        for s in spans:
+            if s is not roots[0]:
+                stages[s['name']] += s['duration_ms']
+        routes[roots[0]['name']].append((roots[0]['duration_ms'], stages))
+
+    report = {}
+    for route, timings in routes.items():
+        durations = [duration for duration, _ in timings]
+        p99 = percentile(durations, 0.99)
+        slow = [(d, stages) for d, stages in timings if d >= p99]
+        names = set(name for _, stages in timings for name in stages)
+        report[route] = {
+            'count': len(timings),
+            'p50': percentile(durations, 0.5),
+            'p99': p99,
+            'stages': dict((name, {
+                'p50': percentile([s[name] for _, s in timings], 0.5),
+                'p99': percentile([s[name] for _, s in timings], 0.99),
+                'p99_share': sum(s[name] / d for d, s in slow if d) /
+                len(slow),
+            }) for name in names),
+        }
+    return report
+
+
+def request_ids():
+    """ Returns the request id and trace context for the current request """
+    request_id = request.headers.get(REQUEST_ID_HEADER, '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = new_id(16)
+    match = TRACEPARENT_PATTERN.match(request.headers.get('traceparent', ''))
+    if match:
+        return request_id, match.group(1), match.group(2)
+    return request_id, None, None
+
+
+def export_trace(app, trace):
+    trace.finish()
+    try:
+        get_exporter(app).export([trace])
+    except Exception:
+        app.logger.warning('Failed to export trace', exc_info=True)
+
+
+class TraceExportMiddleware(object):
+    """
+    Exports a traced request's trace once the server has sent its body and
+    closed it, so the root span covers the body. Flask tears the request
+    down before that, as soon as a streamed or file response is returned.
+    Untraced responses are passed through untouched.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        app_iter = self.wsgi_app(environ, start_response)
+        export = environ.get(EXPORT_TRACE_KEY)
+        if export is None:
+            return app_iter
+        return ClosingIterator(app_iter, export)
+
+
+def register_tracing(app):
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_statement_span(conn, cursor, statement, parameters,
+                             context, executemany):
+        trace = current_trace()
+        if trace is not None:
+            conn.info.setdefault('trace_spans', []).append(trace.start_span(
+                'db.query',
+                {'db.statement': statement[:STATEMENT_ATTRIBUTE_LENGTH]}
+            ))
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def end_statement_span(conn, cursor, statement, parameters,
+                           context, executemany):
+        spans = conn.info.get('trace_spans')
+        if spans:
+            end_span(spans.pop())
+
+    @event.listens_for(Engine, 'handle_error')
+    def end_failed_statement_span(context):
+        spans = (context.connection is not None and
+                 context.connection.info.get('trace_spans'))
+        if spans:
+            end_span(spans.pop())
+
+    def end_span(statement_span):
+        trace = current_trace()
+        if trace is not None:
+            trace.end_span(statement_span)
+
+    @app.before_request
+    def start_trace():
+        request_id, trace_id, parent_id = request_ids()
+        g.request_id = request_id
+        g.trace = None
+        if (not app.config.get('TRACING_ENABLED') or
+                random.random() >= app.config['TRACE_SAMPLE_RATE']):
+            return
+        g.trace = Trace(request_id, trace_id, parent_id)
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.trace_root = g.trace.start_span(
+            '{} {}'.format(request.method, rule),
+            {'http.method': request.method, 'http.route': rule}
+        )
+
+    @app.after_request
+    def add_request_id(response):
+        if g.get('request_id'):
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+        trace = g.get('trace')
+        if trace is not None:
+            g.trace_root.attributes['http.status_code'] = \
+                response.status_code
+            if not request.environ.get(SUB_REQUEST_KEY):
+                request.environ[EXPORT_TRACE_KEY] = \
+                    lambda: export_trace(app, trace)
+        return response
+
+    # Teardown runs before the body is sent, so only requests that never
+    # reached after_request (unhandled errors) are exported here
+    @app.teardown_request
+    def export_failed_trace(exc):
+        if request.environ.get(SUB_REQUEST_KEY):
+            # A /batch sub-request; its spans belong to the batch's trace
+            return
+        trace = g.get('trace')
+        g.trace = g.request_id = None
+        if trace is not None and EXPORT_TRACE_KEY not in request.environ:
+            export_trace(app, trace)
+
+    app.wsgi_app = TraceExportMiddleware(app.wsgi_app)
@@ -1,17 +1,49 @@
-from flask import make_response, jsonify
+import json
+import tempfile
+import flask_restful
+from flask import make_response, jsonify, request, Response
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
+from .tracing import span
+
+# Items encoded per chunk of a streamed response
+STREAM_CHUNK_ITEMS = 500
+# Spooled response bodies are kept in memory up to this size, then on disk
+SPOOL_MEMORY_BYTES = 1024 * 1024
+# Bytes of a spooled body sent per chunk
+SPOOL_CHUNK_BYTES = 64 * 1024
 
 
 class InvalidJSONException(Exception):
     pass
 
 
+class Api(flask_restful.Api):
+    """
+    Leaves exceptions other than HTTP errors to the app's error handlers
+    (see resources.register_error_handlers). Flask-RESTful only does so
+    while exceptions propagate, as in testing, and otherwise answers them
+    all with its own 500.
+    """
+
+    def handle_error(self, e):
+        if not isinstance(e, HTTPException):
+            raise e
+        return super(Api, self).handle_error(e)
+
+
+def json_response(payload, code):
+    with span('json.encode'):
+        return make_response(jsonify(payload), code)
+
+
 def send_error(message, code=400, **kwargs):
     payload = {
         'status': 'error',
         'error': message
     }
     payload.update(kwargs)
-    return make_response(jsonify(payload), code)
+    return json_response(payload, code)
 
 
 def send_success(message, code=200, **kwargs):
@@ -20,7 +52,7 @@ def send_success(message, code=200, **kwargs):
         'message': message
     }
     payload.update(kwargs)
-    return make_response(jsonify(payload), code)
+    return json_response(payload, code)
 
 
 def send_data(data, code=200, **kwargs):
@@ -29,4 +61,50 @@ def send_data(data, code=200, **kwargs):
         'data': data,
     }
     payload.update(kwargs)
-    return make_response(jsonify(payload), code)
+    return json_response(payload, code)
+
+
+def spool():
+    """ Returns a temporary file to build a response body in """
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+
+
+def send_spooled(body, code=200, **kwargs):
+    """
+    Sends a body built in a spool (see spool) from its start. The view's
+    queries are all done by then, so its database connection goes back to
+    the pool when the request is torn down, instead of being held while a
+    slow client downloads the body.
+    """
+    length = body.tell()
+    body.seek(0)
+    response = Response(wrap_file(request.environ, body, SPOOL_CHUNK_BYTES),
+                        code, direct_passthrough=True, **kwargs)
+    response.content_length = length
+    return response
+
+
+def stream_data(items, code=200):
+    """
+    Like send_data for a list, but encodes the items to a spool a chunk at
+    a time, so the whole list is never held in memory as objects
+    """
+    def encode(chunk):
+        with span('json.encode', items=len(chunk)):
+            return ', '.join(json.dumps(item, sort_keys=True)
+                             for item in chunk).encode('utf-8')
+
+    body = spool()
+    body.write(b'{"data": [')
+    separator = b''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == STREAM_CHUNK_ITEMS:
+            body.write(separator + encode(chunk))
+            separator = b', '
+            chunk = []
+    if chunk:
+        body.write(separator + encode(chunk))
+    body.write(b'], "status": "success"}')
+    return send_spooled(body, code, mimetype='application/json')
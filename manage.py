@@ -1,5 +1,7 @@
 import os
+import sys
 import binascii
+import subprocess
 import unittest
 import coverage
 
@@ -26,9 +28,12 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
-@manager.command
-def test():
+@manager.option('-w', '--workers', dest='workers', type=int, default=1,
+                help='Number of test processes, each with its own database')
+def test(workers=1):
     """Runs the unit tests without test coverage."""
+    if workers > 1:
+        return parallel_test(workers)
     tests = unittest.TestLoader().discover('eachday/tests',
                                            pattern='test*.py')
     result = unittest.TextTestRunner(verbosity=2).run(tests)
@@ -37,6 +42,90 @@ def test():
     return 1
 
 
+def test_classes(suite):
+    """ Yields (test class id, number of tests) for a discovered suite """
+    classes = {}
+    stack = [suite]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, unittest.TestSuite):
+            stack.extend(item)
+        else:
+            cls = type(item)
+            name = '{}.{}'.format(cls.__module__, cls.__name__)
+            classes[name] = classes.get(name, 0) + 1
+    return classes.items()
+
+
+def admin_engine(uri):
+    """ An autocommit engine on the server's maintenance database """
+    from sqlalchemy import create_engine
+    from sqlalchemy.engine.url import make_url
+    url = make_url(uri)
+    url.database = 'postgres'
+    return create_engine(url, isolation_level='AUTOCOMMIT')
+
+
+def parallel_test(workers):
+    """
+    Builds the schema once in a template database, clones one database
+    per worker from it and runs the test classes across worker processes
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.engine.url import make_url
+    from eachday.config import TestingConfig
+
+    base_uri = make_url(TestingConfig.SQLALCHEMY_DATABASE_URI)
+    template = base_uri.database + '_template'
+    names = ['{}_{}'.format(base_uri.database, i) for i in range(workers)]
+    admin = admin_engine(str(base_uri))
+
+    for name in [template] + names:
+        admin.execute('DROP DATABASE IF EXISTS "{}"'.format(name))
+    admin.execute('CREATE DATABASE "{}"'.format(template))
+    template_uri = make_url(str(base_uri))
+    template_uri.database = template
+    template_engine = create_engine(template_uri)
+    db.metadata.create_all(bind=template_engine)
+    template_engine.dispose()
+    for name in names:
+        admin.execute('CREATE DATABASE "{}" TEMPLATE "{}"'
+                      .format(name, template))
+
+    # Hand out the biggest test classes first to balance the workers
+    suite = unittest.TestLoader().discover('eachday/tests',
+                                           pattern='test*.py',
+                                           top_level_dir='.')
+    batches = [[] for _ in names]
+    loads = [0] * workers
+    for name, count in sorted(test_classes(suite), key=lambda c: -c[1]):
+        worker = loads.index(min(loads))
+        batches[worker].append(name)
+        loads[worker] += count
+
+    processes = []
+    for name, batch in zip(names, batches):
+        uri = make_url(str(base_uri))
+        uri.database = name
+        env = dict(os.environ, TEST_DATABASE_URI=str(uri),
+                   TEST_SCHEMA_READY='1')
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'unittest'] + batch,
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ))
+
+    failed = False
+    for i, process in enumerate(processes):
+        output = process.communicate()[0].decode()
+        print('Worker {}:\n{}'.format(i, output))
+        failed = failed or process.returncode != 0
+
+    for name in [template] + names:
+        admin.execute('DROP DATABASE IF EXISTS "{}"'.format(name))
+    admin.dispose()
+    return 1 if failed else 0
+
+
 @manager.command
 def cov():
     """Runs the unit tests with coverage."""
@@ -73,6 +162,305 @@ def drop_db():
     db.drop_all()
 
 
+@manager.command
+def prune_tombstones():
+    """Deletes entry tombstones older than SYNC_TOMBSTONE_DAYS."""
+    from datetime import datetime, timedelta
+    from eachday.models import EntryTombstone
+    cutoff = datetime.utcnow() - timedelta(
+        days=app.config['SYNC_TOMBSTONE_DAYS']
+    )
+    count = (EntryTombstone.query
+             .filter(EntryTombstone.deleted_at < cutoff)
+             .delete(synchronize_session=False))
+    db.session.commit()
+    print('Deleted {} tombstones'.format(count))
+
+
+@manager.command
+def prune_tokens():
+    """Deletes expired refresh tokens."""
+    from datetime import datetime
+    from eachday.models import RefreshToken
+    count = (RefreshToken.query
+             .filter(RefreshToken.expires_at < datetime.utcnow())
+             .delete(synchronize_session=False))
+    db.session.commit()
+    print('Deleted {} refresh tokens'.format(count))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=5000, help='Entry ids copied per transaction')
+def backfill_entry_partitions(batch_size=5000):
+    """Copies entries into entry_partitioned ahead of the table swap."""
+    low, high = (db.session.execute('SELECT min(id), max(id) FROM entry')
+                 .first())
+    if low is None:
+        return
+    # FOR SHARE makes concurrent updates and deletes of a batch's rows wait
+    # until it commits, so the mirror trigger applies them after the copy
+    statement = """
+        INSERT INTO entry_partitioned
+            (id, user_id, date, notes, rating, updated_at)
+        SELECT id, user_id, date, notes, rating, updated_at FROM entry
+        WHERE id >= :start AND id < :end
+        FOR SHARE
+        ON CONFLICT DO NOTHING
+    """
+    for start in range(low, high + 1, batch_size):
+        result = db.session.execute(statement, {'start': start,
+                                                'end': start + batch_size})
+        db.session.commit()
+        print('Copied ids {}-{}: {} rows'.format(
+            start, min(start + batch_size, high + 1) - 1, result.rowcount
+        ))
+
+
+@manager.option('-y', '--year', dest='year', type=int, required=True)
+@manager.option('-w', '--workers', dest='workers', type=int,
+                default=None, help='Worker processes (default: one per CPU)')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=500, help='Users per grouped query')
+@manager.option('--rebuild', dest='rebuild', action='store_true',
+                help='Rebuild existing reports instead of skipping them')
+def build_reports(year, workers=None, chunk_size=500, rebuild=False):
+    """Builds every user's year in review report for GET /reports/<year>."""
+    import multiprocessing
+    from eachday.reports import build_reports
+
+    def progress(done, elapsed):
+        print('{} users, {:.0f} users/s'.format(
+            done, done / elapsed if elapsed else 0))
+
+    done, elapsed = build_reports(year, workers or multiprocessing.cpu_count(),
+                                  chunk_size, rebuild, progress)
+    print('Built {} reports in {:.1f}s ({:.0f} users/s)'.format(
+        done, elapsed, done / elapsed if elapsed else 0))
+
+
+@manager.option('directory', help='Directory to write the backup to')
+@manager.option('-w', '--workers', dest='workers', type=int,
+                default=None, help='Worker processes (default: one per CPU)')
+@manager.option('-c', '--chunk-ids', dest='chunk_ids', type=int,
+                default=10000, help='User ids per chunk file')
+def backup(directory, workers=None, chunk_ids=10000):
+    """Backs up users, entries and tokens to a directory."""
+    import multiprocessing
+    from eachday.backup import backup
+
+    def progress(chunk):
+        print('{file}: {rows} rows'.format(**chunk))
+
+    manifest = backup(directory, workers or multiprocessing.cpu_count(),
+                      chunk_ids, progress)
+    print('Wrote {} rows in {} chunks in {:.1f}s'.format(
+        sum(c['rows'] for c in manifest['chunks']),
+        len(manifest['chunks']), manifest['seconds']))
+
+
+@manager.option('directory', help='Directory written by manage.py backup')
+@manager.option('-w', '--workers', dest='workers', type=int,
+                default=None, help='Worker processes (default: one per CPU)')
+def restore(directory, workers=None):
+    """Loads a backup into an empty database and rebuilds its indexes."""
+    import multiprocessing
+    import time
+    from eachday.backup import restore
+
+    def progress(chunk):
+        print('{file}: {rows} rows'.format(**chunk))
+
+    started = time.time()
+    counts = restore(directory, workers or multiprocessing.cpu_count(),
+                     progress)
+    print('Restored {} in {:.1f}s'.format(
+        ', '.join('{} {} rows'.format(count, table)
+                  for table, count in sorted(counts.items())),
+        time.time() - started))
+
+
+@manager.option('directory', nargs='?', default='analytics',
+                help='Directory of monthly partitions (default: analytics)')
+@manager.option('-f', '--format', dest='file_format', default=None,
+                choices=['parquet', 'npy'],
+                help='File format (default: parquet if pyarrow is installed)')
+@manager.option('--full', dest='full', action='store_true',
+                help='Rewrite every month, not just the changed ones')
+def dump_analytics(directory='analytics', file_format=None, full=False):
+    """Writes entries to columnar files, one partition per month."""
+    from eachday.analytics import dump_analytics
+    written, removed = dump_analytics(directory, file_format, full)
+    print('Wrote {} months{}, removed {}'.format(
+        len(written), ' ({})'.format(', '.join(written)) if written else '',
+        len(removed)))
+
+
+@manager.option('--once', dest='once', action='store_true',
+                help='Exit once there are no pending jobs')
+def export_worker(once=False):
+    """Processes export jobs queued through POST /export/jobs."""
+    from eachday.exports import run_worker
+    run_worker(once=once)
+
+
+@manager.option('directory', nargs='?', default='public',
+                help='Build directory to compress (default: public)')
+def compress_static(directory='public'):
+    """Writes precompressed .gz/.br variants of the frontend build."""
+    from eachday.static import compress_directory
+    for path in compress_directory(directory):
+        print(path)
+
+
+@manager.option('-n', '--number', dest='number', type=int, default=2000,
+                help='Iterations per lookup')
+def bench_queries(number=2000):
+    """Times the hot-path lookups built per call vs. as baked queries."""
+    import timeit
+    from datetime import date
+    from eachday import queries
+    from eachday.models import User, Entry, BlacklistToken
+
+    # Coverage tracing would dominate the timings
+    COV.stop()
+    user = User(email='bench-queries@eachday.invalid', password='x',
+                name='bench')
+    db.session.add(user)
+    db.session.commit()
+    entry = Entry(user_id=user.id, date=date(2017, 1, 1), rating=5)
+    db.session.add(entry)
+    db.session.commit()
+    user_id, entry_id = user.id, entry.id
+    dialect = db.session.get_bind(User.__mapper__).dialect
+
+    def built_blacklist():
+        return BlacklistToken.query.filter_by(token='token')
+
+    def built_user():
+        return db.session.query(User).filter_by(id=user_id)
+
+    def built_entry():
+        return db.session.query(Entry).filter_by(user_id=user_id,
+                                                 id=entry_id)
+
+    lookups = [
+        ('blacklist', built_blacklist,
+         lambda: queries.is_blacklisted('token')),
+        ('user by id', built_user, lambda: queries.get_user(user_id)),
+        ('entry by id', built_entry,
+         lambda: queries.get_entry(user_id, entry_id)),
+    ]
+    print('{:<12} {:>14} {:>12} {:>12}'.format(
+        'lookup', 'build+compile', 'built', 'baked'))
+    try:
+        for name, built, baked in lookups:
+            def compile_only():
+                built().statement.compile(dialect=dialect)
+
+            def run_built():
+                built().first()
+                db.session.expunge_all()
+
+            def run_baked():
+                baked()
+                db.session.expunge_all()
+
+            timings = [timeit.timeit(fn, number=number) / number * 1e6
+                       for fn in (compile_only, run_built, run_baked)]
+            print('{:<12} {:>12.0f}us {:>10.0f}us {:>10.0f}us'.format(
+                name, *timings))
+    finally:
+        db.session.rollback()
+        Entry.query.filter_by(user_id=user_id).delete()
+        User.query.filter_by(id=user_id).delete()
+        db.session.commit()
+
+
+@manager.option('-e', '--entries', dest='entries', type=int, default=20000,
+                help='Entries exported per request')
+@manager.option('-n', '--number', dest='number', type=int, default=10,
+                help='Requests per path')
+def bench_export(entries=20000, number=10):
+    """Times GET /export built by csv.writer vs. spooled from COPY."""
+    import time
+    import tracemalloc
+    from datetime import date, timedelta
+    from eachday.models import User, Entry
+
+    # Coverage tracing would dominate the timings
+    COV.stop()
+    user = User(email='bench-export@eachday.invalid', password='x',
+                name='bench')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    db.session.execute(Entry.__table__.insert(), [
+        {'user_id': user_id, 'date': date(1970, 1, 1) + timedelta(days=i),
+         'rating': i % 10 + 1, 'notes': 'Note, "number" {}\n'.format(i) * 4,
+         'updated_at': date.today()}
+        for i in range(entries)
+    ])
+    db.session.commit()
+    headers = {'Authorization': 'Bearer ' +
+               user.encode_auth_token(user_id).decode()}
+    client = app.test_client()
+    print('{:<10} {:>10} {:>14} {:>12}'.format(
+        'path', 'time', 'first byte', 'peak alloc'))
+    try:
+        for name, use_copy in (('csv', False), ('copy', True)):
+            app.config['EXPORT_COPY'] = use_copy
+            total = first = 0
+            tracemalloc.start()
+            for _ in range(number):
+                started = time.time()
+                resp = client.get('/export', headers=headers, buffered=False)
+                body = iter(resp.response)
+                next(body)
+                first += time.time() - started
+                for _ in body:
+                    pass
+                resp.close()
+                total += time.time() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:<10} {:>8.1f}ms {:>12.1f}ms {:>10.1f}MB'.format(
+                name, total / number * 1000, first / number * 1000,
+                peak / 1e6))
+    finally:
+        db.session.rollback()
+        Entry.query.filter_by(user_id=user_id).delete()
+        User.query.filter_by(id=user_id).delete()
+        db.session.commit()
+
+
+@manager.command
+def profile_header():
+    """Prints an X-Profile header that profiles requests to this app."""
+    from eachday.profiling import PROFILE_HEADER, profile_header_value
+    print('{}: {}'.format(PROFILE_HEADER,
+                          profile_header_value(app.config['SECRET_KEY'])))
+
+
+@manager.option('path', nargs='?', default=None,
+                help='Span file to read (default: TRACE_FILE)')
+def trace_report(path=None):
+    """Shows which stages dominate request latency, from exported spans."""
+    import json
+    from eachday.tracing import stage_report
+    with open(path or app.config['TRACE_FILE']) as f:
+        report = stage_report(json.loads(line) for line in f)
+    for route, summary in sorted(report.items()):
+        print('{}: {} requests, p50 {:.1f}ms, p99 {:.1f}ms'.format(
+            route, summary['count'], summary['p50'], summary['p99']))
+        print('  {:<32} {:>9} {:>9} {:>12}'.format(
+            'stage', 'p50', 'p99', 'share@p99'))
+        stages = sorted(summary['stages'].items(),
+                        key=lambda item: -item[1]['p99_share'])
+        for name, stage in stages:
+            print('  {:<32} {:>7.2f}ms {:>7.2f}ms {:>11.0%}'.format(
+                name, stage['p50'], stage['p99'], stage['p99_share']))
+
+
 @manager.command
 def generate_key():
     """ Prints a random hex value (used for SECRET_KEY) """
@@ -0,0 +1,93 @@
+"""Create a hash-partitioned copy of entry, kept in sync by a trigger
+
+This is the first step of moving entry to a table partitioned by hash of
+user_id without taking the app down:
+
+1. This revision creates entry_partitioned, with ENTRY_PARTITIONS
+   partitions, and a trigger that mirrors every write on entry into it.
+2. `python manage.py backfill_entry_partitions` copies the existing rows in
+   small batches, one transaction each.
+3. The next revision swaps the tables, holding a lock on entry only while
+   it catches up on anything the backfill missed.
+
+The schema comes from `manage.py create_db` and the revisions before
+this one, which add entry.updated_at; on databases other than Postgres
+this revision does nothing.
+
+Revision ID: 3c5e1b7a9d20
+Revises: d4e8b1f3a027
+Create Date: 2026-10-19 14:55:12.402118
+
+"""
+from alembic import op
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e1b7a9d20'
+down_revision = 'd4e8b1f3a027'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    partitions = current_app.config['ENTRY_PARTITIONS']
+    # The primary key must include the partition key; id stays unique
+    # since it still comes from entry's sequence
+    op.execute('''
+        CREATE TABLE entry_partitioned (
+            id integer NOT NULL DEFAULT nextval('entry_id_seq'),
+            user_id integer NOT NULL REFERENCES "user" (id),
+            date date NOT NULL,
+            notes text,
+            rating integer,
+            updated_at timestamp without time zone NOT NULL,
+            CONSTRAINT entry_partitioned_pkey PRIMARY KEY (id, user_id),
+            CONSTRAINT entry_partitioned_user_id_date_key
+                UNIQUE (user_id, date)
+        ) PARTITION BY HASH (user_id)
+    ''')
+    for remainder in range(partitions):
+        op.execute('''
+            CREATE TABLE entry_p{remainder:02d} PARTITION OF entry_partitioned
+            FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})
+        '''.format(modulus=partitions, remainder=remainder))
+    op.execute('''
+        CREATE INDEX ix_entry_partitioned_user_id_updated_at
+        ON entry_partitioned (user_id, updated_at)
+    ''')
+
+    op.execute('''
+        CREATE FUNCTION entry_mirror() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM entry_partitioned
+                WHERE id = OLD.id AND user_id = OLD.user_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO entry_partitioned
+                    (id, user_id, date, notes, rating, updated_at)
+                VALUES (NEW.id, NEW.user_id, NEW.date, NEW.notes,
+                        NEW.rating, NEW.updated_at);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER entry_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON entry
+        FOR EACH ROW EXECUTE PROCEDURE entry_mirror()
+    ''')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('DROP TRIGGER entry_mirror ON entry')
+    op.execute('DROP FUNCTION entry_mirror()')
+    op.execute('DROP TABLE entry_partitioned')
@@ -0,0 +1,34 @@
+"""Add user.profile_version
+
+Auth tokens carry the version of the profile they were issued for, so
+GET /user can answer from their claims while it is current. Databases
+created by `manage.py create_db` since then already have the column and
+are left alone.
+
+Revision ID: 5a7c2e9d41b6
+Revises:
+Create Date: 2026-10-19 14:28:40.517203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a7c2e9d41b6'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = sa.inspect(op.get_bind()).get_columns('user')
+    if 'profile_version' in [column['name'] for column in columns]:
+        return
+    op.add_column('user', sa.Column('profile_version', sa.Integer(),
+                                    nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('profile_version')
@@ -0,0 +1,80 @@
+"""Swap entry for its hash-partitioned copy
+
+Holds an exclusive lock on entry while it copies any rows that
+`manage.py backfill_entry_partitions` has not, then renames the tables.
+Run the backfill first on large tables; otherwise this copies everything
+under the lock. The old table is kept as entry_unpartitioned, to be
+dropped once the new one has proven itself.
+
+Revision ID: 8f2d4a6c1e93
+Revises: 3c5e1b7a9d20
+Create Date: 2026-10-19 15:02:47.119604
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2d4a6c1e93'
+down_revision = '3c5e1b7a9d20'
+branch_labels = None
+depends_on = None
+
+COLUMNS = 'id, user_id, date, notes, rating, updated_at'
+
+
+def rename(old, new):
+    """ Renames a table and the constraints and index named after it """
+    op.execute('ALTER TABLE {0} RENAME TO {1}'.format(old, new))
+    for suffix in ('pkey', 'user_id_date_key', 'user_id_fkey'):
+        op.execute('ALTER TABLE {1} RENAME CONSTRAINT {0}_{2} TO {1}_{2}'
+                   .format(old, new, suffix))
+    op.execute('ALTER INDEX ix_{0}_user_id_updated_at '
+               'RENAME TO ix_{1}_user_id_updated_at'.format(old, new))
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('LOCK TABLE entry IN ACCESS EXCLUSIVE MODE')
+    op.execute('''
+        INSERT INTO entry_partitioned ({0})
+        SELECT {0} FROM entry
+        ON CONFLICT DO NOTHING
+    '''.format(COLUMNS))
+    op.execute('''
+        DELETE FROM entry_partitioned p
+        WHERE NOT EXISTS (SELECT 1 FROM entry e
+                          WHERE e.id = p.id AND e.user_id = p.user_id)
+    ''')
+    # The mirror function stays until the previous revision is downgraded
+    op.execute('DROP TRIGGER entry_mirror ON entry')
+
+    rename('entry', 'entry_unpartitioned')
+    rename('entry_partitioned', 'entry')
+    op.execute('ALTER SEQUENCE entry_id_seq OWNED BY entry.id')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # Writes made since the upgrade only exist in the partitioned table, so
+    # copy them back; this holds the lock for a full copy
+    op.execute('LOCK TABLE entry IN ACCESS EXCLUSIVE MODE')
+    op.execute('LOCK TABLE entry_unpartitioned IN ACCESS EXCLUSIVE MODE')
+    op.execute('DELETE FROM entry_unpartitioned')
+    op.execute('''
+        INSERT INTO entry_unpartitioned ({0})
+        SELECT {0} FROM entry
+    '''.format(COLUMNS))
+
+    rename('entry', 'entry_partitioned')
+    rename('entry_unpartitioned', 'entry')
+    op.execute('ALTER SEQUENCE entry_id_seq OWNED BY entry.id')
+    op.execute('''
+        CREATE TRIGGER entry_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON entry
+        FOR EACH ROW EXECUTE PROCEDURE entry_mirror()
+    ''')
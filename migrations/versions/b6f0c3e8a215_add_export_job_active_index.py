@@ -0,0 +1,66 @@
+"""Allow one queued or running export job per user
+
+POST /export/jobs checks for a queued job before adding one, so two
+concurrent requests could both add one. A partial unique index now
+rejects the second, and the request answers with the first. Jobs that
+already doubled up are marked failed, keeping the oldest. Databases that
+predate export jobs get the table; those created by `manage.py create_db`
+since then already have the index and are left alone.
+
+Revision ID: b6f0c3e8a215
+Revises: 8f2d4a6c1e93
+Create Date: 2026-10-19 15:51:12.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6f0c3e8a215'
+down_revision = '8f2d4a6c1e93'
+branch_labels = None
+depends_on = None
+
+ACTIVE = "status IN ('pending', 'running')"
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'export_job' not in inspector.get_table_names():
+        op.create_table(
+            'export_job',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('status', sa.String(), nullable=False),
+            sa.Column('data_version', sa.String(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('started_at', sa.DateTime(), nullable=True),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+            sa.Column('error', sa.Text(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_export_job_user_id_data_version', 'export_job',
+                        ['user_id', 'data_version'])
+        op.create_index('ix_export_job_status', 'export_job', ['status'])
+
+    indexes = [index['name'] for index in
+               inspector.get_indexes('export_job')]
+    if 'ix_export_job_user_id_active' in indexes:
+        return
+    op.execute(
+        "UPDATE export_job SET status = 'failed', "
+        "error = 'Duplicate of an earlier job' "
+        "WHERE {0} AND EXISTS (SELECT 1 FROM export_job AS earlier "
+        "WHERE earlier.user_id = export_job.user_id AND earlier.{0} "
+        "AND earlier.id < export_job.id)".format(ACTIVE)
+    )
+    op.create_index('ix_export_job_user_id_active', 'export_job',
+                    ['user_id'], unique=True,
+                    postgresql_where=sa.text(ACTIVE),
+                    sqlite_where=sa.text(ACTIVE))
+
+
+def downgrade():
+    op.drop_index('ix_export_job_user_id_active', table_name='export_job')
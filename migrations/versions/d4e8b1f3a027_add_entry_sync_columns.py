@@ -0,0 +1,65 @@
+"""Add entry.updated_at, its index and entry_tombstone for delta sync
+
+GET /entry/changes returns the entries updated, and the tombstones of
+those deleted, since a client's cursor. Existing entries get the time
+of the upgrade as their updated_at, so clients that sync afterwards
+fetch them once more. Databases created by `manage.py create_db` since
+then already have all of this and are left alone.
+
+Revision ID: d4e8b1f3a027
+Revises: 5a7c2e9d41b6
+Create Date: 2026-10-19 14:35:01.208374
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e8b1f3a027'
+down_revision = '5a7c2e9d41b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    postgres = bind.dialect.name == 'postgresql'
+
+    columns = [column['name'] for column in inspector.get_columns('entry')]
+    if 'updated_at' not in columns:
+        # The app sets updated_at itself (in UTC); the default only fills
+        # in existing rows. It is not volatile, so Postgres doesn't
+        # rewrite the table.
+        now = "timezone('utc', now())" if postgres else 'CURRENT_TIMESTAMP'
+        op.add_column('entry', sa.Column('updated_at', sa.DateTime(),
+                                         nullable=False,
+                                         server_default=sa.text(now)))
+        if postgres:
+            op.alter_column('entry', 'updated_at', server_default=None)
+
+    indexes = [index['name'] for index in inspector.get_indexes('entry')]
+    if 'ix_entry_user_id_updated_at' not in indexes:
+        op.create_index('ix_entry_user_id_updated_at', 'entry',
+                        ['user_id', 'updated_at'])
+
+    if 'entry_tombstone' not in inspector.get_table_names():
+        op.create_table(
+            'entry_tombstone',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('entry_id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_entry_tombstone_user_id_deleted_at',
+                        'entry_tombstone', ['user_id', 'deleted_at'])
+
+
+def downgrade():
+    op.drop_table('entry_tombstone')
+    op.drop_index('ix_entry_user_id_updated_at', table_name='entry')
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,44 @@
+"""Add refresh_token
+
+Logging in issues a refresh token alongside the short-lived access token,
+so /login, /register and /token/refresh need this table. Databases
+created by `manage.py create_db` since then already have it and are left
+alone.
+
+Revision ID: e1a9d7c4b352
+Revises: b6f0c3e8a215
+Create Date: 2026-10-19 16:24:09.381552
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1a9d7c4b352'
+down_revision = 'b6f0c3e8a215'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'refresh_token' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'refresh_token',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('family', sa.String(), nullable=False),
+        sa.Column('secret_hash', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('revoked_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_refresh_token_family', 'refresh_token', ['family'])
+    op.create_index('ix_refresh_token_user_id', 'refresh_token', ['user_id'])
+
+
+def downgrade():
+    op.drop_table('refresh_token')
@@ -0,0 +1,44 @@
+"""Add year_report
+
+`manage.py build_reports` writes each user's year in review here, and
+GET /reports/<year> reads it. Databases created by `manage.py create_db`
+since then already have it and are left alone.
+
+Revision ID: f3c6b2a8d914
+Revises: e1a9d7c4b352
+Create Date: 2026-10-19 16:31:47.825190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c6b2a8d914'
+down_revision = 'e1a9d7c4b352'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'year_report' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'year_report',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('year', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.Column('rated_count', sa.Integer(), nullable=False),
+        sa.Column('average_rating', sa.Float(), nullable=True),
+        sa.Column('best_month', sa.Integer(), nullable=True),
+        sa.Column('worst_month', sa.Integer(), nullable=True),
+        sa.Column('longest_streak', sa.Integer(), nullable=False),
+        sa.Column('built_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('user_id', 'year')
+    )
+    op.create_index('ix_year_report_year', 'year_report', ['year'])
+
+
+def downgrade():
+    op.drop_table('year_report')
@@ -1,7 +1,7 @@
 import axios from 'axios'
 import jwtDecode from 'jwt-decode'
 import { push } from 'react-router-redux'
-import { errorHandler, cookie, API_URL } from './utils'
+import { errorHandler, cookie, storeTokens, API_URL } from './utils'
 import { AUTH_USER,
          AUTH_ERROR,
          UNAUTH_USER,
@@ -10,7 +10,7 @@ import { AUTH_USER,
 export const loginUser = ({ email, password }) => (dispatch) =>
   axios.post(`${API_URL}/login`, { email, password })
   .then(response => {
-    cookie.set('token', response.data.auth_token, { path: '/' })
+    storeTokens(response.data)
     let payload = jwtDecode(response.data.auth_token)
     dispatch({ type: AUTH_USER, payload: payload })
     dispatch(push('/dashboard'))
@@ -25,7 +25,7 @@ export const registerUser = ({ email, password, name }) => (dispatch) =>
     if (response.data.status !== 'success') {
       errorHandler(dispatch, response, AUTH_ERROR)
     }
-    cookie.set('token', response.data.auth_token, { path: '/' })
+    storeTokens(response.data)
     let payload = jwtDecode(response.data.auth_token)
     dispatch({ type: AUTH_USER, payload: payload })
     dispatch(push('/dashboard'))
@@ -36,13 +36,17 @@ export const registerUser = ({ email, password, name }) => (dispatch) =>
 
 export const logoutUser = () => (dispatch) => {
   const token = cookie.get('token')
+  const refreshToken = cookie.get('refresh_token')
   cookie.remove('token', { path: '/' })
+  cookie.remove('refresh_token', { path: '/' })
 
   dispatch(push('/'))
   dispatch({ type: UNAUTH_USER })
 
-  // Logout request so current auth_token is blacklisted
-  return axios.post(`${API_URL}/logout`, {}, {
+  // Logout request so the refresh token (or, without one, the current
+  // auth_token) is revoked
+  const body = refreshToken ? { refresh_token: refreshToken } : {}
+  return axios.post(`${API_URL}/logout`, body, {
     headers: { 'Authorization': 'Bearer ' + token }
   })
 }
@@ -1,4 +1,4 @@
-import { errorHandler, cookie, API_URL } from './utils'
+import { errorHandler, cookie, storeTokens, API_URL } from './utils'
 import axios from 'axios'
 import { USER_UPDATE,
          CLEAR_PROFILE_API_ERROR,
@@ -17,7 +17,7 @@ export const updateProfile = ({ id, email, name, new_password, password }) => (d
     if (response.data.status !== 'success') {
       return errorHandler(dispatch, response, PROFILE_API_ERROR)
     }
-    cookie.set('token', response.data.data.auth_token, { path: '/' })
+    storeTokens(response.data.data)
     dispatch({ type: USER_UPDATE, payload: response.data.data })
   })
   .catch((error) => {
@@ -1,4 +1,5 @@
 import Cookies from 'universal-cookie'
+import axios from 'axios'
 import map from 'lodash.map'
 
 const cookie = new Cookies()
@@ -6,6 +7,57 @@ export { cookie }
 
 export const API_URL = process.env.API_BASE_URL
 
+const EXPIRED_TOKEN_ERROR = 'Signature expired. Please log in again.'
+
+export function storeTokens ({ auth_token: authToken, refresh_token: refreshToken }) {
+  cookie.set('token', authToken, { path: '/' })
+  if (refreshToken) {
+    // Not httpOnly: POST /token/refresh takes the token in its JSON body,
+    // so this script has to read it. Secure and strict SameSite keep it
+    // off plain HTTP and out of cross-site requests.
+    cookie.set('refresh_token', refreshToken, {
+      path: '/', secure: true, sameSite: 'strict'
+    })
+  }
+}
+
+// Each refresh token can only be used once, so requests that fail at the
+// same time share a single refresh
+let refreshing = null
+
+export function refreshTokens () {
+  if (!refreshing) {
+    refreshing = axios.post(`${API_URL}/token/refresh`, {
+      refresh_token: cookie.get('refresh_token')
+    })
+    .then(response => {
+      refreshing = null
+      storeTokens(response.data)
+      return response.data.auth_token
+    }, error => {
+      refreshing = null
+      throw error
+    })
+  }
+  return refreshing
+}
+
+// Access tokens are short-lived: when one has expired, get a new one with
+// the refresh token and retry the request once
+axios.interceptors.response.use(null, (error) => {
+  const { config, response } = error
+  if (response && response.status === 401 && response.data &&
+      response.data.error === EXPIRED_TOKEN_ERROR && !config.retried &&
+      cookie.get('refresh_token')) {
+    config.retried = true
+    return refreshTokens().then(token => {
+      config.headers['Authorization'] = 'Bearer ' + token
+      return axios(config)
+    })
+  }
+  return Promise.reject(error)
+})
+
 export function formatErrorObject (err) {
   let messages = map(err, (key, msg) => {
     return `${msg}: ${key}`
@@ -16,10 +16,12 @@ const history = createHistory()
 const createStoreWithMiddleware = applyMiddleware(reduxThunk, routerMiddleware(history))(createStore)
 const store = createStoreWithMiddleware(reducers)
 
-const token = (new Cookies()).get('token')
+const cookies = new Cookies()
+const token = cookies.get('token')
 
-// Check if token is available and non-expired
-if (token && jwtDecode(token) && jwtDecode(token).exp > Math.floor(Date.now() / 1000)) {
+// Check if token is available and non-expired, or can be refreshed
+if (token && jwtDecode(token) && (jwtDecode(token).exp > Math.floor(Date.now() / 1000) ||
+    cookies.get('refresh_token'))) {
   store.dispatch({ type: AUTH_USER, payload: jwtDecode(token) })
 }
 